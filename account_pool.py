@@ -0,0 +1,178 @@
+import os
+import json
+import time
+from datetime import datetime
+
+from storage_db import get_connection, transaction, APP_DB_PATH
+
+# --- CẤU HÌNH POOL TÀI KHOẢN FLOW ---
+# Số lần 401 trong cửa sổ thời gian để coi tài khoản là chết (bỏ qua khi phân task)
+ACCOUNT_401_THRESHOLD = int(os.environ.get("ACCOUNT_401_THRESHOLD", "3"))
+ACCOUNT_401_WINDOW = float(os.environ.get("ACCOUNT_401_WINDOW", "600"))
+
+STATUS_HEALTHY = "healthy"
+STATUS_DEAD = "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flow_accounts (
+    name TEXT PRIMARY KEY,
+    cookies TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'healthy',
+    token TEXT,
+    token_at REAL,
+    recent_401 INTEGER DEFAULT 0,
+    last_401_at REAL,
+    last_error TEXT,
+    inflight_tasks INTEGER DEFAULT 0,
+    inflight_jobs INTEGER DEFAULT 0,
+    created_at TEXT,
+    updated_at REAL
+);
+"""
+
+# Cột trả về cho trang admin (không kèm cookies / token)
+_PUBLIC_COLUMNS = ("name, status, token_at, recent_401, last_401_at, last_error, "
+                   "inflight_tasks, inflight_jobs, created_at, updated_at")
+
+
+class AccountPool:
+    """
+    Pool các bộ cookie Flow có tên (mỗi bộ là một tài khoản). Lưu trong SQLite nên mọi
+    tiến trình cùng thấy. Scheduler lấy tài khoản đang ít việc nhất trong số tài khoản
+    còn sống; tài khoản bị 401 liên tục hoặc cookie hỏng bị đánh dấu chết và bỏ qua.
+    """
+    def __init__(self, db_path=APP_DB_PATH):
+        self.db_path = db_path
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        return get_connection(self.db_path)
+
+    # --- QUẢN LÝ ---
+    def migrate_legacy(self, cookies, name="default"):
+        """Bộ cookie duy nhất của phiên bản cũ -> tài khoản đầu tiên (chỉ khi pool còn trống)."""
+        if cookies and not self._conn().execute("SELECT 1 FROM flow_accounts LIMIT 1").fetchone():
+            self.upsert(name, cookies)
+
+    def upsert(self, name, cookies):
+        """Thêm / thay cookie cho một tài khoản. Cookie mới -> coi như còn sống, xoá token cũ."""
+        self._conn().execute(
+            "INSERT INTO flow_accounts (name, cookies, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET cookies = excluded.cookies, status = excluded.status, "
+            "token = NULL, token_at = NULL, recent_401 = 0, last_401_at = NULL, last_error = NULL, "
+            "updated_at = excluded.updated_at",
+            (name, json.dumps(cookies), STATUS_HEALTHY, datetime.now().isoformat(timespec="seconds"), time.time())
+        )
+
+    def delete(self, name):
+        self._conn().execute("DELETE FROM flow_accounts WHERE name = ?", (name,))
+
+    def all(self):
+        rows = self._conn().execute(f"SELECT {_PUBLIC_COLUMNS}, token IS NOT NULL AS has_token FROM flow_accounts ORDER BY name")
+        return [dict(r) for r in rows]
+
+    def get(self, name):
+        row = self._conn().execute("SELECT * FROM flow_accounts WHERE name = ?", (name,)).fetchone()
+        return self._with_cookies(row)
+
+    def _with_cookies(self, row):
+        if row is None:
+            return None
+        account = dict(row)
+        account["cookies"] = json.loads(account["cookies"])
+        return account
+
+    def healthy_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM flow_accounts WHERE status = ?", (STATUS_HEALTHY,)).fetchone()[0]
+
+    # --- PHÂN TÀI KHOẢN ---
+    def _least_loaded(self, conn):
+        return conn.execute(
+            "SELECT * FROM flow_accounts WHERE status = ? "
+            "ORDER BY inflight_tasks + inflight_jobs, recent_401, name LIMIT 1",
+            (STATUS_HEALTHY,)
+        ).fetchone()
+
+    def pick(self):
+        """Tài khoản sống đang ít việc nhất (không tăng bộ đếm). None nếu không còn tài khoản nào."""
+        return self._with_cookies(self._least_loaded(self._conn()))
+
+    def acquire(self):
+        """Như pick() nhưng giữ chỗ cho một task; trả lại bằng release(name)."""
+        conn = self._conn()
+        with transaction(conn):
+            row = self._least_loaded(conn)
+            if row is not None:
+                conn.execute("UPDATE flow_accounts SET inflight_tasks = inflight_tasks + 1 WHERE name = ?", (row["name"],))
+        return self._with_cookies(row)
+
+    def release(self, name):
+        self._conn().execute(
+            "UPDATE flow_accounts SET inflight_tasks = MAX(0, inflight_tasks - 1) WHERE name = ?", (name,)
+        )
+
+    def job_started(self, name):
+        self._conn().execute("UPDATE flow_accounts SET inflight_jobs = inflight_jobs + 1 WHERE name = ?", (name,))
+
+    def job_finished(self, name):
+        self._conn().execute(
+            "UPDATE flow_accounts SET inflight_jobs = MAX(0, inflight_jobs - 1) WHERE name = ?", (name,)
+        )
+
+    def reset_inflight(self):
+        """Leader mới khởi động: bộ đếm của leader cũ không còn đúng."""
+        self._conn().execute("UPDATE flow_accounts SET inflight_tasks = 0, inflight_jobs = 0")
+
+    # --- SỨC KHOẺ ---
+    def record_token(self, name, token):
+        """
+        Token worker vừa bắt được từ trang của tài khoản. Không xoá bộ đếm 401: cookie hỏng vẫn
+        bắt được token nhưng bị 401 ngay, bộ đếm chỉ về 0 khi report_ok (kiểm tra token thành công).
+        """
+        if not name or not token:
+            return
+        self._conn().execute(
+            "UPDATE flow_accounts SET token = ?, token_at = ? WHERE name = ?",
+            (token, time.time(), name)
+        )
+
+    def report_ok(self, name):
+        self._conn().execute(
+            "UPDATE flow_accounts SET status = ?, recent_401 = 0, last_error = NULL, updated_at = ? WHERE name = ?",
+            (STATUS_HEALTHY, time.time(), name)
+        )
+
+    def report_401(self, name=None, token=None):
+        """
+        Ghi nhận một lần 401, theo tên tài khoản (worker biết mình chạy trên tài khoản nào);
+        chỉ tìm theo token khi không có tên. Quá ngưỡng trong cửa sổ -> chết.
+        """
+        now = time.time()
+        conn = self._conn()
+        with transaction(conn):
+            if name is None:
+                row = conn.execute("SELECT * FROM flow_accounts WHERE token = ?", (token,)).fetchone() if token else None
+            else:
+                row = conn.execute("SELECT * FROM flow_accounts WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            recent = 1 if not row["last_401_at"] or now - row["last_401_at"] > ACCOUNT_401_WINDOW else row["recent_401"] + 1
+            status = STATUS_DEAD if recent >= ACCOUNT_401_THRESHOLD else row["status"]
+            conn.execute(
+                "UPDATE flow_accounts SET recent_401 = ?, last_401_at = ?, status = ?, token = NULL, "
+                "last_error = ?, updated_at = ? WHERE name = ?",
+                (recent, now, status, "401 Unauthorized", now, row["name"])
+            )
+        if status == STATUS_DEAD and row["status"] != STATUS_DEAD:
+            print(f"💀 Tài khoản Flow '{row['name']}' bị 401 {recent} lần, tạm ngừng phân task.")
+        return row["name"]
+
+    def mark_dead(self, name, reason):
+        self._conn().execute(
+            "UPDATE flow_accounts SET status = ?, token = NULL, last_error = ?, updated_at = ? WHERE name = ?",
+            (STATUS_DEAD, str(reason)[:500], time.time(), name)
+        )
+        print(f"💀 Tài khoản Flow '{name}' bị đánh dấu chết: {reason}")
+
+
+ACCOUNTS = AccountPool()
@@ -2,18 +2,32 @@ import json
 import os
 import threading
 import uuid
+import time
 from pathlib import Path
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 from werkzeug.routing.exceptions import BuildError
 
 import requests
 from playwright.sync_api import sync_playwright
 from playwright._impl._errors import TargetClosedError
-from workers import start_worker
+from workers import start_worker, BROWSER_POOL, P2V_PIPELINE_DEPTH_MAX, P2V_PAGES_PER_TASK_MAX
+from token_cache import TOKEN_CACHE
+from scheduler import JobScheduler, auto_slots
+from user_store import UserStore
+from task_versions import create_task, current_cursor, resolve_since, task_delta
+from task_events import TASK_EVENTS
+from task_log import TaskLog, TaskLogSnapshot, read_spilled, log_path
+from task_archive import TaskArchive, is_terminal
+from task_journal import JOURNAL
+from shared_state import SHARED
+from account_pool import ACCOUNTS
+from task_summary import TASK_SUMMARIES, query_summaries, user_stats
+from upload_store import UPLOADS, IMAGE_EXTENSIONS
+from zip_stream import stream_zip, unique_names
+from storage_catalog import STORAGE, KIND_UPLOAD
 
 # --- HẰNG SỐ CỦA WORKER ---
 FLOW_URL = "https://labs.google/fx/vi/tools/flow/project/447e27e0-fb0a-44b1-99f0-1624c028d6c4"
@@ -28,6 +42,9 @@ class CustomJSONEncoder(json.JSONEncoder):
             return obj.isoformat()
         if isinstance(obj, threading.Event):
              return "threading.Event (Removed)"
+        if isinstance(obj, (TaskLog, TaskLogSnapshot)):
+            # Chỉ phần log còn trong RAM; toàn bộ log đọc qua /api/task_log
+            return obj.tail()
         return json.JSONEncoder.default(self, obj)
 
 # --- KHỞI TẠO VÀ CẤU HÌNH ---
@@ -42,39 +59,48 @@ Path(app.config['UPLOAD_FOLDER']).mkdir(parents=True, exist_ok=True)
 
 COOKIE_PATH = STORAGE_DIR / "cookie.json"
 VIDEO_SAVE_PATH = STORAGE_DIR / "Generated_Videos"
+# Video không đổi sau khi tải xong: cho trình duyệt cache (vẫn kiểm tra lại bằng ETag)
+VIDEO_MAX_AGE = int(os.environ.get("VIDEO_MAX_AGE", "3600"))
 USERS_DB_PATH = STORAGE_DIR / "users.json" 
 Path(VIDEO_SAVE_PATH).mkdir(exist_ok=True) 
 
-GLOBAL_COOKIES = None
+# Task đang chạy trong tiến trình leader (xem shared_state.py)
 ACTIVE_TASKS = {}  
-LAST_ACTIVITY = {} 
 
-# --- QUẢN LÝ USER DATABASE ---
-def load_users():
-    if not USERS_DB_PATH.exists():
-        admin_data = {
-            "admin": {
-                "username": "admin",
-                "password_hash": generate_password_hash("admin_pass123"),
-                "name": "Nguyễn Đức Thắng (Admin)",
-                "team": "Development",
-                "is_admin": True,
-                "history": {}, 
-                "created_at": str(datetime.now())
-            }
-        }
-        with open(USERS_DB_PATH, 'w', encoding='utf-8') as f:
-            json.dump(admin_data, f, indent=4)
-        return admin_data
-    
-    with open(USERS_DB_PATH, 'r', encoding='utf-8') as f:
-        return json.load(f)
+# --- TRẠNG THÁI DÙNG CHUNG GIỮA CÁC TIẾN TRÌNH ---
+# Cookie Flow nằm trong pool tài khoản (SQLite, xem account_pool.py). Bộ cookie duy nhất
+# của phiên bản cũ (shared_kv hoặc cookie.json) trở thành tài khoản "default".
+def _legacy_cookies():
+    cookies = SHARED.get_value("cookies")
+    if cookies is None and COOKIE_PATH.exists():
+        try:
+            cookies = json.loads(COOKIE_PATH.read_text(encoding='utf-8'))
+        except Exception as e:
+            print(f"Không đọc được {COOKIE_PATH}: {e}")
+    return cookies
+
+ACCOUNTS.migrate_legacy(_legacy_cookies())
+
+def tasks_view():
+    """Leader đọc thẳng ACTIVE_TASKS; tiến trình khác đọc bản chụp leader đã công bố."""
+    return ACTIVE_TASKS if SHARED.is_leader else SHARED.view
+
+def user_task_items(username):
+    """[(task_id, task)] các task đang hiển thị của một user."""
+    if SHARED.is_leader:
+        return [(k, v) for k, v in list(ACTIVE_TASKS.items()) if v['user'] == username]
+    return SHARED.view.for_user(username)
+
+def task_summaries():
+    """Tóm tắt mọi task đang hiển thị (trang admin) mà không copy log/items."""
+    return TASK_SUMMARIES.all(ACTIVE_TASKS) if SHARED.is_leader else SHARED.view.summaries()
 
-def save_users(users_data):
-    with open(USERS_DB_PATH, 'w', encoding='utf-8') as f:
-        json.dump(users_data, f, indent=4, cls=CustomJSONEncoder)
+def tasks_cursor():
+    return current_cursor() if SHARED.is_leader else SHARED.cursor()
 
-USERS_DB = load_users()
+# --- QUẢN LÝ USER DATABASE ---
+# User và lịch sử nằm trong SQLite (storage/app.db); users.json cũ được nhập một lần khi khởi động.
+USER_STORE = UserStore(legacy_json_path=USERS_DB_PATH)
 
 
 # --- CHỨC NĂNG CHIA LỊCH THEO NGÀY ---
@@ -97,49 +123,37 @@ def is_team_allowed_today(user_team):
         
     return False, allowed_team
 
-def update_user_history(username, task_id, status):
-    """Cập nhật lịch sử chạy của user vào USERS_DB."""
-    global USERS_DB
-    user = USERS_DB.get(username)
-    if user:
-        if 'history' not in user:
-            user['history'] = {}
-            
-        today_str = date.today().strftime("%Y-%m-%d")
-        
-        if today_str not in user['history']:
-            user['history'][today_str] = []
-            
-        task_data = ACTIVE_TASKS.get(task_id, {})
-        
-        task_info = {
-            "task_id": task_id,
-            "time": datetime.now().strftime("%H:%M:%S"),
-            "status": status,
-            "type": task_data.get('type', 'N/A'),
-            "resolution": task_data.get('resolution', 'N/A'),
-            "total": task_data.get('total', 0), 
-            "items": task_data.get('items', []) 
-        }
+# --- SCHEDULER: giới hạn số task chạy đồng thời, chia slot công bằng giữa user/team ---
+SCHEDULER = JobScheduler(
+    start_worker, ACTIVE_TASKS,
+    max_slots=min(auto_slots(), BROWSER_POOL.size),
+    is_team_allowed=is_team_allowed_today,
+    accounts=ACCOUNTS
+)
 
-        updated = False
-        if today_str in user['history']:
-            for item in user['history'][today_str]:
-                if item['task_id'] == task_id:
-                    item['status'] = status
-                    item['time'] = datetime.now().strftime("%H:%M:%S")
-                    updated = True
-                    break
-        
-        if not updated or status == "Khởi tạo":
-             user['history'][today_str].append(task_info)
+# --- KHO LƯU TRỮ: task đã kết thúc được chuyển khỏi ACTIVE_TASKS sau thời gian chờ ---
+TASK_ARCHIVE = TaskArchive()
 
+def update_user_history(username, task_id, status):
+    """Cập nhật lịch sử chạy của user vào USER_STORE."""
+    today_str = date.today().strftime("%Y-%m-%d")
+    task_data = ACTIVE_TASKS.get(task_id, {})
+
+    task_info = {
+        "task_id": task_id,
+        "time": datetime.now().strftime("%H:%M:%S"),
+        "status": status,
+        "type": task_data.get('type', 'N/A'),
+        "resolution": task_data.get('resolution', 'N/A'),
+        "total": task_data.get('total', 0),
+        "items": list(task_data.get('items', []))
+    }
 
-        save_users(USERS_DB)
+    USER_STORE.record_history(username, today_str, task_info, new_entry=(status == "Khởi tạo"))
 
 
 def verify_user(username, password):
-    user = USERS_DB.get(username)
+    user = USER_STORE.get(username)
     if user and check_password_hash(user['password_hash'], password):
         return user
     return None
@@ -147,18 +161,16 @@ def verify_user(username, password):
 def get_active_users():
     """Trả về danh sách các user được coi là đang online."""
     online_users = {}
-    time_limit = datetime.now() - timedelta(seconds=30)
     
-    for username, last_seen in list(LAST_ACTIVITY.items()):
-        if last_seen > time_limit:
-            user_data = USERS_DB.get(username)
-            if user_data:
-                online_users[username] = {
-                    "username": username,
-                    "name": user_data.get('name', 'N/A'),
-                    "team": user_data.get('team', 'N/A'),
-                    "last_seen": last_seen.strftime("%H:%M:%S")
-                }
+    for username, last_seen in SHARED.active_users(30).items():
+        user_data = USER_STORE.get(username)
+        if user_data:
+            online_users[username] = {
+                "username": username,
+                "name": user_data.get('name', 'N/A'),
+                "team": user_data.get('team', 'N/A'),
+                "last_seen": last_seen.strftime("%H:%M:%S")
+            }
             
     return online_users
 
@@ -167,19 +179,13 @@ def get_active_users():
 @app.before_request
 def update_last_activity():
     if 'username' in session:
-        LAST_ACTIVITY[session['username']] = datetime.now()
-    
-    global GLOBAL_COOKIES
-    if GLOBAL_COOKIES is None and COOKIE_PATH.exists():
-        try:
-            GLOBAL_COOKIES = json.loads(COOKIE_PATH.read_text(encoding='utf-8'))
-        except:
-            pass
+        SHARED.touch_presence(session['username'])
 
 
 # --- KIỂM TRA TRẠNG THÁI COOKIE (Admin/User) ---
 def get_auth_token_from_cookies(cookies):
-    """Sử dụng Playwright để lấy Auth Token (Bearer) từ cookies."""
+    """Sử dụng Playwright để lấy Auth Token (Bearer) từ cookies.
+    Hàm này tốn một lần mở browser, nên luôn gọi qua TOKEN_CACHE.get()."""
     if not cookies:
         return None
     
@@ -209,19 +215,14 @@ def get_auth_token_from_cookies(cookies):
         return None
 
 
-@app.route('/api/admin/check_cookie')
-def check_cookie_status():
-    if not session.get('is_admin'):
-        return jsonify({"status": "error", "message": "Truy cập bị từ chối"}), 403
-
-    if not GLOBAL_COOKIES:
-        return jsonify({"status": "dead", "message": "Chưa có file cookie nào được tải."})
-
+def probe_account(account):
+    """Kiểm tra token của một tài khoản Flow và cập nhật sức khoẻ trong pool. Trả về (status, message)."""
+    cookies = account['cookies']
     try:
-        auth_token = get_auth_token_from_cookies(GLOBAL_COOKIES)
-        
+        auth_token = TOKEN_CACHE.get(cookies, get_auth_token_from_cookies)
         if not auth_token:
-             return jsonify({"status": "dead", "message": "Không lấy được Authorization Token từ cookies (Cookies có thể chết)."})
+            ACCOUNTS.mark_dead(account['name'], "Không lấy được Authorization Token từ cookies")
+            return "dead", "Không lấy được Authorization Token từ cookies (Cookies có thể chết)."
 
         headers = {"Authorization": auth_token}
         resp = requests.post(
@@ -230,55 +231,70 @@ def check_cookie_status():
             headers=headers,
             timeout=5
         )
-        
-        if resp.status_code == 200 or resp.status_code == 400 or resp.status_code == 404:
-             return jsonify({"status": "live", "message": "Cookies đang hoạt động (Token LIVE)."}), 200
-        
+
+        if resp.status_code in [200, 400, 404]:
+            ACCOUNTS.record_token(account['name'], auth_token)
+            ACCOUNTS.report_ok(account['name'])
+            return "live", "Cookies đang hoạt động (Token LIVE)."
+
         if resp.status_code == 401:
-             return jsonify({"status": "dead", "message": "Token bị từ chối (401 - Unauthorized)."}), 200
+            TOKEN_CACHE.invalidate(cookies)
+            ACCOUNTS.report_401(account['name'])
+            return "dead", "Token bị từ chối (401 - Unauthorized)."
 
-        return jsonify({"status": "unknown", "message": f"Lỗi không xác định: {resp.status_code}"}), 200
+        return "unknown", f"Lỗi không xác định: {resp.status_code}"
 
     except Exception as e:
-        return jsonify({"status": "dead", "message": f"Lỗi kết nối/timeout: {e}"}), 200
+        return "dead", f"Lỗi kết nối/timeout: {e}"
 
-@app.route('/api/user/check_token_status')
-def user_check_token_status():
-    """API kiểm tra token cho User."""
-    if not session.get('username'):
-        return jsonify({"status": "error", "message": "Yêu cầu bị từ chối"}), 403
 
-    if not GLOBAL_COOKIES:
+@app.route('/api/admin/check_cookie')
+def check_cookie_status():
+    """Kiểm tra lần lượt mọi tài khoản trong pool (kể cả tài khoản đang bị đánh dấu chết)."""
+    if not session.get('is_admin'):
+        return jsonify({"status": "error", "message": "Truy cập bị từ chối"}), 403
+
+    names = [a['name'] for a in ACCOUNTS.all()]
+    if not names:
         return jsonify({"status": "dead", "message": "Chưa có file cookie nào được tải."})
 
-    try:
-        auth_token = get_auth_token_from_cookies(GLOBAL_COOKIES)
-        if not auth_token:
-             return jsonify({"status": "dead", "message": "Không lấy được Authorization Token từ cookies."})
+    results = {}
+    for name in names:
+        account = ACCOUNTS.get(name)
+        if account:
+            status, message = probe_account(account)
+            results[name] = {"status": status, "message": message}
 
-        headers = {"Authorization": auth_token}
-        resp = requests.post(CHECK_STATUS_URL, json={"operations": [{"operation": {"name": "projects/dummy/operations/test"}}]}, headers=headers, timeout=5)
-        
-        if resp.status_code in [200, 400, 404]:
-             return jsonify({"status": "live", "message": "Token đang hoạt động."})
-        
-        if resp.status_code == 401:
-             return jsonify({"status": "dead", "message": "Token đã chết (401). Vui lòng liên hệ Admin."})
+    live = sum(1 for r in results.values() if r['status'] == "live")
+    return jsonify({
+        "status": "live" if live else "dead",
+        "message": f"{live}/{len(results)} tài khoản LIVE",
+        "accounts": results
+    })
+
+@app.route('/api/user/check_token_status')
+def user_check_token_status():
+    """API kiểm tra token cho User (tài khoản sẽ được dùng tiếp theo)."""
+    if not session.get('username'):
+        return jsonify({"status": "error", "message": "Yêu cầu bị từ chối"}), 403
 
-        return jsonify({"status": "unknown", "message": f"Lỗi không xác định: {resp.status_code}"})
+    account = ACCOUNTS.pick()
+    if not account:
+        return jsonify({"status": "dead", "message": "Không còn tài khoản Flow nào hoạt động. Vui lòng liên hệ Admin."})
 
-    except Exception:
-        return jsonify({"status": "dead", "message": "Lỗi kết nối hoặc timeout khi kiểm tra token."})
+    status, message = probe_account(account)
+    if status == "dead":
+        message = f"{message} Vui lòng liên hệ Admin."
+    return jsonify({"status": status, "message": message})
 
 
 # --- ROUTES CHÍNH ---
-
 @app.route('/')
 def index():
     if 'username' not in session:
         return redirect(url_for('login'))
     
-    current_user = USERS_DB.get(session.get('username'))
+    current_user = USER_STORE.get(session.get('username'))
     
     if current_user and current_user.get('is_admin'):
         return redirect(url_for('admin_dashboard')) 
@@ -305,7 +321,7 @@ def login():
 @app.route('/logout')
 def logout():
     if 'username' in session:
-        LAST_ACTIVITY.pop(session['username'], None)
+        SHARED.drop_presence(session['username'])
         
     session.pop('username', None)
     session.pop('is_admin', None)
@@ -314,33 +330,67 @@ def logout():
 # --- ADMIN ROUTES ---
 @app.route('/admin')
 def admin_dashboard():
-    current_user = USERS_DB.get(session.get('username'))
+    current_user = USER_STORE.get(session.get('username'))
     if not current_user or not current_user.get('is_admin'):
         return "Truy cập bị từ chối", 403
         
-    global GLOBAL_COOKIES
-    cookie_status = "Đã tải" if GLOBAL_COOKIES else "Chưa tải"
-    
-    tasks_for_render = {}
-    for task_id, task in ACTIVE_TASKS.items():
-        task_clean = deepcopy(task) 
-        task_clean.pop('stop_flag', None) 
-        if 'start_time' in task_clean and isinstance(task_clean['start_time'], datetime):
-             task_clean['start_time'] = str(task_clean['start_time'])
-        tasks_for_render[task_id] = task_clean
-    
-    users_data = []
-    for uname, data in USERS_DB.items():
-        user_copy = data.copy()
-        user_copy.pop('password_hash', None)
-        users_data.append(user_copy)
-        
+    accounts = ACCOUNTS.all()
+    healthy = sum(1 for a in accounts if a['status'] == "healthy")
+    cookie_status = f"Đã tải ({healthy}/{len(accounts)} tài khoản hoạt động)" if accounts else "Chưa tải"
+
+    # Bảng user / task được tải theo trang qua /api/admin/users và /api/admin/tasks
     return render_template('admin.html', 
                            cookie_status=cookie_status, 
-                           tasks=tasks_for_render, 
-                           users=users_data,
                            admin_name=current_user.get('name', 'Admin'))
 
+def _page_args(default_limit=50):
+    limit = min(500, max(1, request.args.get('limit', default_limit, type=int)))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return limit, offset
+
+@app.route('/api/admin/tasks')
+def admin_list_tasks():
+    """Tóm tắt task theo trang: ?user=&status=&q=&limit=&offset=. Kèm thống kê theo user."""
+    if not session.get('is_admin'):
+        return jsonify({}), 403
+
+    limit, offset = _page_args()
+    summaries = task_summaries()
+    page = query_summaries(
+        summaries,
+        user=request.args.get('user'),
+        status=request.args.get('status'),
+        q=request.args.get('q'),
+        limit=limit, offset=offset
+    )
+    page['stats'] = user_stats(summaries, USER_STORE.teams())
+    return jsonify(page)
+
+@app.route('/api/admin/tasks/<task_id>')
+def admin_task_detail(task_id):
+    """Chi tiết một task (items + phần log trong RAM), chỉ tải khi admin mở rộng dòng."""
+    if not session.get('is_admin'):
+        return jsonify({}), 403
+
+    task = tasks_view().get(task_id) or TASK_ARCHIVE.get(task_id)
+    if task is None:
+        return jsonify({"success": False, "message": "Không tìm thấy tác vụ."}), 404
+    task = {k: v for k, v in task.items() if k not in ('stop_flag', 'field_versions')}
+    return app.response_class(json.dumps(task, cls=CustomJSONEncoder, ensure_ascii=False), mimetype='application/json')
+
+@app.route('/api/admin/users', methods=['GET'])
+def admin_list_users():
+    """Danh sách user theo trang: ?q=&team=&limit=&offset=."""
+    if not session.get('is_admin'):
+        return jsonify({}), 403
+
+    limit, offset = _page_args()
+    return jsonify(USER_STORE.find(
+        q=request.args.get('q'),
+        team=request.args.get('team'),
+        limit=limit, offset=offset
+    ))
+
 
 @app.route('/api/admin/users', methods=['POST'])
 def create_or_update_user():
@@ -353,33 +403,29 @@ def create_or_update_user():
     if not username or not data.get('name') or not data.get('team'):
         return jsonify({"success": False, "message": "Thiếu các trường bắt buộc (username, name, team)."}), 400
 
-    if USERS_DB.get(username) and request.method == 'POST' and not data.get('is_edit'):
+    if USER_STORE.exists(username) and request.method == 'POST' and not data.get('is_edit'):
         return jsonify({"success": False, "message": "Tài khoản đã tồn tại. Dùng chức năng Sửa."}), 409
         
-    is_new_user = username not in USERS_DB
+    is_new_user = not USER_STORE.exists(username)
     
     if is_new_user and not data.get('password'):
         return jsonify({"success": False, "message": "Phải có mật khẩu cho tài khoản mới."}), 400
 
     if is_new_user:
-        USERS_DB[username] = {
+        USER_STORE.create({
             "username": username,
+            "password_hash": generate_password_hash(data['password']),
             "name": data['name'],
             "team": data['team'],
             "is_admin": False,
-            "history": {},
             "created_at": str(datetime.now())
-        }
-    
-    USERS_DB[username].update({
-        "name": data['name'],
-        "team": data['team']
-    })
-
-    if data.get('password'):
-        USERS_DB[username]['password_hash'] = generate_password_hash(data['password'])
+        })
+    else:
+        fields = {"name": data['name'], "team": data['team']}
+        if data.get('password'):
+            fields['password_hash'] = generate_password_hash(data['password'])
+        USER_STORE.update(username, **fields)
 
-    save_users(USERS_DB)
     return jsonify({"success": True, "message": f"Tài khoản {username} đã được {'tạo mới' if is_new_user else 'cập nhật'}."})
 
 @app.route('/api/admin/users/<username>', methods=['DELETE'])
@@ -390,9 +436,8 @@ def delete_user(username):
     if username == session['username']:
         return jsonify({"success": False, "message": "Không thể tự xóa tài khoản Admin."}), 403
         
-    if username in USERS_DB:
-        del USERS_DB[username]
-        save_users(USERS_DB)
+    if USER_STORE.exists(username):
+        USER_STORE.delete(username)
         return jsonify({"success": True, "message": f"Tài khoản {username} đã bị xóa."})
         
     return jsonify({"success": False, "message": "Không tìm thấy tài khoản."}), 404
@@ -413,6 +458,8 @@ def upload_cookie_text():
     try:
         # Lấy dữ liệu dạng JSON từ body request
         data = request.json.get('cookie_data')
+        # Tên rỗng / chỉ có khoảng trắng -> tài khoản "default"
+        name = str(request.json.get('account_name') or "").strip() or "default"
         
         if not data:
             return jsonify({"success": False, "message": "Không tìm thấy dữ liệu cookie."})
@@ -426,16 +473,58 @@ def upload_cookie_text():
         else:
             return jsonify({"success": False, "message": "Nội dung JSON không phải là danh sách cookie hợp lệ."})
             
-        global GLOBAL_COOKIES
-        GLOBAL_COOKIES = cookies_list
-        # Lưu vào file để sử dụng trong tương lai
-        COOKIE_PATH.write_text(json.dumps(cookies_list), encoding='utf-8')
+        # Token cũ thuộc về cookie cũ của tài khoản này
+        old = ACCOUNTS.get(name)
+        if old:
+            TOKEN_CACHE.invalidate(old['cookies'])
+        # Lưu vào pool tài khoản (SQLite) để mọi tiến trình cùng thấy
+        ACCOUNTS.upsert(name, cookies_list)
+        # Khởi động sẵn browser với cookie mới (trên tiến trình leader)
+        run_command("warm", account=name)
         
-        return jsonify({"success": True, "message": f"Cập nhật cookie thành công. {len(cookies_list)} mục đã được lưu."})
+        return jsonify({"success": True, "message": f"Cập nhật cookie cho tài khoản '{name}' thành công. {len(cookies_list)} mục đã được lưu."})
         
     except Exception as e:
         return jsonify({"success": False, "message": f"Lỗi xử lý JSON: {e}"})
 
+# --- POOL TÀI KHOẢN FLOW (ADMIN) ---
+@app.route('/api/admin/accounts')
+def list_accounts():
+    """Trạng thái từng tài khoản: sức khoẻ, số lần 401 gần đây, số task/job đang chạy."""
+    if not session.get('is_admin'):
+        return jsonify({}), 403
+    return jsonify(ACCOUNTS.all())
+
+@app.route('/api/admin/accounts/<name>', methods=['DELETE'])
+def delete_account(name):
+    if not session.get('is_admin'):
+        return jsonify({"success": False, "message": "Truy cập bị từ chối"}), 403
+    account = ACCOUNTS.get(name)
+    if account is None:
+        return jsonify({"success": False, "message": "Không tìm thấy tài khoản."}), 404
+    TOKEN_CACHE.invalidate(account['cookies'])
+    ACCOUNTS.delete(name)
+    return jsonify({"success": True, "message": f"Đã xoá tài khoản '{name}'. Task đang chạy trên tài khoản này vẫn chạy tiếp."})
+
+@app.route('/api/admin/accounts/<name>/enable', methods=['POST'])
+def enable_account(name):
+    """Cho tài khoản bị đánh dấu chết quay lại pool (vd. sau khi admin tự kiểm tra)."""
+    if not session.get('is_admin'):
+        return jsonify({"success": False, "message": "Truy cập bị từ chối"}), 403
+    if ACCOUNTS.get(name) is None:
+        return jsonify({"success": False, "message": "Không tìm thấy tài khoản."}), 404
+    ACCOUNTS.report_ok(name)
+    run_command("warm", account=name)
+    return jsonify({"success": True, "message": f"Tài khoản '{name}' đã được kích hoạt lại."})
+
+
+@app.route('/api/admin/storage')
+def storage_usage():
+    """Dung lượng video + ảnh upload theo user, cùng quota hiện tại."""
+    if not session.get('is_admin'):
+        return jsonify({}), 403
+    return jsonify(STORAGE.usage())
+
 
 @app.route('/api/upload_i2v', methods=['POST'])
 def upload_i2v_files():
@@ -444,26 +533,52 @@ def upload_i2v_files():
 
     uploaded_files = request.files.getlist('i2v_files')
     file_paths = []
+    original_names = []
     
     if not uploaded_files or uploaded_files[0].filename == '':
         return jsonify({"success": False, "message": "Không tìm thấy file nào."})
 
+    # Ảnh lưu theo hash nội dung (trùng ảnh thì dùng lại file cũ) và được xử lý sẵn ở thread nền
+    reused = 0
     for file in uploaded_files:
-        if file and file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            filename = secure_filename(f"{session['username']}_{uuid.uuid4().hex[:8]}_{file.filename}")
-            save_path = Path(app.config['UPLOAD_FOLDER']) / filename
-            file.save(save_path)
-            file_paths.append(str(save_path))
+        if file and file.filename.lower().endswith(IMAGE_EXTENSIONS):
+            name, existed, original_name = UPLOADS.save(file)
+            STORAGE.record(UPLOADS.resolve(name), KIND_UPLOAD, owner=session['username'])
+            reused += existed
+            file_paths.append(name)
+            original_names.append(original_name)
         
     if not file_paths:
         return jsonify({"success": False, "message": "Không có file ảnh hợp lệ nào được upload."})
 
-    return jsonify({"success": True, "file_paths": file_paths, "message": f"Đã upload thành công {len(file_paths)} file."})
+    message = f"Đã upload thành công {len(file_paths)} file."
+    if reused:
+        message += f" ({reused} ảnh đã có sẵn trên server)"
+    return jsonify({"success": True, "file_paths": file_paths, "original_names": original_names, "message": message})
+
+def _bounded_int_param(data, key, maximum):
+    """
+    Tham số số nguyên tuỳ chọn của client: (None, None) nếu không gửi, (giá trị đã kẹp về
+    tối đa `maximum`, None) nếu hợp lệ, (None, thông báo lỗi) nếu không phải số nguyên >= 1.
+    """
+    value = data.get(key)
+    if value is None or value == '':
+        return None, None
+    number = None
+    if isinstance(value, int) and not isinstance(value, bool):
+        number = value
+    elif isinstance(value, float) and value.is_integer():
+        number = int(value)
+    elif isinstance(value, str) and value.strip().isdigit():
+        number = int(value)
+    if number is None or number < 1:
+        return None, f"{key} phải là số nguyên >= 1."
+    return min(maximum, number), None
 
 @app.route('/api/submit_task', methods=['POST'])
 def submit_task():
     username = session.get('username')
-    user_data = USERS_DB.get(username)
+    user_data = USER_STORE.get(username)
     if not user_data:
         return jsonify({"success": False, "message": "Không tìm thấy dữ liệu người dùng."}), 404
         
@@ -473,31 +588,62 @@ def submit_task():
     if not is_allowed:
         return jsonify({"success": False, "message": f"Hôm nay ({date.today().day}) thuộc Team {allowed_team} chạy tool. Vui lòng thử lại vào ngày khác."}), 403
 
-    if not username or not GLOBAL_COOKIES:
+    if not username:
         return jsonify({"success": False, "message": "Yêu cầu bị từ chối. Vui lòng đăng nhập hoặc liên hệ Admin."}), 403
 
+    if not ACCOUNTS.healthy_count():
+        return jsonify({"success": False, "message": "Không còn tài khoản Flow nào hoạt động. Vui lòng liên hệ Admin."}), 503
+
     data = request.json
     task_type = data.get('type')
 
     if task_type not in ['P2V', 'I2V']:
         return jsonify({"success": False, "message": "Loại tác vụ không hợp lệ."}), 400
 
+    pipeline_depth, error = _bounded_int_param(data, 'pipeline_depth', P2V_PIPELINE_DEPTH_MAX)
+    if error:
+        return jsonify({"success": False, "message": error}), 400
+    pages_per_task, error = _bounded_int_param(data, 'pages_per_task', P2V_PAGES_PER_TASK_MAX)
+    if error:
+        return jsonify({"success": False, "message": error}), 400
+
     task_id = str(uuid.uuid4())
-    stop_event = threading.Event() 
 
     worker_params = {
         "type": task_type,
         "resolution": data.get('resolution', '720p'),
-        "cookies": GLOBAL_COOKIES,
         "username": username,
         "save_dir": str(VIDEO_SAVE_PATH),
-        "stop_flag": stop_event, 
         
         "prompts": data.get('prompts', []), 
         "tasks": data.get('tasks', []), 
+        "pipeline_depth": pipeline_depth,
+        "use_cache": data.get('use_cache'),
+        "pages_per_task": pages_per_task,
     }
+
+    run_command("submit", task_id, params=worker_params, username=username, team=user_data.get('team', 'N/A'))
     
-    ACTIVE_TASKS[task_id] = {
+    queue_position = ACTIVE_TASKS[task_id].get('queue_position') if task_id in ACTIVE_TASKS else None
+    message = f"Tác vụ {task_type} đã được khởi động."
+    if queue_position:
+        message = f"Tác vụ {task_type} đang xếp hàng (vị trí {queue_position}), sẽ tự chạy khi có slot trống."
+
+    return jsonify({
+        "success": True, 
+        "task_id": task_id, 
+        "queue_position": queue_position,
+        "message": message
+    })
+
+def start_task(task_id, worker_params, username, team):
+    """(Leader) Tạo task trong ACTIVE_TASKS, ghi nhật ký và đưa vào scheduler."""
+    task_type = worker_params['type']
+    stop_event = threading.Event()
+    # Cookie được scheduler gắn khi task bắt đầu chạy (tài khoản Flow ít việc nhất lúc đó)
+    worker_params = dict(worker_params, stop_flag=stop_event)
+
+    create_task(ACTIVE_TASKS, task_id, {
         "id": task_id,
         "user": username,
         "status": "Initializing",
@@ -505,57 +651,247 @@ def submit_task():
         "total": len(worker_params.get('prompts') or worker_params.get('tasks') or []),
         "completed": 0,
         "errors": 0,
-        "log": [],
+        "log": TaskLog(task_id),
         "items": [], 
         "stop_flag": stop_event, 
         "type": task_type,
-        "resolution": worker_params['resolution']
-    }
+        "resolution": worker_params['resolution'],
+        "created_at": datetime.now().isoformat(timespec="seconds")
+    })
+    JOURNAL.task_created(task_id, worker_params, username, team)
 
-    threading.Thread(target=start_worker, args=(task_id, ACTIVE_TASKS, worker_params), daemon=True).start()
+    SCHEDULER.submit(task_id, worker_params, username, team)
     
     # CẬP NHẬT LỊCH SỬ CHẠY
     update_user_history(username, task_id, "Khởi tạo")
-    
-    return jsonify({
-        "success": True, 
-        "task_id": task_id, 
-        "message": f"Tác vụ {task_type} đã được khởi động."
-    })
 
 @app.route('/api/get_tasks')
 def get_tasks():
     if not session.get('username'):
         return jsonify([]), 403
 
-    user_tasks = {k: v for k, v in ACTIVE_TASKS.items() if v['user'] == session['username']}
-    
-    tasks_to_return = json.loads(json.dumps(user_tasks, default=str)) 
+    # Mỗi task là bản chụp bất biến (copy-on-write) nên serialise thẳng, không cần copy
+    user_tasks = dict(user_task_items(session['username']))
 
-    return jsonify(tasks_to_return)
+    return app.response_class(json.dumps(user_tasks, cls=CustomJSONEncoder), mimetype='application/json')
+
+@app.route('/api/get_tasks/delta')
+def get_tasks_delta():
+    """
+    Chỉ trả phần thay đổi kể từ cursor client đã thấy.
+    Query: since=<cursor>, log_offsets=<JSON {task_id: số dòng log đã có}>.
+    Không có gì mới -> 304 (body rỗng).
+    """
+    if not session.get('username'):
+        return jsonify({}), 403
+
+    since = request.args.get('since', '')
+    try:
+        log_offsets = json.loads(request.args.get('log_offsets') or '{}')
+    except ValueError:
+        log_offsets = {}
+
+    # Lấy cursor TRƯỚC khi đọc task: thay đổi xảy ra trong lúc đọc sẽ được gửi lại ở lần sau
+    cursor = tasks_cursor()
+    # Client mới, hoặc cursor thuộc epoch cũ (server khởi động lại / đổi leader) -> gửi lại toàn bộ
+    since = resolve_since(since, cursor)
+    reset = since == 0
+    changed = {}
+    for task_id, task in user_task_items(session['username']):
+        delta = task_delta(task, since, int(log_offsets.get(task_id, 0) or 0))
+        if delta is not None:
+            changed[task_id] = delta
+
+    if not changed and not reset:
+        return '', 304
+
+    return jsonify({"cursor": cursor, "reset": reset, "tasks": changed})
+
+@app.route('/api/task_log/<task_id>')
+def get_task_log(task_id):
+    """Đọc log đầy đủ của task theo trang: ?offset=<dòng bắt đầu>&limit=<số dòng>."""
+    if not session.get('username'):
+        return jsonify({}), 403
+
+    task = tasks_view().get(task_id) or TASK_ARCHIVE.get(task_id)
+    if task is None:
+        return jsonify({"success": False, "message": "Không tìm thấy tác vụ."}), 404
+    if task['user'] != session['username'] and not session.get('is_admin'):
+        return jsonify({"success": False, "message": "Không có quyền xem log tác vụ này."}), 403
+
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(2000, max(1, request.args.get('limit', 500, type=int)))
+    if 'log' in task:
+        page = task['log'].read(offset, limit)
+    else:
+        # Task đã lưu trữ: toàn bộ log nằm trong file gzip
+        page = {"offset": offset, "lines": read_spilled(log_path(task_id), offset, limit), "total": task.get('log_lines', 0)}
+    page['next_offset'] = offset + len(page['lines']) if offset + len(page['lines']) < page['total'] else None
+    return jsonify(page)
+
+@app.route('/api/archive/tasks')
+def find_archived_tasks():
+    """Tra cứu task đã lưu trữ: ?user=&date=YYYY-MM-DD&status=&limit=&offset=. User thường chỉ thấy task của mình."""
+    if not session.get('username'):
+        return jsonify({}), 403
+
+    username = request.args.get('user') if session.get('is_admin') else session['username']
+    limit = min(500, max(1, request.args.get('limit', 50, type=int)))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return jsonify(TASK_ARCHIVE.find(
+        username=username,
+        day=request.args.get('date'),
+        status=request.args.get('status'),
+        limit=limit, offset=offset
+    ))
+
+@app.route('/api/archive/tasks/<task_id>')
+def get_archived_task(task_id):
+    if not session.get('username'):
+        return jsonify({}), 403
+
+    task = TASK_ARCHIVE.get(task_id)
+    if task is None:
+        return jsonify({"success": False, "message": "Không tìm thấy tác vụ trong kho lưu trữ."}), 404
+    if task['user'] != session['username'] and not session.get('is_admin'):
+        return jsonify({"success": False, "message": "Không có quyền xem tác vụ này."}), 403
+    return jsonify(task)
+
+def _sse_response(sub):
+    if sub is None:
+        # Hết chỗ cho kết nối SSE: client dùng polling API delta thay thế
+        return jsonify({"success": False, "message": "Quá nhiều kết nối trực tiếp, chuyển sang cập nhật định kỳ."}), 503
+    if sub.all_users:
+        items_fn = lambda: list(tasks_view().items())
+    else:
+        # Tiến trình phụ chỉ đọc bản chụp của đúng user này (index theo username)
+        items_fn = lambda: user_task_items(sub.username)
+    response = Response(
+        stream_with_context(TASK_EVENTS.stream(sub, items_fn, tasks_cursor)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Client ngắt trước khi stream bắt đầu thì generator không chạy tới finally: trả chỗ ở đây
+    response.call_on_close(lambda: TASK_EVENTS.unsubscribe(sub))
+    return response
+
+@app.route('/api/task_stream')
+def task_stream():
+    """SSE: đẩy delta các task của user ngay khi có thay đổi."""
+    if not session.get('username'):
+        return jsonify({}), 403
+    return _sse_response(TASK_EVENTS.subscribe(session['username']))
+
+@app.route('/api/admin/task_stream')
+def admin_task_stream():
+    """SSE cho admin: mọi task của mọi user (chỉ tóm tắt, không kèm log/items)."""
+    if not session.get('is_admin'):
+        return jsonify({}), 403
+    return _sse_response(TASK_EVENTS.subscribe(session.get('username'), summary=True, all_users=True))
 
 @app.route('/api/stop_task/<task_id>', methods=['POST'])
 def stop_task(task_id):
-    if not session.get('username') or task_id not in ACTIVE_TASKS:
+    task = tasks_view().get(task_id) if session.get('username') else None
+    if task is None:
         return jsonify({"success": False, "message": "Không tìm thấy tác vụ."}), 404
 
-    task = ACTIVE_TASKS[task_id]
     if task['user'] != session['username'] and not session.get('is_admin'):
          return jsonify({"success": False, "message": "Không có quyền dừng tác vụ này."}), 403
-         
+
+    if task['status'] not in ('Queued', 'Running', 'Initializing'):
+        return jsonify({"success": False, "message": "Tác vụ không ở trạng thái Running hoặc không thể dừng."})
+
+    if not SHARED.is_leader:
+        SHARED.send_command("stop", task_id)
+        return jsonify({"success": True, "message": f"Yêu cầu dừng tác vụ {task_id} đã được gửi."})
+
+    success, message = stop_task_local(task_id)
+    return jsonify({"success": success, "message": message})
+
+def stop_task_local(task_id):
+    """(Leader) Rút task khỏi hàng đợi hoặc báo worker dừng."""
+    task = ACTIVE_TASKS.get(task_id)
+    if task is None:
+        return False, "Không tìm thấy tác vụ."
+
+    if task['status'] == 'Queued' and SCHEDULER.cancel(task_id):
+        task['stop_flag'].set()
+        update_user_history(task['user'], task_id, "Đã dừng")
+        return True, f"Tác vụ {task_id} đã được rút khỏi hàng đợi."
+
     if task['status'] == 'Running' or task['status'] == 'Initializing':
         if 'stop_flag' in task and isinstance(task['stop_flag'], threading.Event):
              task['stop_flag'].set()
              update_user_history(task['user'], task_id, "Đã dừng")
-             return jsonify({"success": True, "message": f"Yêu cầu dừng tác vụ {task_id} đã được gửi."})
-
-    return jsonify({"success": False, "message": "Tác vụ không ở trạng thái Running hoặc không thể dừng."})
+             return True, f"Yêu cầu dừng tác vụ {task_id} đã được gửi."
+
+    return False, "Tác vụ không ở trạng thái Running hoặc không thể dừng."
+
+# --- LỆNH TỚI LEADER ---
+def handle_command(kind, task_id, payload):
+    """(Leader) Thực hiện lệnh do chính nó hoặc tiến trình khác gửi tới."""
+    if kind == "submit":
+        start_task(task_id, payload['params'], payload['username'], payload['team'])
+    elif kind == "stop":
+        stop_task_local(task_id)
+    elif kind == "warm":
+        account = ACCOUNTS.get(payload.get('account')) if payload.get('account') else ACCOUNTS.pick()
+        if account:
+            BROWSER_POOL.warm(account['cookies'])
+        # Tài khoản vừa sống lại -> hàng đợi đang tạm dừng (circuit breaker) chạy tiếp ngay
+        SCHEDULER.kick()
+
+def run_command(kind, task_id=None, **payload):
+    """Leader chạy ngay; tiến trình khác chuyển lệnh qua SQLite cho leader."""
+    if SHARED.is_leader:
+        handle_command(kind, task_id, payload)
+    else:
+        SHARED.send_command(kind, task_id, **payload)
 
 @app.route('/downloads/<path:filename>')
 def download_file(filename):
+    """
+    Một video. Hỗ trợ If-None-Match / If-Modified-Since (304), ETag và Range (206)
+    để trình duyệt tải tiếp file 1080p lớn khi bị ngắt thay vì tải lại từ đầu.
+    """
     if not session.get('username'):
         return "Truy cập bị từ chối", 403
-    return send_from_directory(str(VIDEO_SAVE_PATH), filename, as_attachment=True)
+    STORAGE.touch(VIDEO_SAVE_PATH / filename)
+    return send_from_directory(str(VIDEO_SAVE_PATH), filename, as_attachment=True,
+                               conditional=True, etag=True, max_age=VIDEO_MAX_AGE)
+
+@app.route('/api/task_zip/<task_id>')
+def download_task_zip(task_id):
+    """Toàn bộ video đã hoàn thành của một task trong một file ZIP, nén dạng stream (không tạo file tạm)."""
+    if not session.get('username'):
+        return "Truy cập bị từ chối", 403
+
+    task = tasks_view().get(task_id) or TASK_ARCHIVE.get(task_id)
+    if task is None:
+        return jsonify({"success": False, "message": "Không tìm thấy tác vụ."}), 404
+    if task['user'] != session['username'] and not session.get('is_admin'):
+        return jsonify({"success": False, "message": "Không có quyền tải tác vụ này."}), 403
+
+    paths = []
+    for item in task.get('items') or []:
+        if item.get('status') == "Finished" and item.get('file'):
+            path = VIDEO_SAVE_PATH / Path(item['file']).name
+            if path.is_file():
+                paths.append(path)
+    if not paths:
+        return jsonify({"success": False, "message": "Tác vụ chưa có video nào hoàn thành."}), 404
+
+    for path in paths:
+        STORAGE.touch(path)
+    files = list(zip(unique_names([p.name for p in paths]), paths))
+    return Response(
+        stream_with_context(stream_zip(files)),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="task_{task_id[:8]}.zip"',
+            'X-Accel-Buffering': 'no'
+        }
+    )
 
 
 @app.route('/user') 
@@ -563,15 +899,11 @@ def user_dashboard():
     if 'username' not in session:
         return redirect(url_for('login'))
     
-    current_user_data = USERS_DB.get(session.get('username'))
+    current_user_data = USER_STORE.get(session.get('username'))
     if not current_user_data:
         return redirect(url_for('logout'))
 
-    global GLOBAL_COOKIES
-    if not GLOBAL_COOKIES:
-        pass
-
-    user_tasks = {k: v for k, v in ACTIVE_TASKS.items() if v['user'] == session['username']}
+    user_tasks = dict(user_task_items(session['username']))
     
     is_allowed, allowed_team = is_team_allowed_today(current_user_data.get('team', 'N/A'))
 
@@ -587,9 +919,90 @@ def user_dashboard():
                                'allowed_team': allowed_team,
                                'today_date': date.today().strftime("%d/%m/%Y")
                            },
-                           user_history=current_user_data.get('history', {}) 
+                           user_history=USER_STORE.history(current_user_data['username']) 
                           )
 
+# --- KHÔI PHỤC TASK CHƯA XONG SAU KHI KHỞI ĐỘNG LẠI ---
+def recover_tasks():
+    """Dựng lại các task còn dang dở từ nhật ký và đưa lại vào hàng đợi."""
+    recovered = JOURNAL.unfinished()
+    if not recovered:
+        return
+
+    for entry in recovered:
+        task_id, params = entry['task_id'], entry['params']
+        params.update({
+            "stop_flag": threading.Event(),
+            "resume": {"items": entry['items'], "inflight": entry['inflight']},
+        })
+        pending = sum(1 for item in entry['items'] if item['status'] == "Pending")
+        log = TaskLog(task_id)
+        log.append(
+            f"[{datetime.now().strftime('%H:%M:%S')}] ♻️ Khôi phục sau khi khởi động lại: "
+            f"{len(entry['inflight'])} video đang render, {pending} item chưa chạy."
+        )
+        create_task(ACTIVE_TASKS, task_id, {
+            "id": task_id,
+            "user": entry['username'],
+            "status": "Initializing",
+            "progress": 0,
+            "total": len(entry['items']),
+            "completed": 0,
+            "errors": 0,
+            "log": log,
+            "items": [],
+            "stop_flag": params['stop_flag'],
+            "type": params.get('type'),
+            "resolution": params.get('resolution'),
+            "created_at": datetime.fromtimestamp(entry['created_at'] or time.time()).isoformat(timespec="seconds")
+        })
+        SCHEDULER.submit(task_id, params, entry['username'], entry['team'] or 'N/A')
+
+    print(f"♻️ Đã khôi phục {len(recovered)} task chưa hoàn thành từ nhật ký.")
+
+# --- LEADER: tiến trình duy nhất chạy scheduler / worker / browser ---
+def referenced_files():
+    """File (video, ảnh I2V) mà task đang chạy / đang chờ còn dùng: sweeper dọn lưu trữ không được xoá."""
+    files = set()
+    tasks = [task.get('items') or () for task in tasks_view().values()]
+    # Task đang xếp hàng chưa có items: lấy danh sách ảnh từ nhật ký task
+    for entry in JOURNAL.unfinished():
+        tasks.append(entry['items'])
+        for image_task in entry['params'].get('tasks') or []:
+            files.add(UPLOADS.resolve(image_task[0]))
+    for items in tasks:
+        for item in items:
+            if item.get('file'):
+                files.add(VIDEO_SAVE_PATH / Path(item['file']).name)
+            if item.get('image'):
+                files.add(UPLOADS.resolve(item['image']))
+    return files
+
+def become_leader():
+    # Bản chụp do leader cũ để lại: task đã kết thúc thì lưu trữ, task dở dang được khôi phục từ nhật ký
+    for task in SHARED.take_stale_tasks():
+        if is_terminal(task.get('status')):
+            TASK_ARCHIVE.archive(task['id'], task)
+
+    # Bộ đếm task/job đang chạy của leader cũ không còn đúng
+    ACCOUNTS.reset_inflight()
+    SHARED.start_publisher(ACTIVE_TASKS)
+    SHARED.start_command_loop(handle_command)
+    TASK_ARCHIVE.start_sweeper(ACTIVE_TASKS)
+    STORAGE.start_sweeper(referenced_files, VIDEO_SAVE_PATH, app.config['UPLOAD_FOLDER'])
+    recover_tasks()
+
+    handle_command("warm", None, {})
+    print(f"👑 Tiến trình {os.getpid()} là leader (chạy scheduler và worker).")
+
+# Với dev server (debug reloader) chỉ chạy trong tiến trình con thực sự phục vụ request
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    if SHARED.try_become_leader():
+        become_leader()
+    else:
+        SHARED.watch_cursor(TASK_EVENTS.notify_all)
+        SHARED.watch_leadership(become_leader)
+
 if __name__ == '__main__':
     
     app.run(host='0.0.0.0', port=8080, debug=True)
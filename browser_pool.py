@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import queue
+import atexit
+import hashlib
+import threading
+from playwright.sync_api import sync_playwright
+
+# --- CẤU HÌNH POOL (qua biến môi trường) ---
+BROWSER_POOL_SIZE = int(os.environ.get("BROWSER_POOL_SIZE", "2"))
+BROWSER_POOL_WARM = int(os.environ.get("BROWSER_POOL_WARM", "1"))
+BROWSER_MAX_JOBS = int(os.environ.get("BROWSER_MAX_JOBS", "20"))
+BROWSER_MAX_HEAP_MB = int(os.environ.get("BROWSER_MAX_HEAP_MB", "1024"))
+BROWSER_HEADLESS = os.environ.get("BROWSER_HEADLESS", "1") != "0"
+
+
+class CookieError(Exception):
+    """Không thể nạp cookie vào context của browser."""
+
+
+def cookies_key(cookies):
+    """Hash ổn định của một bộ cookie, dùng để biết context có cần nạp lại cookie không."""
+    raw = json.dumps(cookies or [], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# --- MỘT SLOT = MỘT BROWSER SỐNG LÂU TRÊN THREAD RIÊNG ---
+class BrowserSlot(threading.Thread):
+    """
+    Playwright sync API gắn chặt với thread tạo ra nó, nên mỗi browser được
+    giữ trên một thread riêng. Worker "mượn" slot và gửi hàm cần chạy sang
+    thread này qua hàng đợi.
+    """
+    def __init__(self, pool, slot_id):
+        super().__init__(daemon=True, name=f"browser-slot-{slot_id}")
+        self.pool = pool
+        self.slot_id = slot_id
+        self.jobs_done = 0
+        self.cookie_key = None
+        self._calls = queue.Queue()
+        self._pw = None
+        self.browser = None
+        self.context = None
+        self.page = None
+
+    def run(self):
+        with sync_playwright() as p:
+            self._pw = p
+            while True:
+                call = self._calls.get()
+                if call is None:
+                    break
+                fn, args, box, done = call
+                try:
+                    box["result"] = fn(*args)
+                except BaseException as e:
+                    box["error"] = e
+                finally:
+                    if done is not None:
+                        done.set()
+            self._close_browser()
+
+    def call(self, fn, *args):
+        """Chạy fn(*args) trên thread của slot và chờ kết quả."""
+        box, done = {}, threading.Event()
+        self._calls.put((fn, args, box, done))
+        done.wait()
+        if "error" in box:
+            raise box["error"]
+        return box.get("result")
+
+    def submit(self, fn, *args):
+        """Giống call() nhưng không chờ (dùng cho việc dọn dẹp sau job)."""
+        self._calls.put((fn, args, {}, None))
+
+    def stop(self):
+        self._calls.put(None)
+
+    # Các hàm dưới đây CHỈ được chạy trên thread của slot (qua call/submit)
+    def _close_browser(self):
+        try:
+            if self.browser:
+                self.browser.close()
+        except Exception:
+            pass
+        self.browser = self.context = self.page = None
+        self.cookie_key = None
+
+    def _launch(self):
+        self._close_browser()
+        self.browser = self._pw.chromium.launch(headless=BROWSER_HEADLESS)
+        self.jobs_done = 0
+
+    def _healthy(self):
+        try:
+            if not self.browser or not self.browser.is_connected():
+                return False
+            if not self.page or self.page.is_closed():
+                return False
+            self.page.evaluate("1")
+            return True
+        except Exception:
+            return False
+
+    def _heap_mb(self):
+        try:
+            used = self.page.evaluate("performance.memory ? performance.memory.usedJSHeapSize : 0")
+            return (used or 0) / (1024 * 1024)
+        except Exception:
+            return 0
+
+    def _prepare(self, cookies):
+        """Đảm bảo browser sống, context có đúng cookie và trang Flow đã tải sẵn."""
+        if not self.browser or not self.browser.is_connected():
+            self._launch()
+
+        key = cookies_key(cookies)
+        if self.context is None or self.cookie_key != key:
+            if self.context is not None:
+                try:
+                    self.context.close()
+                except Exception:
+                    pass
+            self.context = self.browser.new_context()
+            try:
+                self.context.add_cookies(cookies)
+            except Exception as e:
+                self.context.close()
+                self.context = None
+                raise CookieError(str(e))
+            self.cookie_key = key
+            self.page = None
+
+        if self.page is None or self.page.is_closed():
+            self.page = self.context.new_page()
+
+        if not self.page.url.startswith(self.pool.warm_url):
+            self.page.goto(self.pool.warm_url, timeout=120000)
+
+        if not self._healthy():
+            raise RuntimeError("Browser không phản hồi sau khi khởi tạo.")
+        return self.page
+
+    def _recycle_if_needed(self):
+        """Chạy sau mỗi job: tái tạo browser nếu đã chạy quá nhiều job hoặc phình bộ nhớ."""
+        too_many_jobs = self.jobs_done >= BROWSER_MAX_JOBS
+        too_big = self._heap_mb() > BROWSER_MAX_HEAP_MB
+        if too_many_jobs or too_big or not self._healthy():
+            print(f"[browser-pool] Tái tạo slot {self.slot_id} (jobs={self.jobs_done}, heap_vượt={too_big})")
+            self._close_browser()
+            return
+        # Trả trang về trạng thái sạch cho job sau
+        try:
+            self.page.goto(self.pool.warm_url, timeout=120000)
+        except Exception:
+            self._close_browser()
+
+
+class BrowserLease:
+    """Một lần mượn slot. Dùng với `with` để luôn trả slot về pool."""
+    def __init__(self, pool, slot, page):
+        self.pool = pool
+        self.slot = slot
+        self.page = page
+        self.broken = False
+
+    def run(self, fn, *args):
+        """Chạy fn(page, *args) trên thread sở hữu browser."""
+        try:
+            return self.slot.call(fn, self.page, *args)
+        except Exception:
+            self.broken = True
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.pool.release(self.slot, broken=self.broken or exc_type is not None)
+        return False
+
+
+# --- POOL TOÀN TIẾN TRÌNH ---
+class BrowserPool:
+    def __init__(self, warm_url, size=BROWSER_POOL_SIZE):
+        self.warm_url = warm_url
+        self.size = max(1, size)
+        self._slots = []
+        self._idle = []
+        self._cond = threading.Condition()
+        self._next_id = 0
+
+    def _new_slot(self):
+        self._next_id += 1
+        slot = BrowserSlot(self, self._next_id)
+        slot.start()
+        self._slots.append(slot)
+        return slot
+
+    def _acquire_slot(self, cancel=None, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._slots) < self.size:
+                    return self._new_slot()
+                if cancel and cancel():
+                    return None
+                if deadline is not None and time.time() >= deadline:
+                    return None
+                self._cond.wait(timeout=1)
+
+    def lease(self, cookies, cancel=None, timeout=None):
+        """
+        Mượn một browser đã khởi động sẵn với bộ cookie đã cho.
+        Trả về None nếu bị huỷ (cancel() == True) hoặc hết thời gian chờ.
+        """
+        slot = self._acquire_slot(cancel, timeout)
+        if slot is None:
+            return None
+        try:
+            page = slot.call(slot._prepare, cookies)
+        except CookieError:
+            self.release(slot)
+            raise
+        except Exception:
+            # Health check thất bại: khởi động lại browser một lần
+            try:
+                slot.call(slot._launch)
+                page = slot.call(slot._prepare, cookies)
+            except Exception:
+                self.release(slot, broken=True)
+                raise
+        return BrowserLease(self, slot, page)
+
+    def release(self, slot, broken=False):
+        slot.jobs_done += 1
+        if broken:
+            slot.submit(slot._close_browser)
+        else:
+            slot.submit(slot._recycle_if_needed)
+        with self._cond:
+            self._idle.append(slot)
+            self._cond.notify()
+
+    def warm(self, cookies, count=BROWSER_POOL_WARM):
+        """Khởi động trước `count` browser ở nền để job đầu tiên không phải chờ."""
+        if not cookies:
+            return
+        with self._cond:
+            while len(self._slots) < min(count, self.size):
+                self._idle.append(self._new_slot())
+            to_warm = list(self._idle[:count])
+            self._cond.notify_all()
+        for slot in to_warm:
+            slot.submit(slot._prepare, cookies)
+
+    def stats(self):
+        with self._cond:
+            return {"size": self.size, "slots": len(self._slots), "idle": len(self._idle)}
+
+    def shutdown(self):
+        with self._cond:
+            for slot in self._slots:
+                slot.stop()
+            self._slots.clear()
+            self._idle.clear()
+
+
+_pools = []
+
+
+def create_pool(warm_url, size=BROWSER_POOL_SIZE):
+    pool = BrowserPool(warm_url, size)
+    _pools.append(pool)
+    return pool
+
+
+@atexit.register
+def _shutdown_pools():
+    for pool in _pools:
+        pool.shutdown()
@@ -0,0 +1,141 @@
+import os
+import time
+import base64
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- CẤU HÌNH TẢI VIDEO ---
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+DOWNLOAD_MAX_ATTEMPTS = int(os.environ.get("DOWNLOAD_MAX_ATTEMPTS", "5"))
+
+_RETRYABLE = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class IncompleteDownload(Exception):
+    """File tải về không đủ dung lượng hoặc sai checksum."""
+
+
+def _expected_total(resp, offset):
+    """Tổng dung lượng file theo Content-Range (206) hoặc Content-Length (200)."""
+    content_range = resp.headers.get("Content-Range", "")
+    if "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get("Content-Length")
+    return offset + int(length) if length and length.isdigit() else None
+
+
+def _range_total(resp):
+    """Tổng dung lượng trong "Content-Range: bytes */N" của response 416 (None nếu không có)."""
+    total = resp.headers.get("Content-Range", "").rpartition("/")[2].strip()
+    return int(total) if total.isdigit() else None
+
+
+def _expected_md5(resp):
+    """MD5 (base64) từ header x-goog-hash nếu server trả về."""
+    for part in resp.headers.get("x-goog-hash", "").split(","):
+        key, _, value = part.strip().partition("=")
+        if key == "md5" and value:
+            return value
+    return None
+
+
+def _file_md5_b64(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+
+class DownloadManager:
+    """
+    Tải video ở nền bằng thread pool giới hạn, dùng chung connection pool.
+    Ghi ra file `.part`, tiếp tục bằng HTTP Range khi bị ngắt, kiểm tra
+    dung lượng/MD5 rồi mới đổi tên (atomic) sang tên file cuối cùng.
+    """
+    def __init__(self, workers=DOWNLOAD_WORKERS):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers * 2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def submit(self, url, dest_path):
+        """Đưa một URL vào hàng đợi tải. Trả về Future có kết quả là Path của file đã lưu."""
+        dest_path = Path(dest_path)
+        with self._lock:
+            self._active.add(str(dest_path))
+        future = self._executor.submit(self.download, url, dest_path)
+        future.add_done_callback(lambda _: self._forget(dest_path))
+        return future
+
+    def _forget(self, dest_path):
+        with self._lock:
+            self._active.discard(str(dest_path))
+
+    def active_paths(self):
+        with self._lock:
+            return set(self._active)
+
+    def download(self, url, dest_path, max_attempts=DOWNLOAD_MAX_ATTEMPTS):
+        dest_path = Path(dest_path)
+        part_path = dest_path.with_name(dest_path.name + ".part")
+        last_error = None
+
+        for attempt in range(1, max_attempts + 1):
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            try:
+                with self.session.get(url, stream=True, timeout=(15, 300), headers=headers) as r:
+                    if offset and r.status_code == 416:
+                        # Chỉ coi .part là đã đủ khi server xác nhận đúng tổng dung lượng;
+                        # .part cũ / dài hơn file thật thì xoá và tải lại từ đầu
+                        total, md5 = _range_total(r), _expected_md5(r)
+                        if total != offset:
+                            part_path.unlink(missing_ok=True)
+                            raise IncompleteDownload(f"File .part ({offset} bytes) không khớp dung lượng trên server ({total})")
+                    else:
+                        r.raise_for_status()
+                        if offset and r.status_code != 206:
+                            # Server bỏ qua Range -> tải lại từ đầu
+                            offset = 0
+                        total = _expected_total(r, offset)
+                        md5 = _expected_md5(r)
+                        mode = "ab" if offset else "wb"
+                        with open(part_path, mode, buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
+
+                size = part_path.stat().st_size
+                if total is not None and size != total:
+                    raise IncompleteDownload(f"Đã nhận {size}/{total} bytes")
+                if md5 and _file_md5_b64(part_path) != md5:
+                    part_path.unlink(missing_ok=True)
+                    raise IncompleteDownload("Sai checksum MD5")
+
+                os.replace(part_path, dest_path)
+                return dest_path
+
+            except (IncompleteDownload,) + _RETRYABLE as e:
+                last_error = e
+                time.sleep(min(30, 2 ** attempt))
+            except Exception:
+                part_path.unlink(missing_ok=True)
+                raise
+
+        raise Exception(f"Tải thất bại sau {max_attempts} lần thử: {last_error}")
+
+
+DOWNLOADS = DownloadManager()
@@ -0,0 +1,52 @@
+import threading
+
+# --- GỘP CÁC YÊU CẦU GIỐNG NHAU ĐANG CHẠY ---
+# Khoá yêu cầu giống cache kết quả (result_cache.request_key). Item đầu tiên của một khoá
+# là "leader" và gửi lên Flow như bình thường; item trùng khoá gửi sau (cùng task hoặc task
+# khác) chỉ đăng ký chờ và nhận chung file video khi leader tải xong.
+
+
+class InflightRegistry:
+    def __init__(self):
+        self._jobs = {}   # key -> {"leader": nhãn, "followers": [callback, ...]}
+        self._lock = threading.Lock()
+
+    def join(self, key, label, callback):
+        """
+        None: chưa ai chạy khoá này, người gọi thành leader (nhớ gọi settle khi xong).
+        Ngược lại: callback(filepath, error) được đăng ký và trả về nhãn của leader.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                self._jobs[key] = {"leader": label, "followers": []}
+                return None
+            job["followers"].append(callback)
+            return job["leader"]
+
+    def detach(self, key, callback):
+        """Follower không chờ nữa (vd. task của nó bị dừng)."""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and callback in job["followers"]:
+                job["followers"].remove(callback)
+
+    def settle(self, key, filepath=None, error=None):
+        """Leader xong (có file) hoặc lỗi: báo cho mọi follower rồi bỏ khoá."""
+        with self._lock:
+            job = self._jobs.pop(key, None)
+        if job is None:
+            return 0
+        for callback in job["followers"]:
+            try:
+                callback(filepath, error)
+            except Exception as e:
+                print(f"⚠️ Lỗi khi báo kết quả cho item chờ chung: {e}")
+        return len(job["followers"])
+
+    def stats(self):
+        with self._lock:
+            return {"inflight": len(self._jobs), "followers": sum(len(j["followers"]) for j in self._jobs.values())}
+
+
+INFLIGHT = InflightRegistry()
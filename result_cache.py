@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+
+from storage_db import get_connection, transaction
+
+# --- CACHE KẾT QUẢ (DÙNG LẠI VIDEO ĐÃ TẠO) ---
+# Tắt mặc định; bật cho mọi task bằng RESULT_CACHE_ENABLED=1 hoặc từng task bằng tham số use_cache
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "0") == "1"
+# Thư mục cache nằm cạnh storage/Generated_Videos: index.db + một hard link cho mỗi video
+RESULT_CACHE_DIR = Path(os.environ.get("RESULT_CACHE_DIR", "storage/result_cache"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "5000"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS result_cache (
+    key TEXT PRIMARY KEY,
+    type TEXT,
+    prompt TEXT,
+    image_hash TEXT,
+    resolution TEXT,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    hits INTEGER DEFAULT 0,
+    created_at REAL,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS idx_result_cache_lru ON result_cache(last_used);
+"""
+
+
+def normalize_prompt(prompt):
+    """Prompt chỉ khác hoa/thường hoặc khoảng trắng được coi là giống nhau."""
+    return re.sub(r"\s+", " ", prompt or "").strip().lower()
+
+
+def request_key(task_type, prompt, image_hash, resolution):
+    """Khoá của một yêu cầu tạo video: (loại, prompt chuẩn hoá, hash ảnh, độ phân giải)."""
+    raw = json.dumps([task_type, normalize_prompt(prompt), image_hash or "", resolution])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hard link (không tốn thêm dung lượng); khác ổ đĩa / không hỗ trợ thì copy."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache:
+    """
+    Video đã tạo được giữ theo khoá yêu cầu. Item trùng khoá ở task sau được hoàn
+    thành ngay bằng cách link file có sẵn vào thư mục video. Cache giữ hard link riêng
+    nên xoá file của task cũ không ảnh hưởng; vượt giới hạn dung lượng / số mục thì
+    bỏ các mục lâu nhất chưa được dùng (LRU).
+    """
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES,
+                 max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.root = Path(root)
+        self.db_path = self.root / "index.db"
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        return get_connection(self.db_path)
+
+    def lookup(self, key):
+        """Đường dẫn video trong cache cho khoá này (và đánh dấu vừa dùng), None nếu chưa có."""
+        conn = self._conn()
+        row = conn.execute("SELECT file FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path = self.root / row["file"]
+        if not path.exists():
+            conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE result_cache SET hits = hits + 1, last_used = ? WHERE key = ?", (time.time(), key))
+        return path
+
+    def store(self, key, video_path, task_type=None, prompt=None, image_hash=None, resolution=None):
+        """Ghi video vừa tải xong vào cache (bỏ qua nếu khoá đã có)."""
+        video_path = Path(video_path)
+        name = f"{key}{video_path.suffix}"
+        target = self.root / name
+        if not target.exists():
+            tmp = self.root / f"{name}.{os.getpid()}.part"
+            link_or_copy(video_path, tmp)
+            os.replace(tmp, target)
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR IGNORE INTO result_cache (key, type, prompt, image_hash, resolution, file, size, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, task_type, normalize_prompt(prompt), image_hash, resolution, name, target.stat().st_size, now, now)
+        )
+        self.evict()
+
+    def evict(self):
+        """Bỏ các mục ít dùng gần đây nhất cho tới khi dưới giới hạn dung lượng và số mục."""
+        conn = self._conn()
+        removed = []
+        with transaction(conn):
+            total, count = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM result_cache").fetchone()
+            if total <= self.max_bytes and count <= self.max_entries:
+                return 0
+            for row in conn.execute("SELECT key, file, size FROM result_cache ORDER BY last_used").fetchall():
+                if total <= self.max_bytes and count <= self.max_entries:
+                    break
+                conn.execute("DELETE FROM result_cache WHERE key = ?", (row["key"],))
+                removed.append(row["file"])
+                total -= row["size"]
+                count -= 1
+        for name in removed:
+            try:
+                os.remove(self.root / name)
+            except FileNotFoundError:
+                pass
+        if removed:
+            print(f"🧹 Cache kết quả: đã bỏ {len(removed)} video ít dùng nhất.")
+        return len(removed)
+
+    def release(self, needed):
+        """
+        Ổ đĩa sắp đầy: bỏ các mục LRU mà cache là nơi duy nhất còn giữ file (st_nlink == 1,
+        xoá mới thật sự trả lại dung lượng) cho tới khi đủ `needed` byte. Trả về số byte đã trả.
+        """
+        conn = self._conn()
+        freed, removed = 0, 0
+        for row in conn.execute("SELECT key, file FROM result_cache ORDER BY last_used").fetchall():
+            if freed >= needed:
+                break
+            path = self.root / row["file"]
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                conn.execute("DELETE FROM result_cache WHERE key = ?", (row["key"],))
+                continue
+            if st.st_nlink > 1:
+                continue   # video của task vẫn dùng chung file này
+            conn.execute("DELETE FROM result_cache WHERE key = ?", (row["key"],))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += st.st_size
+            removed += 1
+        if removed:
+            print(f"🧹 Cache kết quả: ổ đĩa sắp đầy, đã bỏ {removed} video ({freed / 1024 ** 2:.0f} MB).")
+        return freed
+
+    def inodes(self):
+        """{(st_dev, st_ino): khoá} của các file trong cache, để nhận ra video nào đang được cache giữ hard link."""
+        try:
+            dev = self.root.stat().st_dev
+            keys = {row["file"]: row["key"] for row in self._conn().execute("SELECT key, file FROM result_cache")}
+            return {(dev, entry.inode()): keys[entry.name] for entry in os.scandir(self.root) if entry.name in keys}
+        except OSError:
+            return {}
+
+    def discard(self, key):
+        """Bỏ một mục (và hard link của nó) khỏi cache."""
+        conn = self._conn()
+        row = conn.execute("SELECT file FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+        try:
+            os.remove(self.root / row["file"])
+        except FileNotFoundError:
+            pass
+        return True
+
+    def stats(self):
+        total, count, hits = self._conn().execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*), COALESCE(SUM(hits), 0) FROM result_cache"
+        ).fetchone()
+        return {"entries": count, "bytes": total, "hits": hits,
+                "max_bytes": self.max_bytes, "max_entries": self.max_entries}
+
+
+RESULT_CACHE = ResultCache()
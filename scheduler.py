@@ -0,0 +1,191 @@
+import os
+import time
+import threading
+
+from task_versions import update_task
+
+# --- CẤU HÌNH SCHEDULER ---
+# 0 = tự tính theo CPU và RAM còn trống
+SCHEDULER_MAX_SLOTS = int(os.environ.get("SCHEDULER_MAX_SLOTS", "0"))
+# RAM ước tính cho một task (Chromium + page Flow + worker)
+SCHEDULER_MB_PER_SLOT = int(os.environ.get("SCHEDULER_MB_PER_SLOT", "700"))
+# Hàng đợi tạm dừng khi mọi tài khoản Flow đều chết: bao lâu kiểm tra lại một lần (giây)
+SCHEDULER_PAUSE_RETRY = float(os.environ.get("SCHEDULER_PAUSE_RETRY", "30"))
+
+
+def _available_memory_mb():
+    """Đọc MemAvailable từ /proc/meminfo (Linux). Trả về None nếu không đọc được."""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except Exception:
+        pass
+    return None
+
+
+def auto_slots(mb_per_slot=SCHEDULER_MB_PER_SLOT):
+    """Số task chạy đồng thời tối đa dựa trên số CPU và RAM còn trống."""
+    if SCHEDULER_MAX_SLOTS > 0:
+        return SCHEDULER_MAX_SLOTS
+    slots = os.cpu_count() or 1
+    mem_mb = _available_memory_mb()
+    if mem_mb is not None:
+        slots = min(slots, mem_mb // mb_per_slot)
+    return max(1, slots)
+
+
+class JobScheduler:
+    """
+    Hàng đợi task toàn cục với số slot giới hạn.
+    Khi có slot trống, task được chọn theo fair share: user đang chạy ít task nhất,
+    rồi đến team đang chạy ít nhất, cuối cùng là task vào hàng sớm nhất.
+    """
+    def __init__(self, start_fn, tasks_db, max_slots=None, is_team_allowed=None, accounts=None):
+        self.start_fn = start_fn
+        self.tasks_db = tasks_db
+        self.max_slots = max_slots or auto_slots()
+        self.is_team_allowed = is_team_allowed
+        self.accounts = accounts    # AccountPool: mỗi task chạy trên tài khoản Flow ít việc nhất
+        self._queue = []      # [{"task_id", "user", "team", "params", "enqueued_at"}]
+        self._running = {}    # task_id -> {"user", "team"}
+        self._lock = threading.Lock()
+        self._paused = False
+        self._resume_timer = None
+
+    def _log(self, task_id, text):
+        task = self.tasks_db.get(task_id)
+        if task is not None:
+            task["log"].append(f"[{time.strftime('%H:%M:%S')}] {text}")
+            update_task(self.tasks_db, task_id, touched=("log",))
+
+    def submit(self, task_id, params, user, team):
+        with self._lock:
+            self._queue.append({
+                "task_id": task_id, "user": user, "team": team,
+                "params": params, "enqueued_at": time.time()
+            })
+            update_task(self.tasks_db, task_id, {"status": "Queued"})
+        self._dispatch()
+        position = self.tasks_db[task_id].get("queue_position")
+        if position:
+            self._log(task_id, f"⏳ Đang xếp hàng chờ slot trống (vị trí {position}).")
+
+    def cancel(self, task_id):
+        """Bỏ một task còn đang xếp hàng. Trả về True nếu task chưa chạy."""
+        with self._lock:
+            for entry in self._queue:
+                if entry["task_id"] == task_id:
+                    self._queue.remove(entry)
+                    update_task(self.tasks_db, task_id, {"status": "Stopped"}, remove=("queue_position",))
+                    self._update_positions()
+                    return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {"max_slots": self.max_slots, "running": len(self._running), "queued": len(self._queue),
+                    "paused": self._paused}
+
+    def kick(self):
+        """Thử chạy lại hàng đợi (vd. admin vừa cập nhật cookie cho một tài khoản)."""
+        self._dispatch()
+
+    # --- CIRCUIT BREAKER ---
+    def _accounts_down(self):
+        """Mọi tài khoản Flow đều chết: giữ task trong hàng thay vì chạy rồi lỗi ngay."""
+        down = self.accounts is not None and self.accounts.healthy_count() == 0
+        if down and not self._paused:
+            print("⏸️ Hàng đợi tạm dừng: không còn tài khoản Flow nào hoạt động.")
+        elif not down and self._paused:
+            print("▶️ Đã có tài khoản Flow hoạt động, hàng đợi chạy tiếp.")
+        self._paused = down
+        return down
+
+    def _schedule_resume(self):
+        if self._resume_timer is not None and self._resume_timer.is_alive():
+            return
+        self._resume_timer = threading.Timer(SCHEDULER_PAUSE_RETRY, self._dispatch)
+        self._resume_timer.daemon = True
+        self._resume_timer.start()
+
+    # --- FAIR SHARE ---
+    def _fair_order(self):
+        """Thứ tự các task trong hàng sẽ được chạy, mô phỏng việc chọn lần lượt."""
+        by_user, by_team = {}, {}
+        for info in self._running.values():
+            by_user[info["user"]] = by_user.get(info["user"], 0) + 1
+            by_team[info["team"]] = by_team.get(info["team"], 0) + 1
+
+        order, remaining = [], list(self._queue)
+        while remaining:
+            entry = min(remaining, key=lambda e: (by_user.get(e["user"], 0), by_team.get(e["team"], 0), e["enqueued_at"]))
+            remaining.remove(entry)
+            order.append(entry)
+            by_user[entry["user"]] = by_user.get(entry["user"], 0) + 1
+            by_team[entry["team"]] = by_team.get(entry["team"], 0) + 1
+        return order
+
+    def _update_positions(self):
+        for position, entry in enumerate(self._fair_order(), start=1):
+            task = self.tasks_db.get(entry["task_id"])
+            if task is not None and task.get("queue_position") != position:
+                update_task(self.tasks_db, entry["task_id"], {"queue_position": position})
+
+    def _dispatch(self):
+        to_start = []
+        paused = False
+        with self._lock:
+            if len(self._running) < self.max_slots and self._queue and self._accounts_down():
+                paused = True
+                for entry in self._queue:
+                    if not entry.get("paused"):
+                        entry["paused"] = True
+                        self._log(entry["task_id"], "⏸️ Hàng đợi tạm dừng: không còn tài khoản Flow nào hoạt động.")
+            while not paused and len(self._running) < self.max_slots and self._queue:
+                entry = self._fair_order()[0]
+                self._queue.remove(entry)
+                if self.is_team_allowed and not self.is_team_allowed(entry["team"])[0]:
+                    update_task(self.tasks_db, entry["task_id"], {"status": "Stopped"})
+                    self._log(entry["task_id"], "⛔ Team không còn lượt chạy hôm nay, bỏ task khỏi hàng đợi.")
+                    continue
+                self._running[entry["task_id"]] = {"user": entry["user"], "team": entry["team"]}
+                update_task(self.tasks_db, entry["task_id"], {"status": "Initializing"}, remove=("queue_position",))
+                to_start.append(entry)
+            self._update_positions()
+
+        if paused:
+            self._schedule_resume()
+        for entry in to_start:
+            threading.Thread(target=self._run, args=(entry,), daemon=True).start()
+
+    def _run(self, entry):
+        task_id = entry["task_id"]
+        params = entry["params"]
+        account, worker = None, None
+        try:
+            if self.accounts is not None:
+                account = self.accounts.acquire()
+                if account is None:
+                    self._log(task_id, "⛔ Không còn tài khoản Flow nào hoạt động. Admin cần cập nhật cookie.")
+                    update_task(self.tasks_db, task_id, {"status": "Error (Cookie)"})
+                    return
+                params = dict(params, cookies=account["cookies"], account=account["name"])
+                update_task(self.tasks_db, task_id, {"account": account["name"]})
+                self._log(task_id, f"👤 Chạy trên tài khoản Flow: {account['name']}")
+            worker = self.start_fn(task_id, self.tasks_db, params)
+            worker.join()
+        except Exception as e:
+            self._log(task_id, f"❌ Worker lỗi: {e}")
+            update_task(self.tasks_db, task_id, {"status": "Error (Init)"})
+        finally:
+            if hasattr(worker, "release_inflight"):
+                worker.release_inflight()
+            if account is not None:
+                if hasattr(worker, "release_account_jobs"):
+                    worker.release_account_jobs()
+                self.accounts.release(account["name"])
+            with self._lock:
+                self._running.pop(task_id, None)
+            self._dispatch()
@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import fcntl
+import threading
+from pathlib import Path
+from datetime import datetime
+
+from storage_db import get_connection, transaction, APP_DB_PATH
+from task_versions import add_listener, current_cursor
+from task_log import TaskLogSnapshot, log_path
+from task_summary import summarize
+
+# --- TRẠNG THÁI DÙNG CHUNG GIỮA CÁC TIẾN TRÌNH GUNICORN ---
+# Chỉ một tiến trình (leader, giữ file lock) chạy scheduler/worker/browser.
+# Leader ghi bản chụp các task vào SQLite; các tiến trình khác đọc từ đó và
+# gửi lệnh (tạo task, dừng task...) qua bảng task_commands.
+LEADER_LOCK_PATH = Path(os.environ.get("LEADER_LOCK_PATH", "storage/leader.lock"))
+SHARED_FLUSH_INTERVAL = float(os.environ.get("SHARED_FLUSH_INTERVAL", "0.5"))
+COMMAND_POLL_INTERVAL = float(os.environ.get("COMMAND_POLL_INTERVAL", "0.3"))
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", "5"))
+# Chỉ ghi thời điểm hoạt động của user tối đa mỗi khoảng này (giây) trên một tiến trình
+PRESENCE_WRITE_INTERVAL = float(os.environ.get("PRESENCE_WRITE_INTERVAL", "5"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_tasks (
+    task_id TEXT PRIMARY KEY,
+    username TEXT,
+    version INTEGER,
+    data TEXT,
+    log_spilled INTEGER DEFAULT 0,
+    log_tail TEXT,
+    summary TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_shared_tasks_user ON shared_tasks(username);
+CREATE TABLE IF NOT EXISTS shared_kv (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS presence (
+    username TEXT PRIMARY KEY,
+    last_seen REAL
+);
+CREATE TABLE IF NOT EXISTS task_commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    task_id TEXT,
+    payload TEXT,
+    created_at REAL
+);
+"""
+
+# Trường không ghi vào bản chụp (log ghi riêng)
+_UNSHARED_FIELDS = {"stop_flag", "log"}
+
+
+class SharedTaskView:
+    """Xem các task do leader công bố, dùng như dict ACTIVE_TASKS (chỉ đọc)."""
+    def __init__(self, shared):
+        self.shared = shared
+
+    def _row_to_task(self, row):
+        task = json.loads(row["data"])
+        task["log"] = TaskLogSnapshot(log_path(row["task_id"]), row["log_spilled"], json.loads(row["log_tail"] or "[]"))
+        return task
+
+    def get(self, task_id, default=None):
+        row = self.shared._conn().execute("SELECT * FROM shared_tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return self._row_to_task(row) if row else default
+
+    def __getitem__(self, task_id):
+        task = self.get(task_id)
+        if task is None:
+            raise KeyError(task_id)
+        return task
+
+    def __contains__(self, task_id):
+        return self.shared._conn().execute("SELECT 1 FROM shared_tasks WHERE task_id = ?", (task_id,)).fetchone() is not None
+
+    def items(self):
+        rows = self.shared._conn().execute("SELECT * FROM shared_tasks ORDER BY updated_at").fetchall()
+        return [(row["task_id"], self._row_to_task(row)) for row in rows]
+
+    def for_user(self, username):
+        """Các task của một user (dùng index theo username, không parse task của user khác)."""
+        rows = self.shared._conn().execute(
+            "SELECT * FROM shared_tasks WHERE username = ? ORDER BY updated_at", (username,)
+        ).fetchall()
+        return [(row["task_id"], self._row_to_task(row)) for row in rows]
+
+    def summaries(self):
+        """Chỉ đọc cột tóm tắt (không parse data/log) cho trang admin."""
+        rows = self.shared._conn().execute("SELECT summary FROM shared_tasks WHERE summary IS NOT NULL").fetchall()
+        return [json.loads(row["summary"]) for row in rows]
+
+    def values(self):
+        return [task for _, task in self.items()]
+
+    def __iter__(self):
+        return iter([task_id for task_id, _ in self.items()])
+
+    def __len__(self):
+        return self.shared._conn().execute("SELECT COUNT(*) FROM shared_tasks").fetchone()[0]
+
+
+class SharedState:
+    def __init__(self, db_path=APP_DB_PATH, lock_path=LEADER_LOCK_PATH):
+        self.db_path = db_path
+        self.lock_path = Path(lock_path)
+        self.is_leader = False
+        self._lock_file = None
+        self._dirty = set()
+        self._published = set()
+        self._dirty_lock = threading.Lock()
+        self._presence_written = {}
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        # DB tạo trước khi có cột summary
+        if "summary" not in {r["name"] for r in conn.execute("PRAGMA table_info(shared_tasks)")}:
+            conn.execute("ALTER TABLE shared_tasks ADD COLUMN summary TEXT")
+        self.view = SharedTaskView(self)
+
+    def _conn(self):
+        return get_connection(self.db_path)
+
+    # --- LEADER ---
+    def try_become_leader(self):
+        """Giữ file lock không chặn. True nếu tiến trình này là leader."""
+        if self.is_leader:
+            return True
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.lock_path, "a+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._lock_file = f
+        self.is_leader = True
+        return True
+
+    def watch_leadership(self, on_elected):
+        """Tiến trình phụ thử lại lock định kỳ; khi leader cũ chết thì tự lên thay."""
+        def loop():
+            while not self.try_become_leader():
+                time.sleep(LEADER_RETRY_INTERVAL)
+            on_elected()
+        threading.Thread(target=loop, name="leader-watch", daemon=True).start()
+
+    # --- KEY/VALUE (cookies...) ---
+    def get_value(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM shared_kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else default
+
+    def set_value(self, key, value):
+        self._conn().execute(
+            "INSERT INTO shared_kv (key, value, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (key, json.dumps(value), time.time())
+        )
+
+    # --- PRESENCE ---
+    def touch_presence(self, username):
+        now = time.time()
+        if now - self._presence_written.get(username, 0) < PRESENCE_WRITE_INTERVAL:
+            return
+        self._presence_written[username] = now
+        self._conn().execute(
+            "INSERT INTO presence (username, last_seen) VALUES (?, ?) "
+            "ON CONFLICT(username) DO UPDATE SET last_seen = excluded.last_seen",
+            (username, now)
+        )
+
+    def drop_presence(self, username):
+        self._presence_written.pop(username, None)
+        self._conn().execute("DELETE FROM presence WHERE username = ?", (username,))
+
+    def active_users(self, within_seconds):
+        """{username: datetime last_seen} của các user hoạt động trong khoảng vừa qua."""
+        rows = self._conn().execute(
+            "SELECT username, last_seen FROM presence WHERE last_seen > ?", (time.time() - within_seconds,)
+        )
+        return {r["username"]: datetime.fromtimestamp(r["last_seen"]) for r in rows}
+
+    # --- CÔNG BỐ TASK (LEADER) ---
+    def _mark_dirty(self, task):
+        task_id = task.get("id")
+        if task_id:
+            with self._dirty_lock:
+                self._dirty.add(task_id)
+
+    def cursor(self):
+        """Cursor "<epoch>:<version>" mới nhất leader đã công bố (đọc ở tiến trình phụ)."""
+        return self.get_value("cursor", "")
+
+    def take_stale_tasks(self):
+        """Lấy và xoá các bản chụp do leader cũ để lại (khi vừa lên làm leader)."""
+        conn = self._conn()
+        with transaction(conn):
+            rows = conn.execute("SELECT * FROM shared_tasks").fetchall()
+            conn.execute("DELETE FROM shared_tasks")
+        return [self.view._row_to_task(row) for row in rows]
+
+    def flush(self, tasks_db):
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        removed = {task_id for task_id in self._published if task_id not in tasks_db}
+        if not dirty and not removed:
+            return
+
+        cursor = current_cursor()
+        conn = self._conn()
+        with transaction(conn):
+            for task_id in dirty:
+                task = tasks_db.get(task_id)
+                if task is None:
+                    continue
+                data = {k: v for k, v in task.items() if k not in _UNSHARED_FIELDS}
+                log = task.get("log")
+                snap = log.snapshot() if hasattr(log, "snapshot") else TaskLogSnapshot(log_path(task_id), 0, list(log or []))
+                conn.execute(
+                    "INSERT OR REPLACE INTO shared_tasks (task_id, username, version, data, log_spilled, log_tail, summary, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (task_id, task.get("user"), task.get("version", 0), json.dumps(data, default=str),
+                     snap.spilled, json.dumps(snap.lines), json.dumps(summarize(task), default=str), time.time())
+                )
+                self._published.add(task_id)
+            for task_id in removed:
+                conn.execute("DELETE FROM shared_tasks WHERE task_id = ?", (task_id,))
+                self._published.discard(task_id)
+            conn.execute(
+                "INSERT INTO shared_kv (key, value, updated_at) VALUES ('cursor', ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (json.dumps(cursor), time.time())
+            )
+
+    def start_publisher(self, tasks_db):
+        add_listener(self._mark_dirty)
+        with self._dirty_lock:
+            self._dirty.update(tasks_db.keys())
+
+        def loop():
+            while True:
+                try:
+                    self.flush(tasks_db)
+                except Exception as e:
+                    print(f"Lỗi ghi trạng thái task dùng chung: {e}")
+                time.sleep(SHARED_FLUSH_INTERVAL)
+        threading.Thread(target=loop, name="shared-publisher", daemon=True).start()
+
+    def watch_cursor(self, on_change):
+        """Tiến trình phụ: gọi on_change() khi leader công bố thay đổi mới (để đẩy SSE)."""
+        def loop():
+            last = None
+            while not self.is_leader:
+                try:
+                    cursor = self.cursor()
+                    if cursor != last:
+                        last = cursor
+                        on_change()
+                except Exception as e:
+                    print(f"Lỗi đọc cursor dùng chung: {e}")
+                time.sleep(SHARED_FLUSH_INTERVAL)
+        threading.Thread(target=loop, name="shared-cursor-watch", daemon=True).start()
+
+    # --- LỆNH GIỮA CÁC TIẾN TRÌNH ---
+    def send_command(self, kind, task_id=None, **payload):
+        self._conn().execute(
+            "INSERT INTO task_commands (kind, task_id, payload, created_at) VALUES (?, ?, ?, ?)",
+            (kind, task_id, json.dumps(payload, default=str), time.time())
+        )
+
+    def start_command_loop(self, handler):
+        """Leader: lấy lệnh theo thứ tự và gọi handler(kind, task_id, payload)."""
+        def loop():
+            while True:
+                try:
+                    conn = self._conn()
+                    with transaction(conn):
+                        rows = conn.execute("SELECT * FROM task_commands ORDER BY id LIMIT 50").fetchall()
+                        if rows:
+                            conn.execute("DELETE FROM task_commands WHERE id <= ?", (rows[-1]["id"],))
+                    for row in rows:
+                        try:
+                            handler(row["kind"], row["task_id"], json.loads(row["payload"] or "{}"))
+                        except Exception as e:
+                            print(f"Lỗi xử lý lệnh {row['kind']} ({row['task_id']}): {e}")
+                except Exception as e:
+                    print(f"Lỗi đọc hàng đợi lệnh: {e}")
+                time.sleep(COMMAND_POLL_INTERVAL)
+        threading.Thread(target=loop, name="shared-commands", daemon=True).start()
+
+
+SHARED = SharedState()
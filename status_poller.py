@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- CẤU HÌNH POLLER ---
+STATUS_POLL_BATCH_SIZE = int(os.environ.get("STATUS_POLL_BATCH_SIZE", "50"))
+POLL_STATS_PATH = Path(os.environ.get("POLL_STATS_PATH", "storage/poll_stats.json"))
+
+STATUS_SUCCESSFUL = "MEDIA_GENERATION_STATUS_SUCCESSFUL"
+STATUS_FAILED = "MEDIA_GENERATION_STATUS_FAILED"
+
+# Loại job dùng cho mô hình deadline
+KIND_720P = "720p"
+KIND_UPSCALE = "1080p_upscale"
+KIND_I2V = "i2v"
+
+
+class TransientPollError(Exception):
+    """Lỗi tạm thời (mạng, 5xx, 429) - sẽ được thử lại trong giới hạn error_budget."""
+
+
+# --- CHÍNH SÁCH POLLING ---
+class PollingPolicy:
+    """
+    Quyết định khi nào kiểm tra lại một operation và bao lâu thì bỏ cuộc.
+    - Lần kiểm tra đầu sớm (first_delay), sau đó giãn dần theo backoff có jitter.
+    - Lỗi tạm thời được thử lại tối đa error_budget lần.
+    - Deadline theo từng loại job = phân vị quan sát được * deadline_factor,
+      dùng default_deadline khi chưa đủ mẫu.
+    """
+    def __init__(self, first_delay=3.0, initial_interval=5.0, max_interval=30.0, backoff=1.5,
+                 jitter=0.2, error_budget=5, percentile=0.95, deadline_factor=1.5,
+                 min_samples=10, default_deadline=300.0, min_deadline=120.0, max_deadline=1800.0,
+                 stats_path=POLL_STATS_PATH):
+        self.first_delay = first_delay
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.error_budget = error_budget
+        self.percentile = percentile
+        self.deadline_factor = deadline_factor
+        self.min_samples = min_samples
+        self.default_deadline = default_deadline
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        self.stats_path = stats_path
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._load_stats()
+
+    def _jittered(self, seconds):
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def next_delay(self, checks_done, errors=0):
+        """Số giây chờ trước lần kiểm tra kế tiếp."""
+        if checks_done == 0 and errors == 0:
+            return self.first_delay
+        if errors:
+            # Lỗi tạm thời: lùi theo số lần lỗi liên tiếp
+            return self._jittered(min(self.max_interval, self.initial_interval * (2 ** (errors - 1))))
+        return self._jittered(min(self.max_interval, self.initial_interval * (self.backoff ** (checks_done - 1))))
+
+    def deadline(self, kind):
+        with self._lock:
+            samples = sorted(self._samples.get(kind, []))
+        if len(samples) < self.min_samples:
+            return self.default_deadline
+        observed = samples[min(len(samples) - 1, int(len(samples) * self.percentile))]
+        return max(self.min_deadline, min(self.max_deadline, observed * self.deadline_factor))
+
+    def record_completion(self, kind, seconds):
+        with self._lock:
+            self._samples.setdefault(kind, deque(maxlen=200)).append(round(seconds, 1))
+            data = {k: list(v) for k, v in self._samples.items()}
+        try:
+            self.stats_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.stats_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp, self.stats_path)
+        except Exception as e:
+            print(f"Không lưu được thống kê polling: {e}")
+
+    def _load_stats(self):
+        try:
+            data = json.loads(self.stats_path.read_text(encoding="utf-8"))
+            self._samples = {k: deque(v, maxlen=200) for k, v in data.items()}
+        except Exception:
+            self._samples = {}
+
+
+class PendingOperation:
+    """Một operation đang chờ kết quả. `event` được set khi xong (thành công/thất bại/lỗi)."""
+    def __init__(self, name, auth_token, kind=KIND_720P):
+        self.name = name
+        self.auth_token = auth_token
+        self.kind = kind
+        self.submitted_at = time.time()
+        self.event = threading.Event()
+        self.status = None
+        self.result = None   # dict operation đầy đủ trong phản hồi
+        self.error = None    # Exception nếu request kiểm tra bị lỗi
+
+    def wait(self, timeout=None):
+        return self.event.wait(timeout)
+
+    def video_url(self):
+        try:
+            return self.result["operation"]["metadata"]["video"]["fifeUrl"]
+        except (KeyError, TypeError) as e:
+            raise Exception(f"Lỗi trích xuất URL từ JSON phản hồi: {e}")
+
+
+class _Tracked:
+    """Trạng thái polling của một operation name (có thể có nhiều PendingOperation chờ)."""
+    def __init__(self, auth_token, kind, next_check):
+        self.auth_token = auth_token
+        self.kind = kind
+        self.waiters = []
+        self.checks = 0
+        self.errors = 0
+        self.next_check = next_check
+
+
+class StatusPoller:
+    """
+    Một thread nền duy nhất gom tất cả operation đang chờ của mọi task vào các
+    request batchCheckAsyncVideoGenerationStatus, dùng chung một Session keep-alive.
+    Lịch kiểm tra của từng operation do PollingPolicy quyết định.
+    """
+    def __init__(self, url, policy=None, batch_size=STATUS_POLL_BATCH_SIZE):
+        self.url = url
+        self.policy = policy or PollingPolicy()
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        self._tracked = {}   # operation name -> _Tracked
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def submit(self, operation_name, auth_token, kind=KIND_720P):
+        pending = PendingOperation(operation_name, auth_token, kind)
+        with self._lock:
+            tracked = self._tracked.get(operation_name)
+            if tracked is None:
+                tracked = _Tracked(auth_token, kind, time.time() + self.policy.next_delay(0))
+                self._tracked[operation_name] = tracked
+            tracked.waiters.append(pending)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="status-poller", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return pending
+
+    def cancel(self, pending):
+        with self._lock:
+            tracked = self._tracked.get(pending.name)
+            if tracked is None:
+                return
+            if pending in tracked.waiters:
+                tracked.waiters.remove(pending)
+            if not tracked.waiters:
+                self._tracked.pop(pending.name, None)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                if not self._tracked:
+                    self._thread = None
+                    return
+                now = time.time()
+                by_token = {}
+                for name, tracked in self._tracked.items():
+                    if tracked.next_check <= now:
+                        by_token.setdefault(tracked.auth_token, []).append(name)
+                next_wake = min(t.next_check for t in self._tracked.values())
+
+            for auth_token, names in by_token.items():
+                for i in range(0, len(names), self.batch_size):
+                    self._check_batch(auth_token, names[i:i + self.batch_size])
+
+            if not by_token:
+                self._wakeup.wait(timeout=max(0.2, next_wake - time.time()))
+
+    def _resolve(self, name, status=None, result=None, error=None):
+        terminal = error is not None or status in (STATUS_SUCCESSFUL, STATUS_FAILED)
+        with self._lock:
+            tracked = self._tracked.get(name)
+            if tracked is None:
+                return
+            waiters = list(tracked.waiters)
+            if terminal:
+                self._tracked.pop(name, None)
+            else:
+                tracked.checks += 1
+                tracked.errors = 0
+                tracked.next_check = time.time() + self.policy.next_delay(tracked.checks)
+
+        for pending in waiters:
+            pending.status = status or pending.status
+            if result is not None:
+                pending.result = result
+            if error is not None:
+                pending.error = error
+            if terminal:
+                if status == STATUS_SUCCESSFUL:
+                    self.policy.record_completion(pending.kind, time.time() - pending.submitted_at)
+                pending.event.set()
+
+    def _retry_later(self, name, error):
+        """Lỗi tạm thời: lên lịch thử lại, hoặc báo lỗi nếu đã hết error_budget."""
+        with self._lock:
+            tracked = self._tracked.get(name)
+            if tracked is None:
+                return
+            tracked.errors += 1
+            exhausted = tracked.errors > self.policy.error_budget
+            if not exhausted:
+                tracked.next_check = time.time() + self.policy.next_delay(tracked.checks, tracked.errors)
+        if exhausted:
+            self._resolve(name, error=error)
+
+    def _check_batch(self, auth_token, names):
+        headers = {"Authorization": auth_token} if auth_token else {}
+        try:
+            resp = self.session.post(
+                self.url,
+                json={"operations": [{"operation": {"name": name}} for name in names]},
+                headers=headers,
+                timeout=30
+            )
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise TransientPollError(f"{resp.status_code} Server Error: {resp.reason}")
+            resp.raise_for_status()
+            operations = resp.json().get("operations", [])
+        except (requests.ConnectionError, requests.Timeout, TransientPollError, ValueError) as e:
+            for name in names:
+                self._retry_later(name, e)
+            return
+        except Exception as e:
+            # 401/403/4xx: không thử lại
+            for name in names:
+                self._resolve(name, error=e)
+            return
+
+        seen = set()
+        for op in operations:
+            name = (op.get("operation") or {}).get("name")
+            if name is None and len(names) == 1:
+                name = names[0]
+            if name:
+                seen.add(name)
+                self._resolve(name, status=op.get("status"), result=op)
+        # Operation không có trong phản hồi: kiểm tra lại theo lịch bình thường
+        for name in names:
+            if name not in seen:
+                self._resolve(name)
@@ -0,0 +1,336 @@
+import os
+import re
+import time
+import shutil
+import threading
+from pathlib import Path
+
+from storage_db import get_connection, transaction, APP_DB_PATH
+from result_cache import RESULT_CACHE
+
+# --- CẤU HÌNH DUNG LƯỢNG LƯU TRỮ ---
+GB = 1024 ** 3
+# 0 = không giới hạn
+STORAGE_USER_QUOTA_BYTES = int(os.environ.get("STORAGE_USER_QUOTA_BYTES", str(10 * GB)))
+STORAGE_GLOBAL_QUOTA_BYTES = int(os.environ.get("STORAGE_GLOBAL_QUOTA_BYTES", str(100 * GB)))
+# Luôn chừa ít nhất bấy nhiêu byte trống trên ổ đĩa (tránh worker lỗi giữa chừng khi tải video)
+STORAGE_MIN_FREE_BYTES = int(os.environ.get("STORAGE_MIN_FREE_BYTES", str(2 * GB)))
+# File không được tải về / dùng lại quá số ngày này thì xoá (0 = giữ mãi nếu còn trong quota)
+STORAGE_RETENTION_DAYS = float(os.environ.get("STORAGE_RETENTION_DAYS", "30"))
+STORAGE_SWEEP_INTERVAL = float(os.environ.get("STORAGE_SWEEP_INTERVAL", "600"))
+# Ảnh vừa upload chưa được task nào tham chiếu: không xoá trong bấy nhiêu giờ kể từ lần upload gần nhất
+STORAGE_UPLOAD_GRACE_HOURS = float(os.environ.get("STORAGE_UPLOAD_GRACE_HOURS", "24"))
+
+KIND_VIDEO = "video"
+KIND_UPLOAD = "upload"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stored_files (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT,
+    task_id TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    created_at REAL,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS idx_stored_files_owner ON stored_files(owner, last_access);
+CREATE INDEX IF NOT EXISTS idx_stored_files_lru ON stored_files(last_access);
+CREATE TABLE IF NOT EXISTS file_owners (
+    path TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    added_at REAL,
+    PRIMARY KEY (path, owner)
+);
+CREATE INDEX IF NOT EXISTS idx_file_owners_owner ON file_owners(owner);
+"""
+
+# Tên upload kiểu cũ: {username}_{uuid8}_{tên file}
+_LEGACY_UPLOAD = re.compile(r"^(.+?)_[0-9a-f]{8}_")
+
+
+def _key(path):
+    return os.path.normpath(str(path))
+
+
+class StorageCatalog:
+    """
+    Danh mục mọi file lưu trong storage/Generated_Videos và storage/uploads: chủ sở hữu,
+    task, dung lượng, thời điểm tạo và lần tải về gần nhất. Sweeper chạy nền xoá file
+    ít dùng nhất (LRU) khi vượt quota của user / toàn hệ thống, khi ổ đĩa sắp đầy hoặc
+    quá hạn lưu giữ; file còn được task đang chạy tham chiếu thì không bao giờ bị xoá.
+
+    Ảnh upload lưu theo hash nên một file có thể thuộc nhiều user (bảng file_owners; cột
+    stored_files.owner chỉ là người tạo đầu tiên). Mỗi user bị tính đủ dung lượng file mình
+    giữ; user vượt quota chỉ mất quyền sở hữu file dùng chung, file bị xoá khi không còn ai giữ.
+    """
+    def __init__(self, db_path=APP_DB_PATH, user_quota=STORAGE_USER_QUOTA_BYTES,
+                 global_quota=STORAGE_GLOBAL_QUOTA_BYTES, min_free=STORAGE_MIN_FREE_BYTES,
+                 retention_days=STORAGE_RETENTION_DAYS, interval=STORAGE_SWEEP_INTERVAL,
+                 upload_grace_hours=STORAGE_UPLOAD_GRACE_HOURS):
+        self.db_path = db_path
+        self.user_quota = user_quota
+        self.global_quota = global_quota
+        self.min_free = min_free
+        self.retention = retention_days * 86400
+        self.interval = interval
+        self.upload_grace = upload_grace_hours * 3600
+        self._protected_fn = None
+        self._sweep_lock = threading.Lock()
+        self._thread = None
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        # Danh mục tạo trước khi có file_owners: chủ sở hữu duy nhất nằm ở stored_files.owner
+        conn.execute(
+            "INSERT OR IGNORE INTO file_owners (path, owner, added_at) "
+            "SELECT path, owner, created_at FROM stored_files WHERE owner IS NOT NULL"
+        )
+
+    def _conn(self):
+        return get_connection(self.db_path)
+
+    # --- GHI NHẬN ---
+    def record(self, path, kind, owner=None, task_id=None):
+        """
+        File mới (hoặc ghi đè). File đã có trong danh mục thì chỉ cập nhật dung lượng / lần dùng
+        và thêm `owner` vào danh sách người giữ file (vd. user khác upload lại cùng một ảnh).
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        now = time.time()
+        conn = self._conn()
+        with transaction(conn):
+            conn.execute(
+                "INSERT INTO stored_files (path, kind, owner, task_id, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access",
+                (_key(path), kind, owner, task_id, size, now, now)
+            )
+            if owner is not None:
+                conn.execute(
+                    "INSERT INTO file_owners (path, owner, added_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(path, owner) DO UPDATE SET added_at = excluded.added_at",
+                    (_key(path), owner, now)
+                )
+
+    def touch(self, path):
+        """Vừa được tải về / dùng lại: đẩy file lên cuối hàng LRU."""
+        self._conn().execute("UPDATE stored_files SET last_access = ? WHERE path = ?", (time.time(), _key(path)))
+
+    def scan(self, video_dir, upload_dir):
+        """
+        Đưa các file đã có trên đĩa (trước khi có danh mục) vào danh mục. Chủ sở hữu video lấy từ
+        lịch sử chạy của user, ảnh upload kiểu cũ lấy từ tiền tố tên file.
+        """
+        conn = self._conn()
+        known = {r["path"] for r in conn.execute("SELECT path FROM stored_files")}
+        owners = {}
+        try:
+            for r in conn.execute(
+                "SELECT i.file, e.username, e.task_id FROM history_items i "
+                "JOIN history_entries e ON e.id = i.entry_id WHERE i.file != ''"
+            ):
+                owners[r["file"]] = (r["username"], r["task_id"])
+        except Exception:
+            pass   # chưa có bảng lịch sử
+
+        rows = []
+        for kind, folder in ((KIND_VIDEO, Path(video_dir)), (KIND_UPLOAD, Path(upload_dir))):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder):
+                if not entry.is_file() or entry.name.endswith(".part") or _key(entry.path) in known:
+                    continue
+                st = entry.stat()
+                if kind == KIND_VIDEO:
+                    owner, task_id = owners.get(entry.name, (None, None))
+                else:
+                    match = _LEGACY_UPLOAD.match(entry.name)
+                    owner, task_id = (match.group(1) if match else None), None
+                rows.append((_key(entry.path), kind, owner, task_id, st.st_size, st.st_mtime, st.st_mtime))
+        if rows:
+            with transaction(conn):
+                conn.executemany(
+                    "INSERT OR IGNORE INTO stored_files (path, kind, owner, task_id, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO file_owners (path, owner, added_at) VALUES (?, ?, ?)",
+                    [(row[0], row[2], row[5]) for row in rows if row[2] is not None]
+                )
+            print(f"🗂️ Đã đưa {len(rows)} file có sẵn vào danh mục lưu trữ.")
+        return len(rows)
+
+    # --- THỐNG KÊ ---
+    def usage(self):
+        """
+        {"total": byte, "files": số file, "users": {owner: {"bytes", "files"}}}. File dùng chung
+        được tính đủ cho từng user giữ nó (tổng của các user có thể lớn hơn "total").
+        """
+        conn = self._conn()
+        total, files = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM stored_files").fetchone()
+        users = {
+            r["owner"]: {"bytes": r["bytes"], "files": r["files"]}
+            for r in conn.execute(
+                "SELECT o.owner, SUM(f.size) AS bytes, COUNT(*) AS files FROM file_owners o "
+                "JOIN stored_files f ON f.path = o.path GROUP BY o.owner ORDER BY bytes DESC"
+            )
+        }
+        return {"total": total, "files": files, "users": users,
+                "user_quota": self.user_quota, "global_quota": self.global_quota}
+
+    # --- DỌN DẸP ---
+    def _free_bytes(self):
+        try:
+            return shutil.disk_usage(Path(self.db_path).parent).free
+        except OSError:
+            return None
+
+    def _remove(self, conn, row, cache_links=None):
+        """
+        Xoá file khỏi đĩa và danh mục. Trả về số byte ổ đĩa thực sự được trả lại: file còn
+        hard link khác (cache kết quả, video dùng chung của task khác) thì dữ liệu vẫn nằm trên đĩa.
+        cache_links ({(dev, inode): khoá}, khi ổ đĩa sắp đầy): link còn lại chỉ là của cache
+        thì bỏ luôn mục cache đó để thật sự lấy lại chỗ.
+        """
+        self._forget(conn, row["path"])
+        released = 0
+        try:
+            st = os.stat(row["path"])
+            os.remove(row["path"])
+            links = st.st_nlink - 1
+            key = (cache_links or {}).get((st.st_dev, st.st_ino))
+            if links == 1 and key is not None and RESULT_CACHE.discard(key):
+                links = 0
+            released = st.st_size if links == 0 else 0
+        except FileNotFoundError:
+            pass
+        if row["kind"] == KIND_UPLOAD:
+            # Bản đã xử lý sẵn của ảnh (xem upload_store.py)
+            for prepared in Path(row["path"]).parent.glob(f"prepared/{Path(row['path']).stem}_*"):
+                try:
+                    os.remove(prepared)
+                except FileNotFoundError:
+                    pass
+        return released
+
+    def _forget(self, conn, path):
+        with transaction(conn):
+            conn.execute("DELETE FROM stored_files WHERE path = ?", (path,))
+            conn.execute("DELETE FROM file_owners WHERE path = ?", (path,))
+
+    def _low_disk(self, free, freed):
+        return free is not None and self.min_free > 0 and free + freed < self.min_free
+
+    def sweep(self, protected=None):
+        """
+        Xoá file theo thứ tự ít dùng gần đây nhất cho tới khi: không file nào quá hạn lưu giữ,
+        mỗi user dưới quota, tổng dưới quota và ổ đĩa còn đủ chỗ trống. Ảnh vừa upload (trong
+        upload_grace) không bị xoá. Trả về số file đã xoá.
+        """
+        if not self._sweep_lock.acquire(blocking=False):
+            return 0
+        try:
+            if protected is None:
+                if self._protected_fn is None:
+                    return 0   # chưa biết file nào đang được dùng: không xoá gì
+                protected = self._protected_fn()
+            protected = {_key(p) for p in protected}
+            conn = self._conn()
+            rows = conn.execute("SELECT * FROM stored_files ORDER BY last_access").fetchall()
+
+            sizes = {r["path"]: r["size"] for r in rows}
+            owners = {}   # path -> {owner: lần upload / tạo gần nhất}
+            for o in conn.execute("SELECT path, owner, added_at FROM file_owners"):
+                owners.setdefault(o["path"], {})[o["owner"]] = o["added_at"] or 0
+
+            total = sum(sizes.values())
+            by_owner = {}
+            for path, holders in owners.items():
+                for owner in holders:
+                    by_owner[owner] = by_owner.get(owner, 0) + sizes.get(path, 0)
+            free = self._free_bytes()
+            now = time.time()
+            cutoff = now - self.retention if self.retention > 0 else None
+            grace_cutoff = now - self.upload_grace
+
+            def drop(r):
+                nonlocal total
+                total -= r["size"]
+                for owner in owners.pop(r["path"], {}):
+                    by_owner[owner] -= r["size"]
+
+            removed, freed, cache_links = 0, 0, None
+            if self._low_disk(free, freed):
+                # Trước hết bỏ video chỉ còn nằm trong cache kết quả (không đụng tới file của user)
+                freed += RESULT_CACHE.release(self.min_free - free)
+                cache_links = RESULT_CACHE.inodes()
+            for r in rows:
+                if r["path"] in protected:
+                    continue
+                if not os.path.exists(r["path"]):
+                    self._forget(conn, r["path"])
+                    drop(r)
+                    continue
+                holders = owners.get(r["path"], {})
+                if r["kind"] == KIND_UPLOAD and max(holders.values(), default=r["created_at"] or 0) > grace_cutoff:
+                    continue   # vừa upload, user có thể chưa kịp gửi task dùng ảnh này
+                expired = cutoff is not None and (r["last_access"] or r["created_at"] or 0) < cutoff
+                over_users = [o for o in holders if self.user_quota > 0 and by_owner[o] > self.user_quota]
+                over_global = self.global_quota > 0 and total > self.global_quota
+                low_disk = self._low_disk(free, freed)
+                if not (expired or over_global or low_disk):
+                    if not over_users:
+                        continue
+                    if len(over_users) < len(holders):
+                        # File dùng chung: user vượt quota chỉ thôi giữ file, user khác vẫn dùng được
+                        conn.executemany(
+                            "DELETE FROM file_owners WHERE path = ? AND owner = ?",
+                            [(r["path"], o) for o in over_users]
+                        )
+                        for o in over_users:
+                            del holders[o]
+                            by_owner[o] -= r["size"]
+                        continue
+                freed += self._remove(conn, r, cache_links if low_disk else None)
+                drop(r)
+                removed += 1
+            if self._low_disk(free, freed):
+                # Video xoá vì quota / hết hạn có thể còn link trong cache: giờ cache là nơi giữ duy nhất
+                freed += RESULT_CACHE.release(self.min_free - free - freed)
+            if removed:
+                print(f"🧹 Dọn lưu trữ: đã xoá {removed} file ({freed / 1024 ** 2:.0f} MB).")
+            return removed
+        finally:
+            self._sweep_lock.release()
+
+    def ensure_free_space(self):
+        """Gọi trước khi ghi file lớn: ổ đĩa sắp đầy thì dọn ngay, không chờ lượt sweep kế tiếp."""
+        if self._low_disk(self._free_bytes(), 0):
+            self.sweep()
+
+    def start_sweeper(self, protected_fn, video_dir, upload_dir):
+        """protected_fn() -> tập đường dẫn file mà task đang chạy / đang chờ còn dùng."""
+        self._protected_fn = protected_fn
+        if self._thread is not None:
+            return
+
+        def loop():
+            try:
+                self.scan(video_dir, upload_dir)
+            except Exception as e:
+                print(f"Lỗi khi quét thư mục lưu trữ: {e}")
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"Lỗi sweeper dọn lưu trữ: {e}")
+                time.sleep(self.interval)
+
+        self._thread = threading.Thread(target=loop, name="storage-sweeper", daemon=True)
+        self._thread.start()
+
+
+STORAGE = StorageCatalog()
@@ -0,0 +1,47 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+# --- SQLITE DÙNG CHUNG CHO CÁC LỚP LƯU TRỮ ---
+APP_DB_PATH = Path(os.environ.get("APP_DB_PATH", "storage/app.db"))
+
+_local = threading.local()
+
+
+def get_connection(path=APP_DB_PATH):
+    """
+    Mỗi thread giữ một connection riêng tới SQLite (WAL mode) để
+    request thread và worker thread ghi song song mà không khoá cả file.
+    """
+    path = Path(path)
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(str(path))
+    if conn is None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conns[str(path)] = conn
+    return conn
+
+
+class transaction:
+    """`with transaction(conn):` -> BEGIN IMMEDIATE ... COMMIT/ROLLBACK."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
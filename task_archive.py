@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+from storage_db import get_connection, transaction, APP_DB_PATH
+
+# --- CẤU HÌNH LƯU TRỮ TASK ---
+# Task đã kết thúc được giữ trong ACTIVE_TASKS thêm khoảng này (giây) rồi mới chuyển sang kho lưu trữ
+TASK_ARCHIVE_GRACE = float(os.environ.get("TASK_ARCHIVE_GRACE", "600"))
+TASK_ARCHIVE_SWEEP_INTERVAL = float(os.environ.get("TASK_ARCHIVE_SWEEP_INTERVAL", "60"))
+
+# Trường nội bộ không lưu vào kho
+_SKIP_FIELDS = {"stop_flag", "field_versions", "version", "log"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived_tasks (
+    task_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    day TEXT NOT NULL,
+    status TEXT,
+    type TEXT,
+    resolution TEXT,
+    total INTEGER DEFAULT 0,
+    completed INTEGER DEFAULT 0,
+    errors INTEGER DEFAULT 0,
+    log_lines INTEGER DEFAULT 0,
+    archived_at TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_archived_user_day ON archived_tasks(username, day);
+CREATE INDEX IF NOT EXISTS idx_archived_day ON archived_tasks(day);
+CREATE INDEX IF NOT EXISTS idx_archived_status ON archived_tasks(status);
+"""
+
+_SUMMARY_COLUMNS = "task_id, username, day, status, type, resolution, total, completed, errors, log_lines, archived_at"
+
+
+def is_terminal(status):
+    status = status or ""
+    return status in ("Finished", "Stopped") or status.startswith("Error")
+
+
+class TaskArchive:
+    """
+    Kho lưu trữ task đã kết thúc (SQLite, đánh index theo user/ngày/trạng thái).
+    Sweeper chạy nền chuyển task khỏi ACTIVE_TASKS sau thời gian chờ `grace`
+    để dict trong RAM chỉ còn các task đang chạy hoặc vừa xong.
+    """
+    def __init__(self, db_path=APP_DB_PATH, grace=TASK_ARCHIVE_GRACE, interval=TASK_ARCHIVE_SWEEP_INTERVAL):
+        self.db_path = db_path
+        self.grace = grace
+        self.interval = interval
+        self._terminal_since = {}   # task_id -> thời điểm thấy trạng thái kết thúc
+        self._thread = None
+        get_connection(self.db_path).executescript(_SCHEMA)
+
+    def _conn(self):
+        return get_connection(self.db_path)
+
+    # --- GHI ---
+    def archive(self, task_id, task):
+        log = task.get("log")
+        log_lines = 0
+        if log is not None and hasattr(log, "flush"):
+            log.flush()
+            log_lines = len(log)
+        elif log is not None:
+            # Bản chụp từ leader cũ: chỉ phần đã ghi ra đĩa còn đọc lại được
+            log_lines = getattr(log, "spilled", 0)
+
+        data = {k: v for k, v in task.items() if k not in _SKIP_FIELDS}
+        created_at = task.get("created_at") or datetime.now().isoformat(timespec="seconds")
+        conn = self._conn()
+        with transaction(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO archived_tasks (task_id, username, day, status, type, resolution, total, "
+                "completed, errors, log_lines, archived_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (task_id, task.get("user"), created_at[:10], task.get("status"), task.get("type"),
+                 task.get("resolution"), task.get("total", 0), task.get("completed", 0), task.get("errors", 0),
+                 log_lines, datetime.now().isoformat(timespec="seconds"), json.dumps(data, default=str))
+            )
+
+    # --- ĐỌC ---
+    def get(self, task_id):
+        row = self._conn().execute(
+            f"SELECT {_SUMMARY_COLUMNS}, data FROM archived_tasks WHERE task_id = ?", (task_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        task = json.loads(row["data"])
+        task.update({k: row[k] for k in row.keys() if k != "data"})
+        return task
+
+    def find(self, username=None, day=None, status=None, limit=50, offset=0):
+        """Tìm task đã lưu trữ theo user / ngày (YYYY-MM-DD) / trạng thái, mới nhất trước."""
+        where, args = [], []
+        if username:
+            where.append("username = ?")
+            args.append(username)
+        if day:
+            where.append("day = ?")
+            args.append(day)
+        if status:
+            where.append("status LIKE ?")
+            args.append(f"{status}%")
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM archived_tasks {clause}", args).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {_SUMMARY_COLUMNS} FROM archived_tasks {clause} ORDER BY archived_at DESC LIMIT ? OFFSET ?",
+            (*args, limit, offset)
+        ).fetchall()
+        return {"total": total, "tasks": [dict(r) for r in rows]}
+
+    # --- SWEEPER ---
+    def sweep(self, tasks_db):
+        """Chuyển các task đã kết thúc quá `grace` giây sang kho. Trả về số task đã chuyển."""
+        now = time.time()
+        moved = 0
+        for task_id, task in list(tasks_db.items()):
+            if not is_terminal(task.get("status")):
+                self._terminal_since.pop(task_id, None)
+                continue
+            since = self._terminal_since.setdefault(task_id, now)
+            if now - since < self.grace:
+                continue
+            try:
+                self.archive(task_id, task)
+            except Exception as e:
+                print(f"Không lưu trữ được task {task_id}: {e}")
+                continue
+            tasks_db.pop(task_id, None)
+            self._terminal_since.pop(task_id, None)
+            moved += 1
+        if moved:
+            print(f"🗄️ Đã chuyển {moved} task đã kết thúc sang kho lưu trữ.")
+        return moved
+
+    def start_sweeper(self, tasks_db):
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.sweep(tasks_db)
+                except Exception as e:
+                    print(f"Lỗi sweeper lưu trữ task: {e}")
+
+        self._thread = threading.Thread(target=loop, name="task-archive", daemon=True)
+        self._thread.start()
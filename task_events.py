@@ -0,0 +1,120 @@
+import os
+import json
+import threading
+
+from task_versions import add_listener, current_cursor, parse_cursor, resolve_since, task_delta
+
+# --- CẤU HÌNH SSE ---
+# Gửi comment keep-alive nếu không có sự kiện trong khoảng này (giây)
+SSE_KEEPALIVE = float(os.environ.get("SSE_KEEPALIVE", "15"))
+# Mỗi kết nối SSE giữ một thread gthread suốt thời gian mở (mặc định 64 thread / tiến trình).
+# Vượt giới hạn thì từ chối (503), client quay về polling API delta như khi không có SSE.
+SSE_MAX_SUBSCRIBERS = int(os.environ.get("SSE_MAX_SUBSCRIBERS", "32"))
+SSE_MAX_PER_USER = int(os.environ.get("SSE_MAX_PER_USER", "2"))
+
+
+class Subscription:
+    """Một kết nối SSE của `username`. all_users=True (admin): nhận mọi task."""
+    def __init__(self, username=None, summary=False, all_users=False):
+        self.username = username
+        self.summary = summary
+        self.all_users = all_users or username is None
+        self._event = threading.Event()
+
+    def wants(self, task):
+        return self.all_users or task.get("user") == self.username
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        fired = self._event.wait(timeout)
+        self._event.clear()
+        return fired
+
+
+class TaskEventHub:
+    """
+    Phát thông báo "task đã đổi" tới các kết nối SSE. Mỗi kết nối tự tính delta
+    theo cursor của mình, nên nhiều thay đổi dồn dập chỉ thành một lần gửi.
+    """
+    def __init__(self, max_subscribers=SSE_MAX_SUBSCRIBERS, max_per_user=SSE_MAX_PER_USER):
+        self._subs = set()
+        self._lock = threading.Lock()
+        self.max_subscribers = max_subscribers
+        self.max_per_user = max_per_user
+
+    def subscribe(self, username=None, summary=False, all_users=False):
+        """
+        Subscription mới, hoặc None nếu tiến trình / user đã đủ số kết nối SSE cho phép.
+        Giới hạn mỗi user tính riêng từng loại kết nối (trang user / trang admin) của chính user đó.
+        """
+        sub = Subscription(username, summary, all_users)
+        with self._lock:
+            if len(self._subs) >= self.max_subscribers:
+                return None
+            kind = (username, sub.all_users)
+            if sum(1 for s in self._subs if (s.username, s.all_users) == kind) >= self.max_per_user:
+                return None
+            self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def publish(self, task):
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            if sub.wants(task):
+                sub.notify()
+
+    def notify_all(self):
+        """Đánh thức mọi kết nối (tiến trình phụ: khi leader công bố thay đổi mới)."""
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            sub.notify()
+
+    def count(self):
+        with self._lock:
+            return len(self._subs)
+
+    def stream(self, sub, items_fn, cursor_fn=current_cursor):
+        """
+        Generator trả về các khung SSE cho một subscription. Khung đầu tiên là toàn bộ (reset).
+        items_fn() -> [(task_id, task)] các task subscription được xem (vd. chỉ task của user đó).
+        """
+        seen, log_offsets, first = None, {}, True
+        try:
+            while True:
+                cursor = cursor_fn()
+                if seen is not None and parse_cursor(seen)[0] != parse_cursor(cursor)[0]:
+                    # Leader khởi động lại / đổi leader (epoch mới): gửi lại toàn bộ như lần đầu
+                    seen, log_offsets, first = None, {}, True
+                since = resolve_since(seen, cursor)
+                changed = {}
+                for task_id, task in items_fn():
+                    if not sub.wants(task):
+                        continue
+                    delta = task_delta(task, since, log_offsets.get(task_id, 0), summary=sub.summary)
+                    if delta is None:
+                        continue
+                    changed[task_id] = delta
+                    if "log" in delta:
+                        log_offsets[task_id] = delta["log_offset"] + len(delta["log"])
+
+                if changed or first:
+                    payload = json.dumps({"cursor": cursor, "reset": first, "tasks": changed}, ensure_ascii=False)
+                    yield f"id: {cursor}\nevent: tasks\ndata: {payload}\n\n"
+                    seen, first = cursor, False
+
+                if not sub.wait(SSE_KEEPALIVE):
+                    yield ": keep-alive\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+
+TASK_EVENTS = TaskEventHub()
+add_listener(TASK_EVENTS.publish)
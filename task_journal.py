@@ -0,0 +1,126 @@
+import json
+import time
+
+from storage_db import get_connection, APP_DB_PATH
+from task_versions import add_listener
+
+# --- NHẬT KÝ TASK (KHÔI PHỤC SAU KHI KHỞI ĐỘNG LẠI) ---
+# Mỗi bước quan trọng của task được ghi ngay vào SQLite:
+#   created    : tham số worker (không gồm cookies / stop_flag)
+#   submitted  : item đã gửi lên server, kèm operation id + token để poll lại
+#   downloaded : item đã tải xong
+#   failed     : item lỗi
+# Task kết thúc (Finished / Stopped / Error...) thì nhật ký của nó được xoá.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal_tasks (
+    task_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    team TEXT,
+    params TEXT NOT NULL,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS journal_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT NOT NULL REFERENCES journal_tasks(task_id) ON DELETE CASCADE,
+    idx INTEGER,
+    event TEXT NOT NULL,
+    data TEXT,
+    ts REAL
+);
+CREATE INDEX IF NOT EXISTS idx_journal_events_task ON journal_events(task_id, seq);
+"""
+
+_UNSAVED_PARAMS = {"stop_flag", "cookies"}
+
+
+def _is_terminal(status):
+    status = status or ""
+    return status in ("Finished", "Stopped") or status.startswith("Error")
+
+
+class TaskJournal:
+    def __init__(self, db_path=APP_DB_PATH):
+        self.db_path = db_path
+        self._open = set()    # task_id còn nhật ký (tránh ghi DB khi task đã đóng)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        self._open.update(r["task_id"] for r in conn.execute("SELECT task_id FROM journal_tasks"))
+        add_listener(self._on_task_changed)
+
+    def _conn(self):
+        return get_connection(self.db_path)
+
+    # --- GHI ---
+    def task_created(self, task_id, params, username, team):
+        saved = {k: v for k, v in params.items() if k not in _UNSAVED_PARAMS}
+        self._conn().execute(
+            "INSERT OR REPLACE INTO journal_tasks (task_id, username, team, params, created_at) VALUES (?, ?, ?, ?, ?)",
+            (task_id, username, team, json.dumps(saved, default=str), time.time())
+        )
+        self._open.add(task_id)
+
+    def record(self, task_id, event, idx=None, **data):
+        if task_id not in self._open:
+            return
+        try:
+            self._conn().execute(
+                "INSERT INTO journal_events (task_id, idx, event, data, ts) VALUES (?, ?, ?, ?, ?)",
+                (task_id, idx, event, json.dumps(data, default=str), time.time())
+            )
+        except Exception as e:
+            print(f"Không ghi được nhật ký task {task_id}: {e}")
+
+    def close(self, task_id):
+        if task_id not in self._open:
+            return
+        self._open.discard(task_id)
+        self._conn().execute("DELETE FROM journal_tasks WHERE task_id = ?", (task_id,))
+
+    def _on_task_changed(self, task):
+        # Task chuyển sang trạng thái kết thúc -> không cần khôi phục nữa
+        if task.get("id") in self._open and _is_terminal(task.get("status")):
+            self.close(task["id"])
+
+    # --- KHÔI PHỤC ---
+    def unfinished(self):
+        """
+        Dựng lại trạng thái các task chưa kết thúc từ nhật ký.
+        Mỗi phần tử: {"task_id", "username", "team", "params", "items", "inflight", "created_at"}
+        - items[idx]: {"status": Pending/Running/Finished/Error, "file": ...}
+        - inflight: các operation đã gửi nhưng chưa tải về (cần poll lại)
+        """
+        conn = self._conn()
+        recovered = []
+        for row in conn.execute("SELECT * FROM journal_tasks ORDER BY created_at").fetchall():
+            params = json.loads(row["params"])
+            count = len(params.get("prompts") or params.get("tasks") or [])
+            items = [{"status": "Pending", "file": ""} for _ in range(count)]
+            inflight = {}
+
+            for ev in conn.execute(
+                "SELECT idx, event, data FROM journal_events WHERE task_id = ? ORDER BY seq", (row["task_id"],)
+            ):
+                idx = ev["idx"]
+                if idx is None or not 0 <= idx < count:
+                    continue
+                data = json.loads(ev["data"] or "{}")
+                if ev["event"] == "submitted":
+                    items[idx] = {"status": "Running", "file": ""}
+                    inflight[idx] = dict(data, idx=idx)
+                elif ev["event"] == "downloaded":
+                    items[idx] = {"status": "Finished", "file": data.get("file", "")}
+                    inflight.pop(idx, None)
+                elif ev["event"] == "failed":
+                    items[idx] = {"status": "Error", "file": ""}
+                    inflight.pop(idx, None)
+
+            recovered.append({
+                "task_id": row["task_id"], "username": row["username"], "team": row["team"],
+                "params": params, "items": items, "inflight": list(inflight.values()),
+                "created_at": row["created_at"]
+            })
+        return recovered
+
+
+JOURNAL = TaskJournal()
@@ -0,0 +1,120 @@
+import os
+import gzip
+import threading
+from pathlib import Path
+
+# --- CẤU HÌNH LOG TASK ---
+# Số dòng log tối đa giữ trong RAM cho mỗi task (phần xem trực tiếp)
+TASK_LOG_MEMORY_LINES = int(os.environ.get("TASK_LOG_MEMORY_LINES", "200"))
+TASK_LOG_DIR = Path(os.environ.get("TASK_LOG_DIR", "storage/task_logs"))
+
+
+def log_path(task_id, log_dir=TASK_LOG_DIR):
+    return Path(log_dir) / f"{task_id}.log.gz"
+
+
+class TaskLog:
+    """
+    Log của một task: giữ tối đa `capacity` dòng mới nhất trong RAM,
+    các dòng cũ hơn được ghi nối vào file gzip riêng của task.
+    Vị trí dòng (offset) luôn tính từ đầu log, kể cả phần đã ghi ra đĩa.
+    """
+    def __init__(self, task_id, capacity=TASK_LOG_MEMORY_LINES, log_dir=TASK_LOG_DIR):
+        self.task_id = task_id
+        self.capacity = max(2, capacity)
+        self.path = log_path(task_id, log_dir)
+        self._lines = []
+        self._spilled = 0     # số dòng đã nằm trong file gzip
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._spilled + len(self._lines)
+
+    def append(self, line):
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) >= self.capacity:
+                self._spill(len(self._lines) - self.capacity // 2)
+
+    def _spill(self, count):
+        """Ghi `count` dòng cũ nhất ra file (mỗi lần là một gzip member mới)."""
+        chunk = self._lines[:count]
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write("".join(line.replace("\n", " ") + "\n" for line in chunk))
+        except Exception as e:
+            # Không ghi được ra đĩa thì vẫn giữ trong RAM, thử lại ở lần sau
+            print(f"Không ghi được log task {self.task_id}: {e}")
+            return
+        del self._lines[:count]
+        self._spilled += count
+
+    def snapshot(self):
+        with self._lock:
+            return TaskLogSnapshot(self.path, self._spilled, list(self._lines))
+
+    def since(self, offset):
+        return self.snapshot().since(offset)
+
+    def tail(self):
+        with self._lock:
+            return list(self._lines)
+
+    def read(self, offset=0, limit=500):
+        return self.snapshot().read(offset, limit)
+
+    def flush(self):
+        """Ghi toàn bộ phần còn trong RAM ra đĩa (khi task được lưu trữ)."""
+        with self._lock:
+            if self._lines:
+                self._spill(len(self._lines))
+
+
+class TaskLogSnapshot:
+    """
+    Bản chụp (chỉ đọc) của TaskLog: số dòng đã ghi ra đĩa + các dòng còn trong RAM.
+    Dùng được ở tiến trình khác vì phần trên đĩa đọc thẳng từ file gzip.
+    """
+    def __init__(self, path, spilled, lines):
+        self.path = Path(path)
+        self.spilled = spilled
+        self.lines = lines
+
+    def __len__(self):
+        return self.spilled + len(self.lines)
+
+    def since(self, offset):
+        """(offset_thực, các dòng trong RAM từ offset). Dòng đã ghi ra đĩa thì bỏ qua."""
+        start = max(offset, self.spilled)
+        return start, self.lines[start - self.spilled:]
+
+    def tail(self):
+        return list(self.lines)
+
+    def read(self, offset=0, limit=500):
+        """Đọc một trang log (gồm cả phần trên đĩa) bắt đầu từ dòng `offset`."""
+        lines = []
+        if offset < self.spilled:
+            lines = read_spilled(self.path, offset, min(limit, self.spilled - offset))
+        if len(lines) < limit:
+            start = max(0, offset - self.spilled)
+            lines += self.lines[start:start + limit - len(lines)]
+        return {"offset": offset, "lines": lines, "total": len(self)}
+
+
+def read_spilled(path, offset=0, limit=500):
+    """Đọc `limit` dòng từ file log gzip, bắt đầu từ dòng `offset`."""
+    path = Path(path)
+    if not path.exists() or limit <= 0:
+        return []
+    lines = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i < offset:
+                continue
+            lines.append(line.rstrip("\n"))
+            if len(lines) >= limit:
+                break
+    return lines
@@ -0,0 +1,82 @@
+import threading
+
+from task_versions import add_listener
+
+# --- TÓM TẮT TASK CHO TRANG ADMIN ---
+# Bản tóm tắt nhỏ (không log, không items) được cập nhật ngay mỗi lần task đổi,
+# nên trang admin không phải copy toàn bộ task ở mỗi lần tải.
+SUMMARY_FIELDS = ("id", "user", "type", "resolution", "status", "queue_position", "account",
+                  "completed", "errors", "total", "progress", "created_at", "version")
+
+
+def summarize(task):
+    return {k: task.get(k) for k in SUMMARY_FIELDS}
+
+
+def _stat_bucket(status):
+    status = status or ""
+    if status in ("Running", "Initializing"):
+        return "running"
+    if status == "Finished":
+        return "finished"
+    if status == "Stopped" or status.startswith("Error"):
+        return "error"
+    return None
+
+
+def user_stats(summaries, teams=None):
+    """
+    {username: {team, total, running, finished, error}} từ danh sách tóm tắt. teams
+    ({username: team}) cho mọi user: user chưa có task nào vẫn có dòng với số 0.
+    """
+    stats = {
+        username: {"team": team, "total": 0, "running": 0, "finished": 0, "error": 0}
+        for username, team in (teams or {}).items()
+    }
+    for s in summaries:
+        entry = stats.setdefault(s["user"], {"team": None, "total": 0, "running": 0, "finished": 0, "error": 0})
+        entry["total"] += 1
+        bucket = _stat_bucket(s.get("status"))
+        if bucket:
+            entry[bucket] += 1
+    return stats
+
+
+def query_summaries(summaries, user=None, status=None, q=None, limit=50, offset=0):
+    """Lọc + phân trang (mới nhất trước). status khớp tiền tố (vd "Error")."""
+    rows = [
+        s for s in summaries
+        if (not user or s["user"] == user)
+        and (not status or (s.get("status") or "").startswith(status))
+        and (not q or q in s["id"] or q in (s["user"] or ""))
+    ]
+    rows.sort(key=lambda s: s.get("created_at") or "", reverse=True)
+    return {"total": len(rows), "tasks": rows[offset:offset + limit]}
+
+
+class TaskSummaryIndex:
+    """Giữ bản tóm tắt của mọi task trong ACTIVE_TASKS, cập nhật qua listener của task_versions."""
+    def __init__(self):
+        self._summaries = {}
+        self._lock = threading.Lock()
+        add_listener(self._on_task_changed)
+
+    def _on_task_changed(self, task):
+        task_id = task.get("id")
+        if task_id:
+            summary = summarize(task)
+            with self._lock:
+                # Listener có thể được gọi lệch thứ tự giữa các thread: giữ bản version mới hơn
+                current = self._summaries.get(task_id)
+                if current is None or (current.get("version") or 0) <= (summary.get("version") or 0):
+                    self._summaries[task_id] = summary
+
+    def all(self, tasks_db):
+        """Tóm tắt các task còn trong tasks_db (task đã chuyển sang kho thì bỏ)."""
+        with self._lock:
+            for task_id in [t for t in self._summaries if t not in tasks_db]:
+                del self._summaries[task_id]
+            return list(self._summaries.values())
+
+
+TASK_SUMMARIES = TaskSummaryIndex()
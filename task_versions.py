@@ -0,0 +1,187 @@
+import uuid
+import itertools
+import threading
+
+# --- VERSION CHO TASK (DÙNG CHO API DELTA) ---
+# Mỗi lần task thay đổi, task["version"] nhận một số tăng dần toàn cục và
+# task["field_versions"] ghi lại version của từng trường (hoặc từng item: "items.3").
+# Client gửi lại cursor đã thấy, server chỉ trả các trường có version lớn hơn.
+#
+# Copy-on-write: dict task trong tasks_db KHÔNG bao giờ bị sửa tại chỗ. Mỗi lần
+# cập nhật tạo một bản mới (items là tuple các dict mới) rồi thay vào tasks_db,
+# nên thread đang đọc / json.dumps bản cũ không cần khoá và không thấy dữ liệu dở dang.
+# Riêng "log" là TaskLog dùng chung giữa các bản (tự khoá bên trong, chỉ ghi nối).
+#
+# Bộ đếm chỉ sống trong tiến trình leader: khởi động lại hay đổi leader thì đếm lại từ 1.
+# Vì vậy cursor gửi cho client có dạng "<epoch>:<n>"; epoch khác với epoch hiện tại nghĩa
+# là version đã bị đánh lại từ đầu và client phải nhận lại toàn bộ.
+
+EPOCH = uuid.uuid4().hex[:12]
+_counter = itertools.count(1)
+_current = 0
+_lock = threading.Lock()
+_listeners = []
+
+# Các trường nội bộ không gửi cho client
+_HIDDEN_FIELDS = {"stop_flag", "field_versions", "version"}
+
+
+def _publish(tasks_db, task_id, task, fields):
+    """(Giữ _lock) Gắn version cho các trường vừa đổi rồi thay bản chụp vào tasks_db."""
+    global _current
+    version = next(_counter)
+    versions = dict(task.get("field_versions") or {})
+    for field in fields:
+        versions[str(field)] = version
+    task["field_versions"] = versions
+    task["version"] = version
+    _current = version
+    tasks_db[task_id] = task
+
+
+def _notify(task):
+    for listener in _listeners:
+        listener(task)
+
+
+def create_task(tasks_db, task_id, task):
+    """Đưa task mới (hoặc dựng lại) vào tasks_db, mọi trường đều được đánh version."""
+    task = dict(task)
+    if "items" in task:
+        task["items"] = tuple(dict(item) for item in task["items"])
+    with _lock:
+        _publish(tasks_db, task_id, task, task.keys())
+    _notify(task)
+    return task
+
+
+def update_task(tasks_db, task_id, changes=None, items=None, remove=(), touched=()):
+    """
+    Cập nhật task theo kiểu copy-on-write. Trả về bản mới, None nếu task không còn
+    (vd. đã chuyển sang kho lưu trữ).
+    - changes: {trường: giá trị mới}
+    - items: {idx: {trường: giá trị}} chỉ thay các item đó
+    - remove: các trường bị xoá
+    - touched: trường đã đổi bên trong đối tượng tự khoá (vd. "log" sau log.append)
+    """
+    with _lock:
+        old = tasks_db.get(task_id)
+        if old is None:
+            return None
+        task = dict(old)
+        fields = list(touched)
+        for key, value in (changes or {}).items():
+            task[key] = value
+            fields.append(key)
+        for key in remove:
+            if key in task:
+                del task[key]
+                fields.append(key)
+        if items:
+            new_items = list(task.get("items") or ())
+            for idx, item_changes in items.items():
+                if 0 <= idx < len(new_items):
+                    new_items[idx] = dict(new_items[idx], **item_changes)
+                    fields.append(f"items.{idx}")
+            task["items"] = tuple(new_items)
+        if not fields:
+            return old
+        _publish(tasks_db, task_id, task, fields)
+    _notify(task)
+    return task
+
+
+def add_listener(fn):
+    """Đăng ký fn(task) được gọi với bản task mới sau mỗi lần cập nhật (vd. đẩy sự kiện SSE)."""
+    _listeners.append(fn)
+
+
+def current_cursor():
+    """Cursor "<epoch>:<version mới nhất>" của tiến trình này."""
+    with _lock:
+        return f"{EPOCH}:{_current}"
+
+
+def parse_cursor(cursor):
+    """(epoch, version) từ cursor client gửi lên. Cursor rỗng / sai dạng / kiểu số cũ -> epoch None."""
+    epoch, _, number = str(cursor or "").rpartition(":")
+    try:
+        return epoch or None, max(0, int(number))
+    except ValueError:
+        return None, 0
+
+
+def resolve_since(since, cursor):
+    """
+    Version để tính delta cho client đã thấy `since`, khi cursor hiện tại là `cursor`.
+    0 (gửi lại toàn bộ) nếu client mới, khác epoch (server khởi động lại / đổi leader)
+    hoặc đứng trước cả server.
+    """
+    epoch, number = parse_cursor(since)
+    current_epoch, current = parse_cursor(cursor)
+    if epoch is None or epoch != current_epoch or number > current:
+        return 0
+    return number
+
+
+def _plain(value):
+    """Bản sao JSON-safe (datetime, Event... thành str) của một giá trị trong task."""
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def task_delta(task, since, log_offset=0, summary=False):
+    """
+    Phần thay đổi của một task kể từ cursor `since`.
+    Trả về None nếu không có gì mới. Task client chưa biết (since=0 hoặc
+    task tạo sau cursor) thì trả về đầy đủ. summary=True bỏ log và items.
+    """
+    if task.get("version", 0) <= since and since:
+        return None
+
+    versions = task.get("field_versions") or {}
+    # Task được tạo sau cursor (client mới chỉ có bản tạm) -> gửi đầy đủ
+    full = not since or not versions or versions.get("user", 0) > since
+
+    delta = {"id": task.get("id"), "version": task.get("version", 0)}
+    for key, value in list(task.items()):
+        if key in _HIDDEN_FIELDS or key in ("log", "items"):
+            continue
+        if full or versions.get(key, 0) > since:
+            delta[key] = _plain(value)
+    # Trường đã bị xoá (vd. queue_position) -> gửi null để client bỏ đi
+    for key, version in list(versions.items()):
+        if version > since and key not in task and "." not in key and key not in ("log", "items"):
+            delta[key] = None
+
+    if summary:
+        # Chỉ log/items đổi thì bản tóm tắt không có gì mới
+        return delta if len(delta) > 2 else None
+
+    # Log: chỉ gửi các dòng sau offset client đã có (phần còn trong RAM của TaskLog)
+    log = task.get("log")
+    if log is not None:
+        log_offset = 0 if full else max(0, min(log_offset, len(log)))
+        start, lines = log.since(log_offset)
+        if lines:
+            delta["log_offset"] = start
+            delta["log"] = lines
+
+    # Items: cả danh sách nếu vừa khởi tạo lại, còn lại chỉ các item đổi trạng thái
+    items = task.get("items", [])
+    if full or versions.get("items", 0) > since:
+        delta["items"] = _plain(items)
+    else:
+        changed = {}
+        for idx, item in enumerate(list(items)):
+            if versions.get(f"items.{idx}", 0) > since:
+                changed[str(idx)] = _plain(item)
+        if changed:
+            delta["item_updates"] = changed
+
+    return delta
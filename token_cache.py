@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+from browser_pool import cookies_key
+
+# --- CẤU HÌNH CACHE TOKEN ---
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", "900"))
+# Cache cả kết quả "không lấy được token" trong thời gian ngắn để tránh mở browser liên tục
+TOKEN_CACHE_NEGATIVE_TTL = int(os.environ.get("TOKEN_CACHE_NEGATIVE_TTL", "60"))
+
+
+class TokenCache:
+    """
+    Cache Bearer token theo hash của bộ cookie, có TTL và single-flight:
+    nhiều request cùng lúc chỉ chạy loader (browser) đúng một lần.
+    """
+    def __init__(self, ttl=TOKEN_CACHE_TTL, negative_ttl=TOKEN_CACHE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}   # key -> (token, expires_at)
+        self._inflight = {}  # key -> threading.Event
+        self._lock = threading.Lock()
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.time():
+            return entry
+        return None
+
+    def peek(self, cookies):
+        """Trả về token còn hạn trong cache (không gọi loader)."""
+        with self._lock:
+            entry = self._fresh(cookies_key(cookies))
+            return entry[0] if entry else None
+
+    def get(self, cookies, loader):
+        """Lấy token từ cache, hoặc gọi loader(cookies) nếu hết hạn (chỉ một thread gọi)."""
+        if not cookies:
+            return None
+        key = cookies_key(cookies)
+        while True:
+            with self._lock:
+                entry = self._fresh(key)
+                if entry:
+                    return entry[0]
+                event = self._inflight.get(key)
+                is_leader = event is None
+                if is_leader:
+                    event = threading.Event()
+                    self._inflight[key] = event
+
+            if not is_leader:
+                event.wait()
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry:
+                        return entry[0]
+                continue
+
+            token = None
+            try:
+                token = loader(cookies)
+            finally:
+                with self._lock:
+                    ttl = self.ttl if token else self.negative_ttl
+                    self._entries[key] = (token, time.time() + ttl)
+                    self._inflight.pop(key, None)
+                event.set()
+            return token
+
+    def put(self, cookies, token):
+        """Lưu token mà worker đã bắt được từ trang của nó."""
+        if not cookies or not token:
+            return
+        with self._lock:
+            self._entries[cookies_key(cookies)] = (token, time.time() + self.ttl)
+
+    def invalidate(self, cookies=None):
+        """Xoá token của một bộ cookie, hoặc toàn bộ cache nếu cookies=None."""
+        with self._lock:
+            if cookies is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(cookies_key(cookies), None)
+
+    def invalidate_token(self, token):
+        """Xoá mọi entry đang giữ token này (dùng khi gặp 401)."""
+        if not token:
+            return
+        with self._lock:
+            for key in [k for k, v in self._entries.items() if v[0] == token]:
+                self._entries.pop(key, None)
+
+
+TOKEN_CACHE = TokenCache()
@@ -0,0 +1,153 @@
+import os
+import re
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:   # Không có Pillow: worker dùng ảnh gốc như trước
+    Image = None
+
+# --- CẤU HÌNH KHO ẢNH UPLOAD (I2V) ---
+UPLOAD_DIR = Path(os.environ.get("UPLOAD_DIR", "storage/uploads"))
+# Kích thước tối đa (và tỉ lệ khung hình) của ảnh gửi lên Flow, vd. "1280x720" = 16:9
+I2V_TARGET_SIZE = os.environ.get("I2V_TARGET_SIZE", "1280x720")
+I2V_JPEG_QUALITY = int(os.environ.get("I2V_JPEG_QUALITY", "90"))
+UPLOAD_PREPARE_WORKERS = int(os.environ.get("UPLOAD_PREPARE_WORKERS", "1"))
+# Worker chờ ảnh đang được xử lý tối đa bấy nhiêu giây rồi dùng ảnh gốc
+UPLOAD_PREPARE_TIMEOUT = float(os.environ.get("UPLOAD_PREPARE_TIMEOUT", "60"))
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def _parse_size(text):
+    width, height = (int(v) for v in text.lower().split("x"))
+    return width, height
+
+
+class UploadStore:
+    """
+    Ảnh I2V lưu theo hash nội dung (sha256): cùng một ảnh upload nhiều lần / bởi nhiều
+    user chỉ giữ một file. Mỗi ảnh được cắt đúng tỉ lệ và thu nhỏ một lần ở thread nền
+    (prepared/), worker đẩy bản nhỏ đó lên Flow thay cho ảnh gốc.
+    """
+    def __init__(self, root=UPLOAD_DIR, target_size=I2V_TARGET_SIZE):
+        self.root = Path(root)
+        self.prepared_dir = self.root / "prepared"
+        self.target_size = _parse_size(target_size)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, UPLOAD_PREPARE_WORKERS),
+                                            thread_name_prefix="upload-prepare")
+        self._futures = {}   # tên ảnh -> Future đang xử lý
+        self._lock = threading.RLock()   # done_callback có thể chạy ngay trong lúc đang giữ lock
+        self.prepared_dir.mkdir(parents=True, exist_ok=True)
+
+    # --- LƯU ẢNH ---
+    def save(self, file):
+        """
+        Lưu một FileStorage của Flask. Trả về (tên file trong kho, True nếu ảnh đã có sẵn, tên
+        file gốc của user). Tên gốc không dùng làm đường dẫn, chỉ để đặt tên video đầu ra.
+        """
+        ext = Path(file.filename).suffix.lower()
+        ext = ".jpg" if ext == ".jpeg" else ext
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in iter(lambda: file.stream.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    out.write(chunk)
+            name = f"{digest.hexdigest()[:32]}{ext}"
+            target = self.root / name
+            existed = target.exists()
+            if existed:
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.prepare_async(name)
+        return name, existed, Path(file.filename.replace("\\", "/")).name
+
+    def resolve(self, name):
+        """Đường dẫn ảnh gốc. Nhận tên trong kho hoặc đường dẫn cũ (chỉ lấy phần tên file)."""
+        return self.root / Path(str(name)).name
+
+    def content_hash(self, name):
+        """Hash nội dung ảnh (tên file trong kho chính là hash; ảnh cũ thì đọc file để tính)."""
+        stem = Path(str(name)).stem
+        if re.fullmatch(r"[0-9a-f]{32}", stem):
+            return stem
+        digest = hashlib.sha256()
+        try:
+            with open(self.resolve(name), "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            return None
+        return digest.hexdigest()[:32]
+
+    # --- TIỀN XỬ LÝ ---
+    def _prepared_path(self, name):
+        width, height = self.target_size
+        return self.prepared_dir / f"{Path(str(name)).stem}_{width}x{height}.jpg"
+
+    def prepare_async(self, name):
+        """Đưa ảnh vào hàng xử lý nền (bỏ qua nếu đã có bản xử lý hoặc đang xử lý)."""
+        if Image is None or self._prepared_path(name).exists():
+            return None
+        with self._lock:
+            future = self._futures.get(name)
+            if future is None:
+                future = self._executor.submit(self._prepare, name)
+                self._futures[name] = future
+                future.add_done_callback(lambda _f: self._forget(name))
+            return future
+
+    def _forget(self, name):
+        with self._lock:
+            self._futures.pop(name, None)
+
+    def _prepare(self, name):
+        src, out = self.resolve(name), self._prepared_path(name)
+        width, height = self.target_size
+        with Image.open(src) as img:
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            # Cắt giữa ảnh theo tỉ lệ đích rồi thu nhỏ (không phóng to ảnh nhỏ)
+            if img.width * height > img.height * width:
+                crop_w = img.height * width // height
+                left = (img.width - crop_w) // 2
+                img = img.crop((left, 0, left + crop_w, img.height))
+            elif img.width * height < img.height * width:
+                crop_h = img.width * height // width
+                top = (img.height - crop_h) // 2
+                img = img.crop((0, top, img.width, top + crop_h))
+            img.thumbnail((width, height), Image.LANCZOS)
+            tmp = out.with_name(f"{out.stem}.{os.getpid()}.{threading.get_ident()}.part")
+            img.save(tmp, "JPEG", quality=I2V_JPEG_QUALITY, optimize=True)
+        os.replace(tmp, out)
+        return out
+
+    def prepared(self, name, timeout=UPLOAD_PREPARE_TIMEOUT):
+        """
+        Ảnh để đưa lên Flow: bản đã xử lý nếu có (chờ nếu đang xử lý), ngược lại ảnh gốc.
+        Ảnh cũ chưa qua kho (hoặc tiến trình khác nhận upload) được xử lý tại đây.
+        """
+        out = self._prepared_path(name)
+        if out.exists():
+            return out
+        future = self.prepare_async(name)
+        if future is None:
+            return self.resolve(name)
+        try:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            print(f"⚠️ Không xử lý được ảnh {name}, dùng ảnh gốc: {e}")
+            return self.resolve(name)
+
+
+UPLOADS = UploadStore()
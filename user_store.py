@@ -0,0 +1,231 @@
+import json
+from datetime import datetime
+from pathlib import Path
+from werkzeug.security import generate_password_hash
+
+from storage_db import get_connection, transaction, APP_DB_PATH
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT,
+    name TEXT,
+    team TEXT,
+    is_admin INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS history_entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    day TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    time TEXT,
+    status TEXT,
+    type TEXT,
+    resolution TEXT,
+    total INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_history_user_day ON history_entries(username, day);
+CREATE INDEX IF NOT EXISTS idx_history_task ON history_entries(task_id);
+CREATE TABLE IF NOT EXISTS history_items (
+    entry_id INTEGER NOT NULL REFERENCES history_entries(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    image TEXT,
+    prompt TEXT,
+    status TEXT,
+    file TEXT,
+    PRIMARY KEY (entry_id, idx)
+);
+"""
+
+_USER_FIELDS = ("password_hash", "name", "team", "is_admin", "created_at")
+
+
+def _user_row(row):
+    user = dict(row)
+    user["is_admin"] = bool(user["is_admin"])
+    return user
+
+
+class UserStore:
+    """
+    Lưu user và lịch sử chạy trong SQLite (WAL). Mỗi thay đổi chỉ ghi
+    đúng các dòng liên quan thay vì ghi lại toàn bộ users.json.
+    """
+    def __init__(self, db_path=APP_DB_PATH, legacy_json_path=None):
+        self.db_path = db_path
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        if legacy_json_path:
+            self.migrate_from_json(Path(legacy_json_path))
+        self._ensure_admin()
+
+    def _conn(self):
+        return get_connection(self.db_path)
+
+    # --- MIGRATION ---
+    def migrate_from_json(self, path):
+        """Nhập storage/users.json (định dạng cũ) vào DB, chỉ chạy một lần."""
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'users_json_imported'").fetchone():
+            return
+        if not path.exists():
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            legacy = json.load(f)
+
+        with transaction(conn):
+            # Tiến trình gunicorn khác có thể vừa nhập xong trong lúc ta chờ khoá ghi
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'users_json_imported'").fetchone():
+                return
+            for username, data in legacy.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (username, password_hash, name, team, is_admin, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (username, data.get("password_hash"), data.get("name"), data.get("team"),
+                     int(bool(data.get("is_admin"))), data.get("created_at"))
+                )
+                for day, entries in (data.get("history") or {}).items():
+                    for entry in entries:
+                        self._insert_entry(conn, username, day, entry)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('users_json_imported', ?)", (str(datetime.now()),))
+        print(f"Đã chuyển {len(legacy)} user từ {path} sang {self.db_path}.")
+
+    def _ensure_admin(self):
+        conn = self._conn()
+        if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]:
+            return
+        # Đếm lại sau khi giữ khoá ghi: nhiều tiến trình gunicorn cùng khởi động trên DB mới
+        with transaction(conn):
+            if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]:
+                return
+            self.create({
+                "username": "admin",
+                "password_hash": generate_password_hash("admin_pass123"),
+                "name": "Nguyễn Đức Thắng (Admin)",
+                "team": "Development",
+                "is_admin": True,
+                "created_at": str(datetime.now())
+            })
+
+    # --- USERS ---
+    def get(self, username):
+        if not username:
+            return None
+        row = self._conn().execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        return _user_row(row) if row else None
+
+    def exists(self, username):
+        return self._conn().execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+
+    def all(self):
+        return [_user_row(r) for r in self._conn().execute("SELECT * FROM users ORDER BY created_at, username")]
+
+    def teams(self):
+        """{username: team} của mọi user (chỉ hai cột, cho bảng thống kê của admin)."""
+        return {r["username"]: r["team"] for r in self._conn().execute("SELECT username, team FROM users ORDER BY created_at, username")}
+
+    def find(self, q=None, team=None, limit=50, offset=0):
+        """Một trang user (không kèm password_hash), lọc theo chuỗi tìm kiếm / team."""
+        where, args = [], []
+        if q:
+            where.append("(username LIKE ? OR name LIKE ?)")
+            args += [f"%{q}%", f"%{q}%"]
+        if team:
+            where.append("team = ?")
+            args.append(team)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM users {clause}", args).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT username, name, team, is_admin, created_at FROM users {clause} "
+            "ORDER BY created_at, username LIMIT ? OFFSET ?",
+            (*args, limit, offset)
+        ).fetchall()
+        return {"total": total, "users": [_user_row(r) for r in rows]}
+
+    def create(self, user):
+        self._conn().execute(
+            "INSERT INTO users (username, password_hash, name, team, is_admin, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user["username"], user.get("password_hash"), user.get("name"), user.get("team"),
+             int(bool(user.get("is_admin"))), user.get("created_at") or str(datetime.now()))
+        )
+
+    def update(self, username, **fields):
+        fields = {k: v for k, v in fields.items() if k in _USER_FIELDS}
+        if not fields:
+            return
+        if "is_admin" in fields:
+            fields["is_admin"] = int(bool(fields["is_admin"]))
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        self._conn().execute(f"UPDATE users SET {assignments} WHERE username = ?", (*fields.values(), username))
+
+    def delete(self, username):
+        self._conn().execute("DELETE FROM users WHERE username = ?", (username,))
+
+    # --- HISTORY ---
+    def _insert_entry(self, conn, username, day, entry):
+        cur = conn.execute(
+            "INSERT INTO history_entries (username, day, task_id, time, status, type, resolution, total) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (username, day, entry["task_id"], entry.get("time"), entry.get("status"),
+             entry.get("type", "N/A"), entry.get("resolution", "N/A"), entry.get("total", 0))
+        )
+        self._upsert_items(conn, cur.lastrowid, entry.get("items") or [])
+        return cur.lastrowid
+
+    def _upsert_items(self, conn, entry_id, items):
+        conn.executemany(
+            "INSERT INTO history_items (entry_id, idx, image, prompt, status, file) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(entry_id, idx) DO UPDATE SET status = excluded.status, file = excluded.file",
+            [(entry_id, i, it.get("image"), it.get("prompt"), it.get("status"), it.get("file", ""))
+             for i, it in enumerate(items)]
+        )
+
+    def record_history(self, username, day, task_info, new_entry=False):
+        """
+        Thêm/cập nhật một dòng lịch sử. Nếu đã có dòng cùng task_id trong ngày và
+        new_entry=False thì chỉ cập nhật status/time và các item thay đổi.
+        """
+        conn = self._conn()
+        with transaction(conn):
+            if not conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                return
+            row = None
+            if not new_entry:
+                row = conn.execute(
+                    "SELECT id FROM history_entries WHERE username = ? AND day = ? AND task_id = ? ORDER BY id LIMIT 1",
+                    (username, day, task_info["task_id"])
+                ).fetchone()
+            if row is None:
+                self._insert_entry(conn, username, day, task_info)
+            else:
+                conn.execute("UPDATE history_entries SET status = ?, time = ? WHERE id = ?",
+                             (task_info["status"], task_info["time"], row["id"]))
+                self._upsert_items(conn, row["id"], task_info.get("items") or [])
+
+    def history(self, username):
+        """Lịch sử theo ngày: {"YYYY-MM-DD": [entry, ...]} như định dạng cũ của users.json."""
+        conn = self._conn()
+        entries = conn.execute(
+            "SELECT * FROM history_entries WHERE username = ? ORDER BY id", (username,)
+        ).fetchall()
+        items_by_entry = {}
+        for it in conn.execute(
+            "SELECT i.* FROM history_items i JOIN history_entries e ON e.id = i.entry_id "
+            "WHERE e.username = ? ORDER BY i.entry_id, i.idx", (username,)
+        ):
+            items_by_entry.setdefault(it["entry_id"], []).append(
+                {"image": it["image"], "prompt": it["prompt"], "status": it["status"], "file": it["file"]}
+            )
+
+        history = {}
+        for e in entries:
+            history.setdefault(e["day"], []).append({
+                "task_id": e["task_id"], "time": e["time"], "status": e["status"],
+                "type": e["type"], "resolution": e["resolution"], "total": e["total"],
+                "items": items_by_entry.get(e["id"], [])
+            })
+        return history
@@ -1,12 +1,27 @@
+import os
 import json
 import time
-import requests
 import re
 import uuid
 import threading
 from pathlib import Path
-from playwright.sync_api import sync_playwright
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from playwright.sync_api import expect
 from playwright._impl._errors import TargetClosedError
+from browser_pool import create_pool, CookieError
+from token_cache import TOKEN_CACHE
+from account_pool import ACCOUNTS
+from downloads import DOWNLOADS
+from task_versions import create_task, update_task
+from task_log import TaskLog
+from task_journal import JOURNAL
+from upload_store import UPLOADS
+from result_cache import RESULT_CACHE, RESULT_CACHE_ENABLED, request_key, link_or_copy
+from inflight_registry import INFLIGHT
+from storage_catalog import STORAGE, KIND_VIDEO
+from status_poller import StatusPoller, STATUS_SUCCESSFUL, STATUS_FAILED, KIND_720P, KIND_UPSCALE, KIND_I2V
 
 # --- HẰNG SỐ CỦA WORKER ---
 FLOW_URL = "https://labs.google/fx/vi/tools/flow/project/447e27e0-fb0a-44b1-99f0-1624c028d6c4"
@@ -24,77 +39,208 @@ UPGRADE_BTN_TEXT = "Đã tăng độ phân giải (1080p)"
 CHECK_UPSCALE_URL = "batchAsyncUpscaleVideo" 
 LATEST_VIDEO_CARD_SELECTOR = 'div[role="list"] > div:nth-child(1) > div > div:nth-child(1)' 
 
+# Số video P2V tối đa được render cùng lúc trên một worker (1 = tuần tự như cũ)
+P2V_PIPELINE_DEPTH = int(os.environ.get("P2V_PIPELINE_DEPTH", "3"))
+# Giới hạn trên cho pipeline_depth do client gửi lên (mỗi video đang render giữ một job trên Flow)
+P2V_PIPELINE_DEPTH_MAX = int(os.environ.get("P2V_PIPELINE_DEPTH_MAX", "8"))
+
+# Số tab (browser trong pool) tối đa một task P2V được dùng song song
+P2V_PAGES_PER_TASK = int(os.environ.get("P2V_PAGES_PER_TASK", "1"))
+# Giới hạn trên cho pages_per_task do client gửi lên (một task không được chiếm hết pool)
+P2V_PAGES_PER_TASK_MAX = int(os.environ.get("P2V_PAGES_PER_TASK_MAX", "4"))
+
+# Khoảng cách tối thiểu (giây) giữa hai lần bấm Generate trên cùng một worker
+FLOW_MIN_SUBMIT_INTERVAL = float(os.environ.get("FLOW_MIN_SUBMIT_INTERVAL", "10"))
+
+# Token bị 401: thread poll chờ tối đa bấy nhiêu giây để page của worker lấy token mới
+TOKEN_REFRESH_TIMEOUT = float(os.environ.get("TOKEN_REFRESH_TIMEOUT", "60"))
+# Thời gian chờ request API đầu tiên (có header Bearer) sau khi tải lại trang
+TOKEN_CAPTURE_TIMEOUT = float(os.environ.get("TOKEN_CAPTURE_TIMEOUT", "30"))
+# Số lần một lần poll được lấy token mới rồi thử lại
+TOKEN_REFRESH_ATTEMPTS = int(os.environ.get("TOKEN_REFRESH_ATTEMPTS", "1"))
+
+# Pool browser dùng chung cho toàn tiến trình (xem browser_pool.py)
+BROWSER_POOL = create_pool(FLOW_URL)
+# Poller trạng thái dùng chung cho mọi task (xem status_poller.py)
+STATUS_POLLER = StatusPoller(CHECK_STATUS_URL)
+
 def sanitize_filename(s, maxlen=50):
     s = re.sub(r'[\\/:"*?<>|]+', '', s)
     s = re.sub(r'\s+', '_', s).strip('_')
     return s[:maxlen] or "video"
     
+def clamp_param(value, default, maximum):
+    """Tham số số nguyên của task (có thể từ journal cũ): sai kiểu thì dùng mặc định, kẹp trong [1, maximum]."""
+    try:
+        value = int(value or default)
+    except (TypeError, ValueError):
+        value = default
+    return min(maximum, max(1, value))
+
 def wait_for_generate_button(generate_locator, job_id, task_store, max_wait=60):
     task_store.log(f"⏳ [{job_id}] Đang chờ nút Generate được kích hoạt (max {max_wait}s)...")
-    start_wait = time.time()
     generate_locator.wait_for(state="visible", timeout=10000)
     
-    while not generate_locator.is_enabled() and time.time() - start_wait < max_wait:
-        time.sleep(1)
-    
-    if not generate_locator.is_enabled():
+    try:
+        expect(generate_locator).to_be_enabled(timeout=max_wait * 1000)
+    except AssertionError:
           raise Exception(f"Timeout {max_wait}s: Nút Generate vẫn bị vô hiệu hóa.")
           
     task_store.log(f"✅ [{job_id}] Nút Generate đã sẵn sàng.")
 
+def capture_token(page, timeout=TOKEN_CAPTURE_TIMEOUT):
+    """Tải lại trang đang mở và bắt header Bearer từ request API đầu tiên của trang (không mở browser mới)."""
+    found = []
+
+    def on_request(request):
+        auth = request.headers.get("authorization")
+        if not found and auth and auth.startswith("Bearer ") and "googleapis.com" in request.url:
+            found.append(auth)
+
+    page.on("request", on_request)
+    try:
+        page.reload(wait_until="domcontentloaded", timeout=timeout * 1000)
+        deadline = time.time() + timeout
+        while not found and time.time() < deadline:
+            page.wait_for_timeout(500)
+    finally:
+        page.remove_listener("request", on_request)
+    return found[0] if found else None
+
+class SubmitStopped(Exception):
+    """Task bị dừng ngay trước khi bấm Generate: item được đánh dấu Stopped, không tính lỗi."""
+
+
+class SubmitThrottle:
+    """
+    Giãn cách tối thiểu giữa hai lần bấm Generate (thay cho sleep cố định sau mỗi item).
+    Dùng chung cho mọi tab của một task: mỗi lần wait() giữ chỗ ngay (dưới lock) một mốc
+    thời gian riêng, nên các tab không cùng đọc một last_submit cũ rồi bấm cùng lúc.
+    """
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.last_submit = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, task_store):
+        """Chờ tới lượt bấm Generate. False nếu task bị dừng (không được bấm nữa)."""
+        with self._lock:
+            now = time.time()
+            slot = max(now, self.last_submit + self.min_interval)
+            self.last_submit = slot
+        remaining = slot - now
+        if remaining > 0:
+            task_store.log(f"⏳ Giãn cách {remaining:.0f}s trước lần Generate tiếp theo...")
+            task_store.stop_flag.wait(remaining)
+        return not task_store.stop_requested()
+
+    def mark(self):
+        """Response đã về: lần kế tiếp tính giãn cách từ lúc này (không lùi mốc đã giữ chỗ)."""
+        with self._lock:
+            self.last_submit = max(self.last_submit, time.time())
+
 # --- LỚP TASK STORE MỚI: Dùng để thay thế pyqtSignal ---
 class TaskStore:
-    def __init__(self, task_id, tasks_db, total_prompts, username, is_i2v, prompts_or_tasks, stop_flag_event):
+    """
+    Ghi trạng thái task vào tasks_db theo kiểu copy-on-write (task_versions.update_task):
+    người đọc luôn thấy một bản chụp hoàn chỉnh, không cần khoá.
+    Trong `with store.batch():` các thay đổi của thread hiện tại được gom lại và công bố một lần.
+    """
+    def __init__(self, task_id, tasks_db, total_prompts, username, is_i2v, prompts_or_tasks, stop_flag_event, resumed_items=None, image_names=None):
         self.task_id = task_id
         self.tasks_db = tasks_db
         self.total_prompts = total_prompts
         self.username = username
         self.is_i2v = is_i2v
         self.prompts_or_tasks = prompts_or_tasks
+        self.image_names = image_names or []
         self.stop_flag = stop_flag_event 
-        self.init_status()
+        self._local = threading.local()
+        self.init_status(resumed_items)
         
-    def init_status(self):
+    def init_status(self, resumed_items=None):
         initial_items = []
-        for item in self.prompts_or_tasks:
+        for idx, item in enumerate(self.prompts_or_tasks):
             if self.is_i2v and isinstance(item, list) and len(item) == 2:
-                initial_items.append({"image": item[0].split('/')[-1], "prompt": item[1], "status": "Pending", "file": ""}) # Pending
+                image = item[0].split('/')[-1]
+                image_name = self.image_names[idx] if idx < len(self.image_names) else image
+                initial_items.append({"image": image, "image_name": image_name, "prompt": item[1], "status": "Pending", "file": ""}) # Pending
             elif not self.is_i2v and isinstance(item, str):
                 initial_items.append({"prompt": item, "status": "Pending", "file": ""}) # Pending
             else:
                  initial_items.append({"prompt": "N/A (Lỗi khởi tạo item)", "status": "Error", "file": ""})
+        # Task được khôi phục từ nhật ký: giữ trạng thái các item đã chạy trước khi khởi động lại
+        for item, resumed in zip(initial_items, resumed_items or []):
+            item.update(status=resumed["status"], file=resumed.get("file", ""))
 
         if self.task_id in self.tasks_db:
-             self.tasks_db[self.task_id].update({
+             update_task(self.tasks_db, self.task_id, {
                 "status": "Running",
                 "total": self.total_prompts,
-                "items": initial_items
+                "items": tuple(initial_items)
              })
         else:
-             self.tasks_db[self.task_id] = {
-                 "status": "Running", "total": self.total_prompts, "items": initial_items,
+             log = TaskLog(self.task_id)
+             log.append("WARNING: TaskStore initialized late.")
+             create_task(self.tasks_db, self.task_id, {
+                 "id": self.task_id, "status": "Running", "total": self.total_prompts, "items": initial_items,
                  "user": self.username, "progress": 0, "completed": 0, "errors": 0,
-                 "log": ["WARNING: TaskStore initialized late."], "stop_flag": self.stop_flag
-             }
-        
+                 "log": log, "stop_flag": self.stop_flag
+             })
+
+    # --- GHI (gom theo batch) ---
+    def _commit(self, changes=None, items=None, touched=()):
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            update_task(self.tasks_db, self.task_id, changes, items, touched=touched)
+            return
+        pending["changes"].update(changes or {})
+        for idx, item_changes in (items or {}).items():
+            pending["items"].setdefault(idx, {}).update(item_changes)
+        pending["touched"].update(touched)
+
+    @contextmanager
+    def batch(self):
+        """Gom mọi thay đổi trong khối thành một bản chụp mới (lồng nhau thì dùng batch ngoài cùng)."""
+        if getattr(self._local, "pending", None) is not None:
+            yield
+            return
+        self._local.pending = {"changes": {}, "items": {}, "touched": set()}
+        try:
+            yield
+        finally:
+            pending, self._local.pending = self._local.pending, None
+            update_task(self.tasks_db, self.task_id, pending["changes"], pending["items"], touched=pending["touched"])
+
     def log(self, text):
         ts = time.strftime("%H:%M:%S")
-        self.tasks_db[self.task_id]["log"].append(f"[{ts}] {text}")
+        task = self.tasks_db.get(self.task_id)
+        if task is None:
+            return
+        task["log"].append(f"[{ts}] {text}")
+        self._commit(touched=("log",))
         
-    def update_item_status(self, item_index, status, file_path=""):
-        if item_index < len(self.tasks_db[self.task_id]["items"]):
+    def update_item_status(self, item_index, status, file_path="", **extra):
+        task = self.tasks_db.get(self.task_id)
+        if task is not None and item_index < len(task["items"]):
             # Chuẩn hóa trạng thái English cho Frontend dễ xử lý
             if "Hoàn thành" in status: status = "Finished"
             elif "Đang xử lý" in status: status = "Running"
             elif "Lỗi" in status: status = "Error"
             elif "Tạm dừng" in status: status = "Stopped"
                 
-            self.tasks_db[self.task_id]["items"][item_index]["status"] = status
-            self.tasks_db[self.task_id]["items"][item_index]["file"] = file_path
+            self._commit(items={item_index: {"status": status, "file": file_path, **extra}})
+
+            if status == "Finished":
+                JOURNAL.record(self.task_id, "downloaded", item_index, file=file_path)
+            elif status.startswith("Error"):
+                JOURNAL.record(self.task_id, "failed", item_index)
+
+    def record_operation(self, item_index, operation_id, job_id, kind, auth_token):
+        """Ghi nhật ký item đã gửi lên server (để poll tiếp nếu tiến trình khởi động lại)."""
+        JOURNAL.record(self.task_id, "submitted", item_index, op_id=operation_id, job_id=job_id, kind=kind, token=auth_token)
         
     def update_progress(self, completed, errors):
-        self.tasks_db[self.task_id]["completed"] = completed
-        self.tasks_db[self.task_id]["errors"] = errors
         pending = self.total_prompts - completed - errors
         
         if pending < 0: pending = 0 
@@ -104,63 +250,72 @@ class TaskStore:
         else:
             progress_percent = int((completed / self.total_prompts) * 100)
             
-        self.tasks_db[self.task_id]["progress"] = progress_percent
+        self._commit({"completed": completed, "errors": errors, "progress": progress_percent})
         
     def set_final_status(self, status):
-        self.tasks_db[self.task_id]["status"] = status
+        self._commit({"status": status})
         
     def stop_requested(self):
         return self.stop_flag.is_set()
 
-# --- HÀM POLLING CHUNG (Giữ nguyên) ---
-def poll_status(auth_token, operation_id, job_id, task_store):
+# --- HÀM POLLING CHUNG (dùng STATUS_POLLER gom request của mọi task) ---
+def poll_status(auth_token, operation_id, job_id, task_store, kind=KIND_720P, token_source=None):
+    """
+    Chờ operation xong và trả về video URL. Gặp 401 thì xin token mới từ token_source
+    (worker, xem BaseWorker.refresh_token) rồi poll lại thay vì bỏ item.
+    """
     video_url = None
+    refreshes = 0
     poll_start = time.time()
     log_interval = 30
     last_log_time = time.time()
+    # Deadline lấy từ thời gian hoàn thành quan sát được của loại job này
+    deadline = STATUS_POLLER.policy.deadline(kind)
+    pending = STATUS_POLLER.submit(operation_id, auth_token, kind)
     
-    while time.time() - poll_start < 300 and not task_store.stop_requested():
-        try:
-            headers = {"Content-Type": "application/json"}
-            if auth_token:
-                headers["Authorization"] = auth_token
-                
-            resp = requests.post(
-                CHECK_STATUS_URL,
-                json={"operations": [{"operation": {"name": operation_id}}]},
-                headers=headers
-            )
-            resp.raise_for_status()
-            result = resp.json()
-
-            status = result.get("operations", [{}])[0].get("status")
-            if status == "MEDIA_GENERATION_STATUS_SUCCESSFUL":
-                try:
-                    video_url = result["operations"][0]["operation"]["metadata"]["video"]["fifeUrl"]
-                    task_store.log(f"🎬 [{job_id}] Hoàn thành, đã có video URL.")
-                    return video_url
-                except KeyError as e:
-                    raise Exception(f"Lỗi trích xuất URL từ JSON phản hồi: {e}")
+    try:
+        while time.time() - poll_start < deadline and not task_store.stop_requested():
+            if not pending.wait(timeout=1):
+                if token_source is not None:
+                    token_source.service_token_refresh()
+                if time.time() - last_log_time > log_interval:
+                    task_store.log(f"⏳ [{job_id}] Đang chờ... Status: {pending.status}")
+                    last_log_time = time.time()
+                continue
+
+            if pending.error is not None:
+                task_store.log(f"⚠️ [{job_id}] Lỗi khi kiểm tra trạng thái: {pending.error}")
+                if "401 Client Error" in str(pending.error):
+                    TOKEN_CACHE.invalidate_token(auth_token)
+                    ACCOUNTS.report_401(getattr(token_source, "account", None), token=auth_token)
+                    new_token = None
+                    if token_source is not None and refreshes < TOKEN_REFRESH_ATTEMPTS:
+                        new_token = token_source.refresh_token(auth_token)
+                    if new_token:
+                        refreshes += 1
+                        task_store.log(f"🔄 [{job_id}] Đã có token mới, kiểm tra lại trạng thái.")
+                        STATUS_POLLER.cancel(pending)
+                        auth_token = new_token
+                        pending = STATUS_POLLER.submit(operation_id, auth_token, kind)
+                        continue
+                    task_store.log(f"🚫 [{job_id}] Lỗi 401: Token đã hết hạn và không lấy được token mới.")
+                break
+
+            if pending.status == STATUS_SUCCESSFUL:
+                video_url = pending.video_url()
+                task_store.log(f"🎬 [{job_id}] Hoàn thành, đã có video URL.")
+                return video_url
                     
-            elif status == "MEDIA_GENERATION_STATUS_FAILED":
+            if pending.status == STATUS_FAILED:
                 raise Exception("Tác vụ tạo video đã thất bại trên server.")
-            
-            if time.time() - last_log_time > log_interval:
-                task_store.log(f"⏳ [{job_id}] Đang chờ... Status: {status}")
-                last_log_time = time.time()
-                
-        except Exception as poll_e:
-            task_store.log(f"⚠️ [{job_id}] Lỗi khi kiểm tra trạng thái: {poll_e}")
-            if "401 Client Error" in str(poll_e):
-                task_store.log("🚫 Lỗi 401: Token đã hết hạn. Vui lòng chạy lại ứng dụng để lấy token mới.")
-            break
-        time.sleep(5)
+    finally:
+        STATUS_POLLER.cancel(pending)
         
     if task_store.stop_requested():
         raise Exception("Tác vụ bị dừng bởi người dùng.")
 
     if not video_url:
-        raise Exception("Timeout, không thể lấy được video URL sau 5 phút.")
+        raise Exception(f"Timeout, không thể lấy được video URL sau {int(deadline)} giây.")
     return video_url
 
 
@@ -171,9 +326,16 @@ class BaseWorker(threading.Thread):
         self.task_id = task_id
         self.is_i2v = is_i2v
         self.prompts_or_tasks = params['prompts'] if not is_i2v else params['tasks']
+        self.image_names = []
+        if is_i2v:
+            # Task I2V: [tên ảnh trong kho, prompt] hoặc [tên ảnh trong kho, prompt, tên file gốc]
+            tasks = self.prompts_or_tasks
+            self.image_names = [Path(str(task[2])).name if len(task) > 2 and task[2] else Path(task[0]).name for task in tasks]
+            self.prompts_or_tasks = [[task[0], task[1]] for task in tasks]
         
         self.save_dir = Path(params['save_dir']) 
         self.cookies = params['cookies']
+        self.account = params.get('account')   # tên tài khoản Flow do scheduler phân
         self.resolution = params['resolution']
         self.username = params['username']
         
@@ -182,9 +344,33 @@ class BaseWorker(threading.Thread):
         self.error_prompts = 0
         self.pending_errors = []
         self.auth_token = None
+        self.submit_throttle = SubmitThrottle(FLOW_MIN_SUBMIT_INTERVAL)
+        self._counter_lock = threading.Lock()
+        self._downloads_cond = threading.Condition()
+        self._downloads_pending = 0
+        self._account_jobs = set()   # idx đang tính vào inflight_jobs của tài khoản
+        use_cache = params.get('use_cache')
+        self.use_cache = RESULT_CACHE_ENABLED if use_cache is None else bool(use_cache)
+        self._led = {}         # idx -> khoá yêu cầu mà item này là leader (xem inflight_registry.py)
+        self._following = {}   # idx -> (khoá, callback) của item đang chờ leader, bảo vệ bởi _downloads_cond
+
+        # Làm mới token khi gặp 401 (chỉ thread giữ page chính mới thao tác được page)
+        self._token_cond = threading.Condition()
+        self._refresh_wanted = False
+        self._page = None
+        self._page_thread = None
+        self._circuit_open = False   # cookie chết thật: dừng gửi item mới, item còn lại lỗi ngay
         
+        # Task khôi phục sau khi khởi động lại (xem task_journal.py)
+        self.resume = params.get('resume') or {}
+        self._resumed_threads = []
+        resumed_items = self.resume.get('items')
+        if resumed_items:
+            self.completed_prompts = sum(1 for it in resumed_items if it['status'] == "Finished")
+            self.error_prompts = sum(1 for it in resumed_items if it['status'].startswith("Error"))
+
         stop_event = tasks_db[task_id]['stop_flag']
-        self.task_store = TaskStore(task_id, tasks_db, self.total_prompts, self.username, self.is_i2v, self.prompts_or_tasks, stop_event)
+        self.task_store = TaskStore(task_id, tasks_db, self.total_prompts, self.username, self.is_i2v, self.prompts_or_tasks, stop_event, resumed_items, self.image_names)
         
         
     def _upscale_and_download(self, page, original_filename_prefix, job_id, original_op_id):
@@ -202,25 +388,22 @@ class BaseWorker(threading.Thread):
             
             video_card_locator.click()
             self.task_store.log(f"▶️ [{job_id}] Đã click mở video mới nhất.")
-            time.sleep(5) 
             
-            # 2. Click nút có selector đặc biệt
+            # 2. Click nút có selector đặc biệt (chờ nút xuất hiện khi trình xem video mở ra)
             try:
-                page.locator(RADIX_BTN_SELECTOR).wait_for(timeout=15000)
+                page.locator(RADIX_BTN_SELECTOR).wait_for(state="visible", timeout=20000)
                 page.locator(RADIX_BTN_SELECTOR).click()
                 self.task_store.log(f"⚙️ [{job_id}] Đã click nút Tùy chỉnh ({RADIX_BTN_SELECTOR}).")
-                time.sleep(3) 
             except Exception as e:
                 self.task_store.log(f"⚠️ [{job_id}] Lỗi: Không tìm thấy nút Tùy chỉnh. {e}")
                 raise Exception("Cannot find Radix button, aborting upscale.")
                 
             # 3. Click nút tăng độ phân giải (1080p) và lắng nghe phản hồi API mới
             with page.expect_response(lambda resp: CHECK_UPSCALE_URL in resp.url, timeout=120000) as response_info:
-                page.locator(f'text="{UPGRADE_BTN_TEXT}"').wait_for(timeout=10000)
+                page.locator(f'text="{UPGRADE_BTN_TEXT}"').wait_for(state="visible", timeout=15000)
                 page.locator(f'text="{UPGRADE_BTN_TEXT}"').click()
                 self.task_store.log(f"🚀 [{job_id}] Đã kích hoạt tăng độ phân giải (1080p).")
 
-            time.sleep(10) 
             upscale_response = response_info.value
             upscale_data = upscale_response.json()
             
@@ -228,13 +411,13 @@ class BaseWorker(threading.Thread):
             self.task_store.log(f"🔑 [{job_id}] Operation ID Upscale: {upscale_op_id}")
 
             # 4. Polling cho tác vụ Upscaling
-            new_video_url = poll_status(self.auth_token, upscale_op_id, f"{job_id}_1080p", self.task_store)
+            new_video_url = poll_status(self.auth_token, upscale_op_id, f"{job_id}_1080p", self.task_store, kind=KIND_UPSCALE, token_source=self)
             video_url = new_video_url
             
             # 5. Đóng giao diện xem video để chuẩn bị cho tác vụ tiếp theo (Click ESC)
             try:
                 page.keyboard.press("Escape")
-                time.sleep(2)
+                page.locator(RADIX_BTN_SELECTOR).wait_for(state="hidden", timeout=5000)
             except:
                 pass
             
@@ -247,6 +430,498 @@ class BaseWorker(threading.Thread):
             
         return video_url, filename
 
+    # --- TẢI CỦA TÀI KHOẢN (để scheduler chọn tài khoản ít việc nhất) ---
+    def _job_started(self, idx):
+        if self.account:
+            with self._counter_lock:
+                self._account_jobs.add(idx)
+            ACCOUNTS.job_started(self.account)
+
+    def _job_done(self, idx):
+        with self._counter_lock:
+            if idx not in self._account_jobs:
+                return
+            self._account_jobs.discard(idx)
+        ACCOUNTS.job_finished(self.account)
+
+    def release_account_jobs(self):
+        """Gọi khi worker đã kết thúc: trả lại các job chưa được đóng (vd. bị dừng giữa chừng)."""
+        with self._counter_lock:
+            leftover, self._account_jobs = len(self._account_jobs), set()
+        for _ in range(leftover):
+            ACCOUNTS.job_finished(self.account)
+
+    def _save_token(self, token):
+        TOKEN_CACHE.put(self.cookies, token)
+        ACCOUNTS.record_token(self.account, token)
+
+    # --- LÀM MỚI TOKEN KHI GẶP 401 ---
+    def _bind_page(self, page):
+        """Gọi trên thread sở hữu page chính: page này sẽ được dùng để lấy token mới."""
+        self._page = page
+        self._page_thread = threading.current_thread()
+
+    def _unbind_page(self):
+        with self._token_cond:
+            self._page = None
+            self._page_thread = None
+            self._token_cond.notify_all()
+
+    def _fresh_token(self, stale_token):
+        """Token khác token vừa bị 401: của worker (thread khác đã làm mới) hoặc trong cache dùng chung."""
+        if self.auth_token and self.auth_token != stale_token:
+            return self.auth_token
+        cached = TOKEN_CACHE.peek(self.cookies)
+        if cached and cached != stale_token:
+            self.auth_token = cached
+            return cached
+        return None
+
+    def refresh_token(self, stale_token):
+        """
+        Trả về token mới thay cho stale_token, None nếu không lấy được.
+        Thread giữ page tự tải lại trang để bắt token; thread khác yêu cầu rồi chờ thread đó.
+        Chưa có page (task khôi phục đang poll tiếp, worker đang chờ browser): mượn tạm
+        một browser của pool. Circuit breaker chỉ mở khi đã thực sự thử lấy token mà thất bại.
+        """
+        if self._circuit_open:
+            return None
+        if threading.current_thread() is self._page_thread:
+            return self._refresh_on_page(stale_token)
+
+        deadline = time.time() + TOKEN_REFRESH_TIMEOUT
+        with self._token_cond:
+            while not self._circuit_open:
+                fresh = self._fresh_token(stale_token)
+                if fresh:
+                    return fresh
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._page_thread is None:
+                    break
+                self._refresh_wanted = True
+                self._token_cond.wait(min(remaining, 1))
+            if self._circuit_open:
+                return None
+            fresh = self._fresh_token(stale_token)
+            no_page = self._page_thread is None
+        if fresh or not no_page:
+            # Có page mà hết thời gian chờ: lượt tải lại trang (nếu thất bại) đã tự mở circuit breaker
+            return fresh
+        return self._refresh_via_pool(stale_token, max(1, deadline - time.time()))
+
+    def _refresh_via_pool(self, stale_token, timeout):
+        """
+        Mượn một browser của pool để bắt token mới. Không đi qua TOKEN_CACHE.get: không có
+        browser rảnh thì chưa thử gì cả, không được để lại kết quả "không có token" trong cache
+        (probe_account sẽ đọc nhầm thành cookie chết). Lấy được token mới thì mới TOKEN_CACHE.put.
+        """
+        token, reason, attempted = None, "Tải lại trang vẫn không có token mới", False
+        cached = TOKEN_CACHE.peek(self.cookies)
+        if cached and cached != stale_token:
+            token = cached   # thread / task khác vừa lấy được token mới cho bộ cookie này
+        else:
+            try:
+                lease = BROWSER_POOL.lease(self.cookies, cancel=self.task_store.stop_requested, timeout=timeout)
+                if lease is not None:
+                    attempted = True
+                    self.task_store.log("🔄 Token hết hạn, đang lấy token mới bằng một trình duyệt của pool...")
+                    with lease:
+                        token = lease.run(capture_token)
+                    if token:
+                        TOKEN_CACHE.put(self.cookies, token)
+            except CookieError as e:
+                attempted = True
+                reason = f"Cookie lỗi: {e}"
+            except Exception as e:
+                self.task_store.log(f"⚠️ Lỗi khi mượn trình duyệt để lấy token: {e}")
+
+        if token and token != stale_token:
+            with self._token_cond:
+                self.auth_token = token
+                self._save_token(token)
+                self._token_cond.notify_all()
+            self.task_store.log("🔑 Đã lấy được Authorization Token mới.")
+            return token
+        if attempted:
+            self._trip_circuit(reason)
+        return None
+
+    def service_token_refresh(self):
+        """Thread giữ page gọi định kỳ khi đang chờ: xử lý yêu cầu làm mới token của thread khác."""
+        if self._refresh_wanted and threading.current_thread() is self._page_thread:
+            self._refresh_on_page(self.auth_token)
+
+    def _refresh_on_page(self, stale_token, page=None, force=False):
+        """(Thread giữ page) Tải lại page và bắt token mới. force=True: luôn tải lại (page vừa bị 401)."""
+        page = page or self._page
+        with self._token_cond:
+            fresh = None if force else self._fresh_token(stale_token)
+            if fresh or page is None:
+                self._refresh_wanted = False
+                self._token_cond.notify_all()
+                return fresh
+
+        self.task_store.log("🔄 Token hết hạn, đang lấy token mới từ trang đang mở...")
+        token = None
+        try:
+            token = capture_token(page)
+            self._after_reload(page)
+        except Exception as e:
+            self.task_store.log(f"⚠️ Lỗi khi tải lại trang để lấy token: {e}")
+
+        with self._token_cond:
+            self._refresh_wanted = False
+            if token and token != stale_token:
+                self.auth_token = token
+                self._save_token(token)
+                self.task_store.log("🔑 Đã lấy được Authorization Token mới.")
+            else:
+                token = None
+            self._token_cond.notify_all()
+        if token is None:
+            self._trip_circuit("Tải lại trang vẫn không có token mới")
+        return token
+
+    def _after_reload(self, page):
+        """Đưa page về trạng thái sẵn sàng gửi item sau khi tải lại (lớp con ghi đè)."""
+        pass
+
+    def _trip_circuit(self, reason):
+        """Cookie chết thật: đánh dấu tài khoản chết để scheduler bỏ qua, task dừng gửi item mới."""
+        with self._token_cond:
+            if self._circuit_open:
+                return
+            self._circuit_open = True
+            self._token_cond.notify_all()
+        self.task_store.log(f"⛔ {reason}. Ngừng gửi item mới, các item còn lại được đánh dấu lỗi.")
+        if self.account:
+            ACCOUNTS.mark_dead(self.account, reason)
+
+    def _generate(self, page, url_part, submit, retry=True):
+        """
+        Gọi submit() (nhập + bấm Generate) và trả về response của request tạo video.
+        Response 401: tải lại chính page đó để lấy token mới rồi gửi lại một lần
+        (retry=False: chỉ lấy token mới, item báo lỗi để lượt retry chạy lại).
+        """
+        for attempt in range(2):
+            if not self.submit_throttle.wait(self.task_store):
+                raise SubmitStopped("Đã dừng trước khi bấm Generate.")
+            with page.expect_response(lambda resp: url_part in resp.url, timeout=120000) as response_info:
+                submit()
+            self.submit_throttle.mark()
+            response = response_info.value
+            if response.status != 401:
+                break
+            ACCOUNTS.report_401(self.account, token=self.auth_token)
+            TOKEN_CACHE.invalidate_token(self.auth_token)
+            refreshed = not attempt and not self._circuit_open and self._refresh_on_page(self.auth_token, page, force=True)
+            if not refreshed:
+                raise Exception("Generate bị từ chối (401) và không lấy được token mới.")
+            if not retry:
+                raise Exception("Generate bị từ chối (401), đã lấy token mới; item sẽ được chạy lại.")
+        if response.status != 200:
+            raise Exception(f"Generate lỗi HTTP {response.status}.")
+        return response
+
+    def _fail_remaining(self):
+        """Circuit breaker mở: đánh dấu lỗi ngay các item chưa chạy thay vì chờ từng item timeout."""
+        items = self.task_store.tasks_db[self.task_id]['items']
+        with self.task_store.batch():
+            for idx, item in enumerate(items):
+                if item['status'] == "Pending":
+                    with self._counter_lock:
+                        self.error_prompts += 1
+                    self.task_store.update_item_status(idx, "Error (Cookie)")
+            self.task_store.update_progress(self.completed_prompts, self.error_prompts)
+
+    def _final_status(self):
+        if self.task_store.stop_requested():
+            return "Stopped"
+        if self._circuit_open:
+            return "Error (Cookie)"
+        return "Finished"
+
+    def _mark_finished(self, idx, filepath):
+        with self._counter_lock:
+            self.completed_prompts += 1
+        self._job_done(idx)
+        self.task_store.update_item_status(idx, "Finished", str(filepath.name)) # Trạng thái English
+        STORAGE.record(filepath, KIND_VIDEO, owner=self.username, task_id=self.task_id)
+        self._cache_result(idx, filepath)
+        self._settle_inflight(idx, filepath=filepath)
+
+    # --- CACHE KẾT QUẢ (xem result_cache.py) ---
+    def _request_key(self, idx):
+        """(khoá, thông tin) của yêu cầu tạo video ở item idx."""
+        if self.is_i2v:
+            image_path, prompt = self.prompts_or_tasks[idx]
+            image_hash = UPLOADS.content_hash(image_path)
+        else:
+            prompt, image_hash = self.prompts_or_tasks[idx], None
+        task_type = "I2V" if self.is_i2v else "P2V"
+        info = {"task_type": task_type, "prompt": prompt, "image_hash": image_hash, "resolution": self.resolution}
+        return request_key(task_type, prompt, image_hash, self.resolution), info
+
+    def _serve_cached(self):
+        """Hoàn thành trước mọi item đã có trong cache (trước khi mượn browser)."""
+        if not self.use_cache:
+            return
+        served = sum(1 for idx in self._remaining() if self._from_cache(idx))
+        if served:
+            self.task_store.log(f"♻️ {served}/{self.total_prompts} item dùng lại video có sẵn, không cần tạo lại.")
+
+    def _from_cache(self, idx):
+        """Item đã có video giống hệt trong cache: link file vào task và hoàn thành ngay."""
+        try:
+            key, _ = self._request_key(idx)
+            cached = RESULT_CACHE.lookup(key)
+            if cached is None:
+                return False
+            job_id = f"cache_{idx+1}_{uuid.uuid4().hex[:6]}"
+            filepath = self.save_dir / self._linked_filename(idx, job_id)
+            link_or_copy(cached, filepath)
+            STORAGE.record(filepath, KIND_VIDEO, owner=self.username, task_id=self.task_id)
+        except Exception as e:
+            self.task_store.log(f"⚠️ Không dùng được cache cho item #{idx+1}: {e}")
+            return False
+        with self.task_store.batch():
+            self.task_store.log(f"♻️ [{job_id}] Dùng lại video đã tạo trước đó: {filepath.name}")
+            with self._counter_lock:
+                self.completed_prompts += 1
+            self.task_store.update_item_status(idx, "Finished", filepath.name, cached=True)
+            self.task_store.update_progress(self.completed_prompts, self.error_prompts)
+        return True
+
+    def _linked_filename(self, idx, job_id):
+        """Tên file cho item nhận video có sẵn (cache / item trùng đang chạy)."""
+        return self._video_filename(idx, job_id).replace("720p_", f"{self.resolution}_", 1)
+
+    def _cache_result(self, idx, filepath):
+        # Upscale lỗi thì item nhận bản 720p: không ghi vào cache dưới khoá 1080p
+        if not self.use_cache or f"{self.resolution}_" not in filepath.name:
+            return
+        try:
+            key, info = self._request_key(idx)
+            RESULT_CACHE.store(key, filepath, **info)
+        except Exception as e:
+            self.task_store.log(f"⚠️ Không ghi được video vào cache: {e}")
+
+    def _mark_error(self, idx, retry_entry, job_id, e, is_retry):
+        if isinstance(e, SubmitStopped):
+            self.task_store.log(f"⏹️ [{job_id}] {e}")
+            self._job_done(idx)
+            self._settle_inflight(idx, error=e)
+            self.task_store.update_item_status(idx, "Stopped")
+            return
+        self.task_store.log(f"❌ [{job_id}] {'Lỗi I2V' if self.is_i2v else 'Lỗi'}: {e}")
+        self._job_done(idx)
+        self._settle_inflight(idx, error=e)
+        if not is_retry:
+            with self._counter_lock:
+                self.pending_errors.append(retry_entry)
+                self.error_prompts += 1
+            self.task_store.update_item_status(idx, "Error") # Trạng thái English
+        else:
+            self.task_store.update_item_status(idx, "Error (Retried)") # Trạng thái English
+
+    def _hand_off_download(self, idx, video_url, filename, job_id, retry_entry, is_retry):
+        """Giao URL cho DOWNLOADS và trả về ngay; item được cập nhật khi tải xong."""
+        filepath = self.save_dir / filename
+        self.task_store.log(f"⬇️ [{job_id}] Đang tải video về: {filepath}")
+        with self._downloads_cond:
+            self._downloads_pending += 1
+        STORAGE.ensure_free_space()
+
+        def on_done(future):
+            try:
+                with self.task_store.batch():
+                    try:
+                        saved = future.result()
+                        self.task_store.log(f"✅ [{job_id}] Đã lưu: {saved.name}")
+                        self._mark_finished(idx, saved)
+                    except Exception as dl_e:
+                        self._mark_error(idx, retry_entry, job_id, f"Lỗi khi tải/lưu file: {dl_e}", is_retry)
+                    finally:
+                        self.task_store.update_progress(self.completed_prompts, self.error_prompts)
+            finally:
+                with self._downloads_cond:
+                    self._downloads_pending -= 1
+                    self._downloads_cond.notify_all()
+
+        DOWNLOADS.submit(video_url, filepath).add_done_callback(on_done)
+
+    # --- GỘP ITEM TRÙNG ĐANG CHẠY ---
+    def _follow_inflight(self, idx, is_retry):
+        """
+        Item trùng khoá với một video đang được tạo (task này hoặc task khác): không gửi lại
+        mà chờ leader và nhận chung file. Trả về False nếu item phải tự chạy (và là leader).
+        """
+        if not self.use_cache:
+            return False
+        key, _ = self._request_key(idx)
+
+        def on_leader_done(filepath, error):
+            self._on_leader_done(idx, filepath, error, is_retry)
+
+        # Giữ _downloads_cond để callback không chạy trước khi item được đánh dấu Following
+        with self._downloads_cond:
+            leader = INFLIGHT.join(key, f"{self.task_id[:8]}#{idx+1}", on_leader_done)
+            if leader is None:
+                self._led[idx] = key
+                return False
+            self._following[idx] = (key, on_leader_done)
+            with self.task_store.batch():
+                self.task_store.log(f"🔗 Item #{idx+1} trùng với video đang tạo ({leader}), chờ dùng chung kết quả.")
+                self.task_store.update_item_status(idx, "Following", follows=leader)
+        return True
+
+    def _on_leader_done(self, idx, filepath, error, is_retry):
+        with self._downloads_cond:
+            if self._following.pop(idx, None) is None:
+                return   # item đã bỏ chờ (task bị dừng)
+            job_id = f"follow_{idx+1}_{uuid.uuid4().hex[:6]}"
+            with self.task_store.batch():
+                try:
+                    if filepath is None:
+                        raise Exception(f"Video dùng chung bị lỗi: {error}")
+                    target = self.save_dir / self._linked_filename(idx, job_id)
+                    link_or_copy(filepath, target)
+                    self.task_store.log(f"🔗 [{job_id}] Nhận video dùng chung: {target.name}")
+                    self._mark_finished(idx, target)
+                except Exception as e:
+                    self._mark_error(idx, self._retry_entry(idx), job_id, e, is_retry)
+                finally:
+                    self.task_store.update_progress(self.completed_prompts, self.error_prompts)
+            self._downloads_cond.notify_all()
+
+    def _settle_inflight(self, idx, filepath=None, error=None):
+        """Leader xong / lỗi: báo cho các item đang chờ."""
+        with self._counter_lock:
+            key = self._led.pop(idx, None)
+        if key is not None:
+            INFLIGHT.settle(key, filepath=filepath, error=error)
+
+    def release_inflight(self):
+        """Gọi khi worker đã kết thúc: không để item nào chờ một leader không còn chạy."""
+        with self._counter_lock:
+            led, self._led = self._led, {}
+        for key in led.values():
+            INFLIGHT.settle(key, error="Task dẫn đầu đã kết thúc")
+        with self._downloads_cond:
+            for key, callback in self._following.values():
+                INFLIGHT.detach(key, callback)
+            self._following.clear()
+
+    def _wait_downloads(self):
+        """Chờ mọi video đã giao cho DOWNLOADS tải xong (trước khi retry/kết thúc task)."""
+        with self._downloads_cond:
+            if self._following:
+                self.task_store.log(f"⏳ Đang chờ {len(self._following)} item dùng chung video với item khác...")
+            while self._following and not self.task_store.stop_requested():
+                self._downloads_cond.wait(1)
+            # Task bị dừng: bỏ chờ, các item này chưa có kết quả
+            for idx, (key, callback) in list(self._following.items()):
+                INFLIGHT.detach(key, callback)
+                self.task_store.update_item_status(idx, "Stopped")
+            self._following.clear()
+            if self._downloads_pending:
+                self.task_store.log(f"⏳ Đang chờ {self._downloads_pending} video tải xong...")
+            while self._downloads_pending:
+                self._downloads_cond.wait()
+
+    def _retry_entry(self, idx):
+        if self.is_i2v:
+            image_path, prompt = self.prompts_or_tasks[idx]
+            return (idx, image_path, prompt)
+        return (idx, self.prompts_or_tasks[idx])
+
+    def _image_stem(self, idx):
+        """Tên ảnh (không đuôi) để đặt tên video I2V: tên file gốc của user, không phải hash trong kho."""
+        return sanitize_filename(Path(self.image_names[idx]).stem)
+
+    def _video_filename(self, idx, job_id):
+        """Tên file video 720p của một item."""
+        if self.is_i2v:
+            _image_path, prompt = self.prompts_or_tasks[idx]
+            return f"I2V_720p_I2V_{sanitize_filename(prompt)}_{self._image_stem(idx)}_{job_id}.mp4"
+        return f"720p_{sanitize_filename(self.prompts_or_tasks[idx])}_{job_id}.mp4"
+
+    # --- KHÔI PHỤC SAU KHI KHỞI ĐỘNG LẠI ---
+    def _remaining(self):
+        """
+        Các idx chưa từng chạy. Task khôi phục bỏ qua item đã xong, đã lỗi hoặc đang render;
+        item vừa lấy từ cache kết quả cũng không còn Pending.
+        """
+        items = self.task_store.tasks_db[self.task_id]['items']
+        return [idx for idx, item in enumerate(items) if item['status'] == "Pending"]
+
+    def _resume_inflight(self):
+        """Poll tiếp các operation đã gửi trước khi tiến trình khởi động lại."""
+        inflight = self.resume.get('inflight') or []
+        if inflight:
+            self.task_store.log(f"♻️ Tiếp tục theo dõi {len(inflight)} video đang render từ trước khi khởi động lại.")
+        for op in inflight:
+            self._job_started(op['idx'])
+            t = threading.Thread(target=self._finish_resumed, args=(op,), daemon=True)
+            t.start()
+            self._resumed_threads.append(t)
+
+    def _finish_resumed(self, op):
+        idx, job_id = op['idx'], op['job_id']
+        try:
+            video_url = poll_status(op.get('token') or self.auth_token, op['op_id'], job_id, self.task_store, kind=op.get('kind', KIND_720P), token_source=self)
+            self._hand_off_download(idx, video_url, self._video_filename(idx, job_id), job_id, self._retry_entry(idx), False)
+        except Exception as e:
+            self._mark_error(idx, self._retry_entry(idx), job_id, e, False)
+        finally:
+            self.task_store.update_progress(self.completed_prompts, self.error_prompts)
+
+    def _join_resumed(self):
+        for t in self._resumed_threads:
+            while t.is_alive():
+                t.join(1)
+                self.service_token_refresh()
+        self._resumed_threads = []
+        self._wait_downloads()
+
+    def _finish_without_browser(self):
+        """Task khôi phục không còn item nào phải gửi: chỉ chờ các video đang render rồi kết thúc."""
+        self._join_resumed()
+        self.task_store.set_final_status(self._final_status())
+        self.task_store.log("✅ Đã hoàn tất các video còn dang dở.")
+
+    def _reset_page(self, page):
+        """Đóng popup và xoá ô prompt để sẵn sàng cho item tiếp theo."""
+        try:
+            page.keyboard.press("Escape")
+            page.locator(PROMPT_BOX).fill("", timeout=5000)
+        except:
+            pass
+
+    def _lease_browser(self):
+        """Mượn một browser đã khởi động sẵn từ pool. Trả về None nếu không thể chạy tiếp."""
+        self.task_store.log("🌐 Đang lấy trình duyệt từ pool...")
+        try:
+            lease = BROWSER_POOL.lease(self.cookies, cancel=self.task_store.stop_requested)
+        except CookieError as e:
+            self.task_store.log(f"⚠️ Cookie lỗi: {e}. Worker dừng.")
+            if self.account:
+                ACCOUNTS.mark_dead(self.account, e)
+            self.task_store.set_final_status("Error (Cookie)")
+            return None
+        except Exception as e:
+            self.task_store.log(f"❌ Khởi tạo thất bại: {e}")
+            self.task_store.set_final_status("Error (Init)")
+            return None
+
+        if lease is None:
+            self.task_store.log("⏸️ Tác vụ bị dừng trước khi có trình duyệt rảnh.")
+            self.task_store.set_final_status("Stopped")
+            return None
+
+        self.task_store.log(f"✅ Đã nhận trình duyệt #{lease.slot.slot_id} (đã chạy {lease.slot.jobs_done} job), trang Flow đã tải sẵn.")
+        return lease
+
     def run(self):
         pass
 
@@ -255,33 +930,45 @@ class P2VWorker(BaseWorker):
     def __init__(self, task_id, tasks_db, params):
         super().__init__(task_id, tasks_db, params, is_i2v=False)
         self.prompts = params['prompts']
+        self.pipeline_depth = clamp_param(params.get('pipeline_depth'), P2V_PIPELINE_DEPTH, P2V_PIPELINE_DEPTH_MAX)
+        self.pages_per_task = clamp_param(params.get('pages_per_task'), P2V_PAGES_PER_TASK, P2V_PAGES_PER_TASK_MAX)
+        self._extra_leases = []
+        self._inflight = None
+        self._executor = None
+
+    def _submit_prompt(self, page, idx, prompt, job_id):
+        """Nhập prompt, bấm Generate và trả về operation id của video gốc."""
+        with self.task_store.batch():
+            self.task_store.update_item_status(idx, "Running") 
+            self.task_store.log(f"📝 [{job_id}] Đã nhập prompt: {prompt[:100]}...")
+
+        def submit():
+            page.locator(PROMPT_BOX).fill(prompt)
+            page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}").click()
+
+        response = self._generate(page, "batchAsyncGenerateVideoText", submit)
+        data = response.json()
         
+        op_data = data["operations"][0].get("operation")
+        self.task_store.record_operation(idx, op_data["name"], job_id, KIND_720P, self.auth_token)
+        self._job_started(idx)
+        return op_data["name"]
+
     def _process_prompt(self, page, idx, prompt, job_id, is_retry=False):
+        if self._executor is not None:
+            return self._process_prompt_pipelined(page, idx, prompt, job_id, is_retry)
+
         video_url = None
         original_op_id = None
         
         try:
-            generate_locator = page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}")
-            
-            self.task_store.update_item_status(idx, "Running") 
-            self.task_store.log(f"📝 [{job_id}] Đã nhập prompt: {prompt[:100]}...")
-            page.locator(PROMPT_BOX).fill(prompt)
-            
-            with page.expect_response(lambda resp: "batchAsyncGenerateVideoText" in resp.url and resp.status == 200, timeout=120000) as response_info:
-                page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}").click()
-
-            time.sleep(10) 
-            response = response_info.value
-            data = response.json()
-            
-            op_data = data["operations"][0].get("operation")
-            original_op_id = op_data["name"]
+            original_op_id = self._submit_prompt(page, idx, prompt, job_id)
 
             # Polling trạng thái cho video gốc (720p)
-            video_url_original = poll_status(self.auth_token, original_op_id, job_id, self.task_store)
+            video_url_original = poll_status(self.auth_token, original_op_id, job_id, self.task_store, token_source=self)
 
             filename_prefix = sanitize_filename(prompt)
-            filename = f"720p_{filename_prefix}_{job_id}.mp4" 
+            filename = self._video_filename(idx, job_id)
 
             if self.resolution == "1080p":
                 try:
@@ -294,68 +981,121 @@ class P2VWorker(BaseWorker):
             else:
                 video_url = video_url_original
 
-            # Bắt đầu tải video
-            filepath = self.save_dir / filename
-            self.task_store.log(f"⬇️ [{job_id}] Đang tải video về: {filepath}")
-            
-            try:
-                with requests.get(video_url, stream=True, timeout=300) as r:
-                    r.raise_for_status()
-                    with open(filepath, "wb") as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            f.write(chunk)
-            except Exception as dl_e:
-                raise Exception(f"Lỗi khi tải/lưu file: {dl_e}")
-
-            self.task_store.log(f"✅ [{job_id}] Đã lưu: {filepath.name}")
-            self.completed_prompts += 1
-            self.task_store.update_item_status(idx, "Finished", str(filepath.name)) # Trạng thái English
+            # Giao việc tải video cho DOWNLOADS rồi chuyển sang prompt tiếp theo
+            self._hand_off_download(idx, video_url, filename, job_id, (idx, prompt), is_retry)
             
         except Exception as e:
-            self.task_store.log(f"❌ [{job_id}] Lỗi: {e}")
-            if not is_retry:
-                self.pending_errors.append((idx, prompt))
-                self.error_prompts += 1
-                self.task_store.update_item_status(idx, "Error") # Trạng thái English
-            else:
-                self.task_store.update_item_status(idx, "Error (Retried)") # Trạng thái English
+            self._mark_error(idx, (idx, prompt), job_id, e, is_retry)
             
         finally:
             self.task_store.update_progress(self.completed_prompts, self.error_prompts)
-            try:
-                page.keyboard.press("Escape")
-                time.sleep(1)
-                page.locator(PROMPT_BOX).fill("")
-            except:
-                pass
-            
-            self.task_store.log("⏳ Chờ 30 giây trước khi bắt đầu tác vụ tiếp theo...") 
-            time.sleep(30)
-            
+            self._reset_page(page)
+
+    # --- CHẾ ĐỘ PIPELINE: page gửi prompt tiếp theo trong khi các video trước đang render ---
+    def _process_prompt_pipelined(self, page, idx, prompt, job_id, is_retry=False):
+        # Chờ đến khi số video đang render < pipeline_depth
+        while not self._inflight.acquire(timeout=1):
+            self.service_token_refresh()
+            if self.task_store.stop_requested():
+                self.task_store.update_item_status(idx, "Stopped")
+                return
+
+        try:
+            original_op_id = self._submit_prompt(page, idx, prompt, job_id)
+            self.task_store.log(f"🔑 [{job_id}] Đã gửi, operation id: {original_op_id}. Chuyển sang prompt tiếp theo.")
+        except Exception as e:
+            self._inflight.release()
+            self._mark_error(idx, (idx, prompt), job_id, e, is_retry)
+            self.task_store.update_progress(self.completed_prompts, self.error_prompts)
+            self._reset_page(page)
+            return
+
+        self._executor.submit(self._finish_prompt, idx, prompt, job_id, original_op_id, is_retry)
+        self._reset_page(page)
+
+    def _finish_prompt(self, idx, prompt, job_id, original_op_id, is_retry):
+        """Poll + tải video, chạy trên thread riêng (không đụng tới page)."""
+        try:
+            video_url = poll_status(self.auth_token, original_op_id, job_id, self.task_store, token_source=self)
+            filename = self._video_filename(idx, job_id)
+            self._hand_off_download(idx, video_url, filename, job_id, (idx, prompt), is_retry)
+        except Exception as e:
+            self._mark_error(idx, (idx, prompt), job_id, e, is_retry)
+        finally:
+            self._inflight.release()
+            self.task_store.update_progress(self.completed_prompts, self.error_prompts)
+
+    def _drain_pipeline(self):
+        """Chờ tất cả video đang render/tải xong."""
+        if self._executor is None:
+            return
+        for _ in range(self.pipeline_depth):
+            while not self._inflight.acquire(timeout=1):
+                self.service_token_refresh()
+        for _ in range(self.pipeline_depth):
+            self._inflight.release()
 
     def run(self):
         self.task_store.log("P2V Worker started.")
         self.task_store.update_progress(self.completed_prompts, self.error_prompts)
-        
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True) 
-            context = browser.new_context()
-            
+
+        self._resume_inflight()
+        self._serve_cached()
+        if not self._remaining():
+            self._finish_without_browser()
+            return
+
+        # Upscale 1080p cần thao tác trên card video mới nhất của page, nên chỉ pipeline với 720p
+        if self.pipeline_depth > 1 and self.resolution != "1080p":
+            self._inflight = threading.BoundedSemaphore(self.pipeline_depth)
+            self._executor = ThreadPoolExecutor(max_workers=self.pipeline_depth, thread_name_prefix=f"p2v-{self.task_id[:8]}")
+            self.task_store.log(f"⚡ Chế độ pipeline: tối đa {self.pipeline_depth} video render cùng lúc.")
+
+        lease = self._lease_browser()
+        if lease is None:
+            return
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(lease)
+                for extra in self._lease_extra_pages():
+                    stack.enter_context(extra)
+                lease.run(self._run_on_page)
+        finally:
+            self._unbind_page()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def _lease_extra_pages(self):
+        """Mượn thêm browser đang rảnh để chạy song song nhiều tab (không chờ nếu pool đã hết)."""
+        self._extra_leases = []
+        wanted = min(self.pages_per_task, self.total_prompts) - 1
+        for _ in range(max(0, wanted)):
             try:
-                context.add_cookies(self.cookies)
+                extra = BROWSER_POOL.lease(self.cookies, timeout=0)
             except Exception as e:
-                self.task_store.log(f"⚠️ Cookie lỗi: {e}. Worker dừng.")
-                self.task_store.set_final_status("Error (Cookie)")
-                return
-            
-            page = context.new_page()
-            try:
-                self.task_store.log(f"🌐 Đang mở trang web: {FLOW_URL}")
-                page.goto(FLOW_URL, timeout=120000)
-                page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}").wait_for(timeout=60000)
-                self.task_store.log("✅ Trang web đã tải xong.")
+                self.task_store.log(f"⚠️ Không mở được tab phụ: {e}")
+                break
+            if extra is None:
+                break
+            self._extra_leases.append(extra)
+        if self._extra_leases:
+            self.task_store.log(f"🗂️ Chạy song song trên {len(self._extra_leases) + 1} tab.")
+        return self._extra_leases
 
-                # Lấy Auth Token
+    def _after_reload(self, page):
+        page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}").wait_for(timeout=60000)
+
+    def _run_on_page(self, page):
+        self._bind_page(page)
+        try:
+            page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}").wait_for(timeout=60000)
+            self.task_store.log("✅ Trang web đã tải xong.")
+
+            # Lấy Auth Token (ưu tiên token còn hạn trong cache để khỏi tạo video "test")
+            self.auth_token = TOKEN_CACHE.peek(self.cookies)
+            if self.auth_token:
+                self.task_store.log("🔑 Dùng Authorization Token từ cache.")
+            else:
                 with page.expect_response(lambda resp: "batchAsyncGenerateVideoText" in resp.url, timeout=120000) as response_info:
                     page.locator(PROMPT_BOX).fill("test")
                     page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}").click()
@@ -364,49 +1104,80 @@ class P2VWorker(BaseWorker):
                 auth_header = request.headers.get("authorization")
                 if auth_header and auth_header.startswith("Bearer "):
                     self.auth_token = auth_header
+                    self._save_token(auth_header)
                     self.task_store.log("🔑 Đã lấy được Authorization Token.")
-                
-            except Exception as e:
-                self.task_store.log(f"❌ Khởi tạo thất bại: {e}")
-                self.task_store.set_final_status("Error (Init)")
-                browser.close()
-                return
             
-            # --- LOGIC CHẠY VÀ XỬ LÝ TẠM DỪNG (STOPPED) ---
-            for idx, prompt in enumerate(self.prompts):
-                if self.task_store.stop_requested():
-                    self.task_store.log("⏸️ Tác vụ bị dừng bởi người dùng. Đánh dấu các tác vụ còn lại là Tạm dừng.")
-                    # Đánh dấu các tác vụ còn lại là Tạm dừng
-                    for remaining_idx in range(idx, self.total_prompts):
-                        # Chỉ đánh dấu nếu item chưa được xử lý (trạng thái ban đầu là Pending)
-                        if self.task_store.tasks_db[self.task_id]['items'][remaining_idx]['status'] == "Pending":
-                            self.task_store.update_item_status(remaining_idx, "Stopped") 
-                    break
-                
-                job_id = f"prompt_{idx+1}_{uuid.uuid4().hex[:6]}"
-                self._process_prompt(page, idx, prompt, job_id)
-            # --- END LOGIC XỬ LÝ TẠM DỪNG ---
+        except Exception as e:
+            self.task_store.log(f"❌ Khởi tạo thất bại: {e}")
+            self.task_store.set_final_status("Error (Init)")
+            return
+        
+        self._run_pass(page, [(idx, self.prompts[idx]) for idx in self._remaining()], is_retry=False)
+        self._join_resumed()
 
-            # Logic Retry (chỉ chạy retry nếu không bị dừng bởi người dùng)
-            if not self.task_store.stop_requested() and self.pending_errors:
-                self.task_store.log("---")
-                self.task_store.log("🔁 Bắt đầu chạy lại các tác vụ lỗi...")
+        # Logic Retry (chỉ chạy retry nếu không bị dừng bởi người dùng và cookie còn sống)
+        if not self.task_store.stop_requested() and not self._circuit_open and self.pending_errors:
+            self.task_store.log("---")
+            self.task_store.log("🔁 Bắt đầu chạy lại các tác vụ lỗi...")
 
-                error_list = list(self.pending_errors)
-                self.pending_errors.clear()
+            error_list = list(self.pending_errors)
+            self.pending_errors.clear()
+            self._run_pass(page, error_list, is_retry=True)
 
-                for original_idx, prompt_text in error_list:
-                    if self.task_store.stop_requested(): break
-                    job_id = f"retry_{original_idx+1}_{uuid.uuid4().hex[:6]}"
-                    self._process_prompt(page, original_idx, prompt_text, job_id, is_retry=True)
+        # --- XỬ LÝ TẠM DỪNG (STOPPED) ---
+        if self.task_store.stop_requested():
+            self.task_store.log("⏸️ Tác vụ bị dừng bởi người dùng. Đánh dấu các tác vụ còn lại là Tạm dừng.")
+            with self.task_store.batch():
+                for remaining_idx, item in enumerate(self.task_store.tasks_db[self.task_id]['items']):
+                    # Chỉ đánh dấu nếu item chưa được xử lý (trạng thái ban đầu là Pending)
+                    if item['status'] == "Pending":
+                        self.task_store.update_item_status(remaining_idx, "Stopped") 
 
-            browser.close()
-            if self.task_store.stop_requested():
-                 self.task_store.set_final_status("Stopped")
-            else:
-                 self.task_store.set_final_status("Finished")
+        if self._circuit_open:
+            self._fail_remaining()
+
+        with self.task_store.batch():
+            self.task_store.set_final_status(self._final_status())
             self.task_store.log("✅ Tất cả tác vụ P2V đã hoàn thành.")
 
+    # --- HÀNG ĐỢI DÙNG CHUNG GIỮA CÁC TAB ---
+    def _run_pass(self, page, work, is_retry):
+        """Chia các (idx, prompt) cho tab chính và các tab phụ: tab nào rảnh thì lấy item tiếp theo."""
+        work_queue = deque(work)
+        helpers = []
+        for extra in self._extra_leases:
+            t = threading.Thread(target=self._run_extra_page, args=(extra, work_queue, is_retry), daemon=True)
+            t.start()
+            helpers.append(t)
+
+        self._page_loop(page, work_queue, is_retry)
+        for t in helpers:
+            t.join()
+        self._drain_pipeline()
+        self._wait_downloads()
+
+    def _run_extra_page(self, lease, work_queue, is_retry):
+        try:
+            lease.run(self._page_loop, work_queue, is_retry, True)
+        except Exception as e:
+            # Item đang xử lý đã được đánh dấu lỗi; phần còn lại trong hàng đợi do các tab khác nhận
+            self.task_store.log(f"⚠️ Tab phụ #{lease.slot.slot_id} dừng do lỗi: {e}")
+
+    def _page_loop(self, page, work_queue, is_retry, is_extra=False):
+        if is_extra:
+            page.locator(f"xpath={P2V_GENERATE_BTN_XPATH}").wait_for(timeout=60000)
+        while not self.task_store.stop_requested() and not self._circuit_open:
+            if not is_extra:
+                self.service_token_refresh()
+            try:
+                idx, prompt = work_queue.popleft()
+            except IndexError:
+                break
+            if self._follow_inflight(idx, is_retry):
+                continue
+            job_id = f"{'retry' if is_retry else 'prompt'}_{idx+1}_{uuid.uuid4().hex[:6]}"
+            self._process_prompt(page, idx, prompt, job_id, is_retry=is_retry)
+
 # --- I2V WORKER (Cập nhật logic run tương tự) ---
 class I2VWorker(BaseWorker):
     def __init__(self, task_id, tasks_db, params):
@@ -415,33 +1186,33 @@ class I2VWorker(BaseWorker):
         
     def _process_task(self, page, idx, image_path, prompt, job_id, is_retry=False):
         # ... (Logic _process_task giữ nguyên, chỉ đảm bảo update_item_status dùng English status) ...
-        image_file = str(image_path)
+        # Bản đã cắt đúng tỉ lệ + thu nhỏ sẵn (ảnh gốc nếu không có Pillow / xử lý lỗi)
+        image_file = str(UPLOADS.prepared(image_path))
         video_url = None
 
         try:
             self.task_store.update_item_status(idx, "Running") 
             
             page.locator(I2V_UPLOAD_BTN).click()
-            time.sleep(10)
             
             upload_desktop_locator = page.locator(f"xpath={I2V_SELECT_FROM_DESKTOP_BTN_XPATH}")
-            upload_desktop_locator.wait_for(timeout=10000) 
+            upload_desktop_locator.wait_for(state="visible", timeout=20000) 
             
             with page.expect_file_chooser(timeout=35000) as fc_info:
                 upload_desktop_locator.click()
                 
             file_chooser = fc_info.value
             file_chooser.set_files(image_file) 
-            self.task_store.log(f"🖼️ [{job_id}] Đã tải lên ảnh từ Server: {Path(image_file).name}")
+            self.task_store.log(f"🖼️ [{job_id}] Đã tải lên ảnh từ Server: {self.image_names[idx]}")
             
             crop_save_locator = page.locator(I2V_CROP_AND_SAVE_BTN)
             crop_save_locator.wait_for(timeout=30000) 
             crop_save_locator.click()
-            
-            time.sleep(20)
-            self.task_store.log(f"✂️ [{job_id}] Đã click Cắt và lưu. Chờ 20s...")
+            self.task_store.log(f"✂️ [{job_id}] Đã click Cắt và lưu. Chờ hộp thoại cắt ảnh đóng...")
+            # Hộp thoại đóng lại khi ảnh đã được cắt và tải lên xong
+            crop_save_locator.wait_for(state="hidden", timeout=60000)
 
-            page.locator(PROMPT_BOX).wait_for(timeout=10000)
+            page.locator(PROMPT_BOX).wait_for(state="visible", timeout=10000)
             
             page.locator(PROMPT_BOX).fill(prompt)
             self.task_store.log(f"📝 [{job_id}] Đã nhập prompt: {prompt[:100]}...")
@@ -449,26 +1220,26 @@ class I2VWorker(BaseWorker):
             generate_locator = page.locator(I2V_GENERATE_BTN)
             wait_for_generate_button(generate_locator, job_id, self.task_store)
             
-            with page.expect_response(lambda resp: "batchAsyncGenerateVideoStartImage" in resp.url and resp.status == 200, timeout=120000) as response_info:
-                generate_locator.click() 
-            
-            time.sleep(10)
-            response = response_info.value
+            # Tải lại trang làm mất ảnh đã upload nên 401 ở đây không gửi lại ngay
+            response = self._generate(page, "batchAsyncGenerateVideoStartImage", generate_locator.click, retry=False)
             request = response.request
             auth_header = request.headers.get("authorization")
             if auth_header and auth_header.startswith("Bearer "):
                 self.auth_token = auth_header
+                self._save_token(auth_header)
             
             data = response.json()
             op_data = data["operations"][0].get("operation")
             original_op_id = op_data["name"]
 
             self.task_store.log(f"🔑 [{job_id}] Đã lấy operation id gốc: {original_op_id}")
+            self.task_store.record_operation(idx, original_op_id, job_id, KIND_I2V, self.auth_token)
+            self._job_started(idx)
 
-            video_url_original = poll_status(self.auth_token, original_op_id, job_id, self.task_store)
+            video_url_original = poll_status(self.auth_token, original_op_id, job_id, self.task_store, kind=KIND_I2V, token_source=self)
 
-            filename_prefix = f"I2V_{sanitize_filename(prompt)}_{Path(image_path).stem}"
-            filename = f"I2V_720p_{filename_prefix}_{job_id}.mp4" 
+            filename_prefix = f"I2V_{sanitize_filename(prompt)}_{self._image_stem(idx)}"
+            filename = self._video_filename(idx, job_id)
 
             if self.resolution == "1080p":
                 try:
@@ -481,95 +1252,86 @@ class I2VWorker(BaseWorker):
             else:
                 video_url = video_url_original
 
-            filepath = self.save_dir / filename
-            self.task_store.log(f"⬇️ [{job_id}] Đang tải video về: {filepath}")
-            
-            with requests.get(video_url, stream=True, timeout=300) as r:
-                r.raise_for_status()
-                with open(filepath, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
-            self.task_store.log(f"✅ [{job_id}] Đã lưu: {filepath.name}")
-            self.completed_prompts += 1
-            self.task_store.update_item_status(idx, "Finished", str(filepath.name)) 
+            self._hand_off_download(idx, video_url, filename, job_id, (idx, image_path, prompt), is_retry)
             
         except Exception as e:
-            self.task_store.log(f"❌ [{job_id}] Lỗi I2V: {e}")
-            if not is_retry:
-                self.pending_errors.append((idx, image_path, prompt))
-                self.error_prompts += 1
-                self.task_store.update_item_status(idx, "Error") 
-            else:
-                self.task_store.update_item_status(idx, "Error (Retried)")
+            self._mark_error(idx, (idx, image_path, prompt), job_id, e, is_retry)
             
         finally:
             self.task_store.update_progress(self.completed_prompts, self.error_prompts)
-            try:
-                page.keyboard.press("Escape")
-                time.sleep(1)
-                page.locator(PROMPT_BOX).fill("")
-            except:
-                pass
-            
-            self.task_store.log("⏳ Chờ 30 giây trước khi bắt đầu tác vụ tiếp theo...") 
-            time.sleep(30) 
+            self._reset_page(page)
 
 
     def run(self):
         self.task_store.log("I2V Worker started.")
         self.task_store.update_progress(self.completed_prompts, self.error_prompts)
-        
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = browser.new_context()
-            
-            try:
-                context.add_cookies(self.cookies)
-            except Exception as e:
-                self.task_store.log(f"⚠️ Cookie lỗi: {e}. Worker dừng.")
-                self.task_store.set_final_status("Error (Cookie)")
-                return
-            
-            page = context.new_page()
-            try:
-                self.task_store.log(f"🌐 Đang mở trang web: {FLOW_URL}")
-                page.goto(FLOW_URL, timeout=120000)
-                
-                page.locator(I2V_SELECT_WORKFLOW_BTN).wait_for(timeout=60000)
-                page.locator(I2V_SELECT_WORKFLOW_BTN).click()
-                time.sleep(10)
-                
-                page.locator(I2V_SELECT_IMG2VID_BTN).wait_for(timeout=10000)
-                page.locator(I2V_SELECT_IMG2VID_BTN).click()
-                time.sleep(10)
-                self.task_store.log("✅ Đã chọn I2V Workflow.")
 
-                page.locator(I2V_UPLOAD_BTN).wait_for(timeout=15000) 
-                self.task_store.log("✅ Nút Upload đã sẵn sàng.")
-                
-            except Exception as e:
-                self.task_store.log(f"❌ Khởi tạo thất bại: {e}")
-                self.task_store.set_final_status("Error (Init)")
-                browser.close()
-                return
+        self._resume_inflight()
+        self._serve_cached()
+        if not self._remaining():
+            self._finish_without_browser()
+            return
+
+        lease = self._lease_browser()
+        if lease is None:
+            return
+        try:
+            with lease:
+                lease.run(self._run_on_page)
+        finally:
+            self._unbind_page()
 
-            for idx, (image_path, prompt) in enumerate(self.prompts_or_tasks):
-                if self.task_store.stop_requested():
-                    self.task_store.log("⏸️ Tác vụ bị dừng bởi người dùng. Đánh dấu các tác vụ còn lại là Tạm dừng.")
+    def _select_workflow(self, page):
+        page.locator(I2V_SELECT_WORKFLOW_BTN).wait_for(timeout=60000)
+        page.locator(I2V_SELECT_WORKFLOW_BTN).click()
+
+        # Menu workflow mở ra -> chờ lựa chọn I2V hiển thị rồi click
+        page.locator(I2V_SELECT_IMG2VID_BTN).wait_for(state="visible", timeout=20000)
+        page.locator(I2V_SELECT_IMG2VID_BTN).click()
+        page.locator(I2V_UPLOAD_BTN).wait_for(state="visible", timeout=30000)
+
+    def _after_reload(self, page):
+        self._select_workflow(page)
+
+    def _run_on_page(self, page):
+        self._bind_page(page)
+        try:
+            self._select_workflow(page)
+            self.task_store.log("✅ Đã chọn I2V Workflow.")
+            self.task_store.log("✅ Nút Upload đã sẵn sàng.")
+            
+        except Exception as e:
+            self.task_store.log(f"❌ Khởi tạo thất bại: {e}")
+            self.task_store.set_final_status("Error (Init)")
+            return
+
+        remaining = set(self._remaining())
+        for idx, (image_path, prompt) in enumerate(self.prompts_or_tasks):
+            if idx not in remaining:
+                continue
+            if self.task_store.stop_requested():
+                self.task_store.log("⏸️ Tác vụ bị dừng bởi người dùng. Đánh dấu các tác vụ còn lại là Tạm dừng.")
+                items = self.task_store.tasks_db[self.task_id]['items']
+                with self.task_store.batch():
                     for remaining_idx in range(idx, self.total_prompts):
-                        if self.task_store.tasks_db[self.task_id]['items'][remaining_idx]['status'] == "Pending":
+                        if items[remaining_idx]['status'] == "Pending":
                             self.task_store.update_item_status(remaining_idx, "Stopped") 
-                    break
-                    
-                job_id = f"i2v_{idx+1}_{uuid.uuid4().hex[:6]}"
-                self._process_task(page, idx, image_path, prompt, job_id)
+                break
+            if self._circuit_open:
+                break
+            self.service_token_refresh()
+            if self._follow_inflight(idx, False):
+                continue
 
-            browser.close()
-            if self.task_store.stop_requested():
-                 self.task_store.set_final_status("Stopped")
-            else:
-                 self.task_store.set_final_status("Finished")
+            job_id = f"i2v_{idx+1}_{uuid.uuid4().hex[:6]}"
+            self._process_task(page, idx, image_path, prompt, job_id)
+        self._join_resumed()
+
+        if self._circuit_open:
+            self._fail_remaining()
+
+        with self.task_store.batch():
+            self.task_store.set_final_status(self._final_status())
             self.task_store.log("✅ Tất cả tác vụ I2V đã hoàn thành.")
 
 
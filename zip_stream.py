@@ -0,0 +1,57 @@
+import os
+import zipfile
+
+# --- NÉN ZIP DẠNG STREAM ---
+ZIP_STREAM_CHUNK_SIZE = int(os.environ.get("ZIP_STREAM_CHUNK_SIZE", str(1024 * 1024)))
+
+
+class _ZipSink:
+    """Đầu ra không seek được cho ZipFile: gom byte vừa ghi để generator trả dần về client."""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if self._chunks:
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            yield data
+
+
+def unique_names(names):
+    """Tên trong file ZIP không được trùng: thêm hậu tố _2, _3... khi cần."""
+    seen = set()
+    result = []
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while candidate in seen:
+            n += 1
+            candidate = f"{stem}_{n}{ext}"
+        seen.add(candidate)
+        result.append(candidate)
+    return result
+
+
+def stream_zip(files, chunk_size=ZIP_STREAM_CHUNK_SIZE):
+    """
+    Generator trả về file ZIP của [(tên trong zip, đường dẫn), ...] theo từng đoạn,
+    không tạo file tạm. Video mp4 đã nén sẵn nên lưu kiểu STORED (không nén lại).
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for arcname, path in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as src, zf.open(info, "w", force_zip64=True) as dst:
+                for block in iter(lambda: src.read(chunk_size), b""):
+                    dst.write(block)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()